@@ -0,0 +1 @@
+default_app_config = 'beacon_app.apps.BeaconAppConfig'
@@ -67,3 +67,51 @@ class LogEntryAdmin(admin.ModelAdmin):
     readonly_fields = ('event_type', 'event_text', 'timestamp', 'server_timestamp', 'student')
     search_fields = ('event_type', 'event_text', 'student__user__username')
 
+
+@admin.register(SightingBatch)
+class SightingBatchAdmin(admin.ModelAdmin):
+    readonly_fields = ('student', 'status', 'created_at', 'processed_at', 'sightings', 'result', 'error')
+    list_filter = ('status',)
+
+
+@admin.register(AttendanceCounter)
+class AttendanceCounterAdmin(admin.ModelAdmin):
+    readonly_fields = ('student', 'class_rel', 'attended', 'contributing', 'counted_through', 'upcoming_attended',
+                       'upcoming_contributing', 'valid_until')
+    list_filter = ('dirty',)
+
+
+@admin.register(StreakState)
+class StreakStateAdmin(admin.ModelAdmin):
+    readonly_fields = ('student', 'class_rel', 'processed_through', 'valid_until', 'current_start', 'last_date')
+    list_filter = ('dirty',)
+
+
+@admin.register(StreakRecord)
+class StreakRecordAdmin(admin.ModelAdmin):
+    readonly_fields = ('student', 'class_rel', 'start', 'end')
+    search_fields = ('student__user__username',)
+
+
+@admin.register(BeaconChange)
+class BeaconChangeAdmin(admin.ModelAdmin):
+    readonly_fields = ('beacon_id', 'time')
+    list_display = ('pk', 'beacon_id', 'time')
+
+
+@admin.register(TimetableSyncState)
+class TimetableSyncStateAdmin(admin.ModelAdmin):
+    readonly_fields = ('student', 'payload_hash', 'course_hashes', 'synced_at')
+    search_fields = ('student__user__username',)
+
+
+@admin.register(CourseSchedule)
+class CourseScheduleAdmin(admin.ModelAdmin):
+    readonly_fields = ('schedule_hash', 'meetings')
+
+
+@admin.register(TimetableSyncStatus)
+class TimetableSyncStatusAdmin(admin.ModelAdmin):
+    readonly_fields = ('student', 'status', 'queued_at', 'claimed_at', 'synced_at', 'finished_at', 'error')
+    list_filter = ('status',)
+    search_fields = ('student__user__username',)
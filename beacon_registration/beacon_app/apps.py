@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class BeaconAppConfig(AppConfig):
     name = 'beacon_app'
+
+    def ready(self):
+        # Connects the signal receivers which keep the in-memory indexes, attendance counters, streaks, cached
+        # timetables, ETag versions, beacon manifest and shared course schedules up to date
+        from . import counters, etags, indexes, manifest, meetingbuilder, presence, signals, streaks, timetablecache
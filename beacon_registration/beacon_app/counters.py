@@ -0,0 +1,260 @@
+import datetime
+from typing import Dict, Iterable, List, Tuple, Union
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Count, F, Min, Q, When
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import AttendanceCounter, AttendanceRecord, Beacon, Meeting, MeetingInstance, Student
+from .signals import attendance_recorded, bulk_saved
+
+
+def _aware(value: datetime.datetime) -> datetime.datetime:
+    return timezone.make_aware(value) if timezone.is_naive(value) else value
+
+
+def _count(student: Student, since: Dict[int, datetime.date], today: datetime.date) -> Dict[int, Dict]:
+    """
+    Counts the Student's contributing MeetingInstances for several Classes with a single grouped query
+    :param since: a dictionary mapping from Class pks to the first date to count from, or None to count everything
+    :return: a dictionary mapping from Class pks to the counts before today, the counts for the rest of today, and the
+    time that the next MeetingInstance today starts
+    """
+    window = Q()
+    for class_id, first_date in since.items():
+        class_window = Q(meeting__class_rel=class_id)
+        if first_date is not None:
+            class_window &= Q(date__gte=first_date)
+        window |= class_window
+
+    attended_ids = AttendanceRecord.objects.filter(student=student).values('meeting_instance')
+    instances = student.contributing_instances().filter(window)
+
+    rows = instances.values('meeting__class_rel').annotate(
+        attended=Count(Case(When(date__lt=today, pk__in=attended_ids, then='pk')), distinct=True),
+        contributing=Count(Case(When(date__lt=today, then='pk')), distinct=True),
+        upcoming_attended=Count(Case(When(date=today, pk__in=attended_ids, then='pk')), distinct=True),
+        upcoming_contributing=Count(Case(When(date=today, then='pk')), distinct=True),
+        next_start=Min(Case(When(date=today, then='meeting__time_start')))).order_by()
+
+    return {row['meeting__class_rel']: row for row in rows}
+
+
+def refresh_counters(student: Student, counters: List[AttendanceCounter]):
+    """
+    Brings the Student's AttendanceCounters up to date in place. Dirty counters are recounted from the start, and the
+    rest only count the MeetingInstances since they were last refreshed.
+    """
+    now = datetime.datetime.now()
+    today = now.date()
+
+    since = {counter.class_rel_id: None if counter.dirty else counter.counted_through for counter in counters}
+    counts = _count(student, since, today)
+
+    empty = {'attended': 0, 'contributing': 0, 'upcoming_attended': 0, 'upcoming_contributing': 0,
+             'next_start': None}
+
+    for counter in counters:
+        row = counts.get(counter.class_rel_id, empty)
+
+        if row['next_start'] is not None:
+            # MeetingInstances stop contributing once they start, until the end of the day
+            valid_until = datetime.datetime.combine(today, row['next_start']) + datetime.timedelta(microseconds=1)
+        else:
+            valid_until = datetime.datetime.combine(today + datetime.timedelta(days=1), datetime.time())
+
+        fields = {'counted_through': today,
+                  'upcoming_attended': row['upcoming_attended'],
+                  'upcoming_contributing': row['upcoming_contributing'],
+                  'valid_until': _aware(valid_until),
+                  'dirty': False}
+
+        counters_to_update = AttendanceCounter.objects.filter(pk=counter.pk)
+
+        if counter.pk is None or counter.dirty:
+            fields['attended'] = row['attended']
+            fields['contributing'] = row['contributing']
+            update = dict(fields)
+        else:
+            # Added to rather than overwritten, in case attendance was recorded while counting. Only added if no one
+            # else has brought the counter forward since it was read, so that the same days aren't counted twice.
+            fields['attended'] = counter.attended + row['attended']
+            fields['contributing'] = counter.contributing + row['contributing']
+            update = dict(fields, attended=F('attended') + row['attended'],
+                          contributing=F('contributing') + row['contributing'])
+            counters_to_update = counters_to_update.filter(counted_through=counter.counted_through, dirty=False)
+
+        if counter.pk is None:
+            for field, value in fields.items():
+                setattr(counter, field, value)
+
+            try:
+                with transaction.atomic():
+                    counter.save()
+            except IntegrityError:
+                # Another request created the counter first, and has already counted the same MeetingInstances
+                pass
+        elif counters_to_update.update(**update):
+            for field, value in fields.items():
+                setattr(counter, field, value)
+        else:
+            # Refreshed or marked dirty by another request since it was read
+            counter.refresh_from_db()
+
+
+def attendance_counters(student: Student, class_ids: Iterable[int]) -> Dict[int, AttendanceCounter]:
+    """
+    :return: a dictionary mapping from each Class pk to the Student's up to date AttendanceCounter for that Class
+    """
+    class_ids = list(class_ids)
+    now = timezone.now()
+
+    counters = {counter.class_rel_id: counter for counter in
+                AttendanceCounter.objects.filter(student=student, class_rel__in=class_ids)}
+
+    stale = []
+    for class_id in class_ids:
+        counter = counters.get(class_id)
+
+        if counter is None:
+            counter = counters[class_id] = AttendanceCounter(student=student, class_rel_id=class_id)
+
+        if counter.pk is None or counter.dirty or counter.valid_until is None or now >= counter.valid_until:
+            stale.append(counter)
+
+    if stale:
+        refresh_counters(student, stale)
+
+    return counters
+
+
+def counters_stamp(counters: Iterable[AttendanceCounter]) -> Union[Tuple, None]:
+    """
+    :return: a value which changes whenever the AttendanceCounters are refreshed, or None if some of them are out of
+    date
+    """
+    counters = list(counters)
+    now = timezone.now()
+
+    if any(counter.dirty or counter.valid_until is None or now >= counter.valid_until for counter in counters):
+        return None
+
+    return len(counters), min((counter.valid_until.timestamp() for counter in counters), default=None)
+
+
+def counters_version(student: Student) -> Union[Tuple, None]:
+    """
+    :return: a value which changes whenever the AttendanceCounters for the Student's Classes are refreshed, or None if
+    some of them are out of date and need refreshing first. Free once the Student's attendances have been read.
+    """
+    stamp = getattr(student, '_counters_version', None)
+    if stamp is not None:
+        return stamp
+
+    return counters_stamp(AttendanceCounter.objects.filter(student=student,
+                                                           class_rel__in=student.meeting_set.values('class_rel'))
+                          .only('dirty', 'valid_until'))
+
+
+def refresh_stale_counters() -> int:
+    """
+    Refreshes every AttendanceCounter which is dirty or has expired, one Student at a time
+    :return: the number of counters refreshed
+    """
+    now = timezone.now()
+    stale = AttendanceCounter.objects.filter(Q(dirty=True) | Q(valid_until__isnull=True) | Q(valid_until__lte=now))
+
+    by_student = {}
+    for counter in stale.select_related('student').order_by('student'):
+        by_student.setdefault(counter.student_id, []).append(counter)
+
+    for counters in by_student.values():
+        refresh_counters(counters[0].student, counters)
+
+    return sum(len(counters) for counters in by_student.values())
+
+
+def _attendance_changed(records: Iterable[AttendanceRecord], change: int):
+    """
+    Adds change to the attended counts of the AttendanceCounters that have already counted the records'
+    MeetingInstances
+    """
+    today = datetime.date.today()
+
+    for record in records:
+        # Counters are only ever counted up to today, so attendance from today onwards is counted when they are next
+        # refreshed. This is the usual case, and needs no queries.
+        if AttendanceRecord.meeting_instance.is_cached(record) and record.meeting_instance.date >= today:
+            continue
+
+        instance_date = F('class_rel__meetings__instances__date')
+
+        AttendanceCounter.objects.filter(student=record.student_id,
+                                         class_rel__meetings__instances=record.meeting_instance_id,
+                                         counted_through__gt=instance_date,
+                                         student__date_registered__lte=instance_date,
+                                         class_rel__meetings__instances__room__beacons__date_added__lte=instance_date,
+                                         dirty=False).update(attended=F('attended') + change)
+
+
+@receiver(attendance_recorded)
+def _attendance_recorded(sender, records, **kwargs):
+    _attendance_changed(records, 1)
+
+
+@receiver(post_delete, sender=AttendanceRecord)
+def _attendance_record_deleted(sender, instance, **kwargs):
+    _attendance_changed([instance], -1)
+
+
+@receiver(post_save, sender=Beacon)
+@receiver(post_delete, sender=Beacon)
+def _beacon_changed(sender, instance, **kwargs):
+    AttendanceCounter.objects.filter(class_rel__meetings__instances__room=instance.room_id).update(dirty=True)
+
+
+def _meeting_instances_changed(instances: Iterable[MeetingInstance]):
+    # Counters haven't counted future MeetingInstances yet, and timetable syncs mostly add those
+    today = datetime.date.today()
+    meeting_ids = {instance.meeting_id for instance in instances if instance.date <= today}
+
+    if meeting_ids:
+        AttendanceCounter.objects.filter(class_rel__meetings__in=meeting_ids).update(dirty=True)
+
+
+@receiver(post_save, sender=MeetingInstance)
+def _meeting_instance_saved(sender, instance, created, raw=False, **kwargs):
+    # Changing a MeetingInstance's lecturer doesn't change the counts, only new MeetingInstances do
+    if created and not raw:
+        _meeting_instances_changed([instance])
+
+
+@receiver(bulk_saved, sender=MeetingInstance)
+def _meeting_instances_bulk_saved(sender, instances, created, **kwargs):
+    if created:
+        _meeting_instances_changed(instances)
+
+
+@receiver(post_delete, sender=MeetingInstance)
+def _meeting_instance_deleted(sender, instance, **kwargs):
+    _meeting_instances_changed([instance])
+
+
+@receiver(m2m_changed, sender=Meeting.students.through)
+def _meeting_students_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if reverse:
+        # instance is a Student, and pk_set holds Meetings
+        counters = AttendanceCounter.objects.filter(student=instance)
+        if pk_set:
+            counters = counters.filter(class_rel__meetings__in=pk_set)
+    else:
+        counters = AttendanceCounter.objects.filter(class_rel=instance.class_rel_id)
+        if pk_set:
+            counters = counters.filter(student__in=pk_set)
+
+    counters.update(dirty=True)
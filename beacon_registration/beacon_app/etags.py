@@ -0,0 +1,99 @@
+import hashlib
+from typing import List, Union
+
+from django.db.models.signals import post_save, post_delete
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.response import Response
+
+from .models import Beacon, Building, Class, Meeting, MeetingInstance, Room
+from .signals import bulk_saved
+from .versions import bump_version, get_versions
+
+# Models which the read-only viewsets serialize, and whose changes should change those viewsets' ETags
+VERSIONED_MODELS = (Beacon, Building, Class, Meeting, MeetingInstance, Room)
+
+
+def model_version_key(model) -> str:
+    """
+    :return: the key of the Version which is bumped whenever any instance of the model is saved or deleted
+    """
+    return 'model-version:{}'.format(model._meta.label_lower)
+
+
+def _model_changed(sender, **kwargs):
+    bump_version(model_version_key(sender))
+
+
+for versioned_model in VERSIONED_MODELS:
+    post_save.connect(_model_changed, sender=versioned_model, dispatch_uid='etag-save-{}'.format(versioned_model))
+    post_delete.connect(_model_changed, sender=versioned_model, dispatch_uid='etag-delete-{}'.format(versioned_model))
+    bulk_saved.connect(_model_changed, sender=versioned_model, dispatch_uid='etag-bulk-{}'.format(versioned_model))
+
+
+class NotModified(APIException):
+    status_code = status.HTTP_304_NOT_MODIFIED
+
+
+def _parse_etags(header: str) -> List[str]:
+    return [etag.strip() for etag in header.split(',') if etag.strip()]
+
+
+class ConditionalGetMixin:
+    """
+    Adds strong ETags to a view's GET responses, and answers GETs with a matching If-None-Match header with 304 Not
+    Modified before the view runs.
+
+    The ETag is made from the version stamps returned by get_etag_parts(). By default, these are the Versions of the
+    models listed in etag_models, which are read with a single query.
+    """
+    etag_models = ()
+
+    def get_etag_parts(self, request, *args, **kwargs) -> Union[List, None]:
+        """
+        :return: cheap values which change whenever the response would, or None if there is no ETag for the request
+        """
+        if not self.etag_models:
+            return None
+
+        return get_versions([model_version_key(model) for model in self.etag_models])
+
+    def get_etag(self, request, *args, **kwargs) -> Union[str, None]:
+        parts = self.get_etag_parts(request, *args, **kwargs)
+        if parts is None:
+            return None
+
+        # Responses also depend on the URL, the host that absolute links point to, and the format they are rendered in
+        parts = [request.build_absolute_uri(), request.accepted_renderer.format] + parts
+        return '"{}"'.format(hashlib.sha1('|'.join(str(part) for part in parts).encode('UTF-8')).hexdigest())
+
+    def initial(self, request, *args, **kwargs):
+        super(ConditionalGetMixin, self).initial(request, *args, **kwargs)
+
+        self.etag = None
+        if_none_match = _parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+
+        # Without If-None-Match, the ETag is only needed for the response
+        if request.method in ('GET', 'HEAD') and if_none_match:
+            self.etag = self.get_etag(request, *args, **kwargs)
+
+            if self.etag is not None and (self.etag in if_none_match or '*' in if_none_match):
+                raise NotModified()
+
+    def handle_exception(self, exc):
+        if isinstance(exc, NotModified):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': self.etag})
+
+        return super(ConditionalGetMixin, self).handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(ConditionalGetMixin, self).finalize_response(request, response, *args, **kwargs)
+
+        if request.method in ('GET', 'HEAD') and response.status_code == status.HTTP_200_OK \
+                and not response.has_header('ETag'):
+            # When there was no ETag before the view ran, the view may have brought the versions up to date
+            etag = getattr(self, 'etag', None) or self.get_etag(request, *args, **kwargs)
+            if etag is not None:
+                response['ETag'] = etag
+
+        return response
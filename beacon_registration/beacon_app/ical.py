@@ -0,0 +1,181 @@
+import calendar
+import datetime
+import itertools
+from typing import Iterable, Iterator, List
+
+import pytz
+from django.conf import settings
+from django.utils import timezone
+
+from .models import MeetingInstance
+
+# Lines longer than this many octets have to be folded onto continuation lines
+MAX_LINE_OCTETS = 75
+
+WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+
+
+def _fold(line: str) -> str:
+    """
+    :return: the content line, folded into CRLF terminated lines of at most MAX_LINE_OCTETS octets
+    """
+    lines = []
+    current, octets = '', 0
+
+    for char in line:
+        char_octets = len(char.encode('UTF-8'))
+        if octets + char_octets > MAX_LINE_OCTETS:
+            lines.append(current)
+            # Continuation lines start with a space, which counts towards their length
+            current, octets = ' ', 1
+
+        current += char
+        octets += char_octets
+
+    lines.append(current)
+    return ''.join(line + '\r\n' for line in lines)
+
+
+def _escape(text: str) -> str:
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def _local(date: datetime.date, time: datetime.time) -> str:
+    return datetime.datetime.combine(date, time).strftime('%Y%m%dT%H%M%S')
+
+
+def _offset(offset: datetime.timedelta) -> str:
+    minutes = int(offset.total_seconds()) // 60
+    return '{}{:02}{:02}'.format('-' if minutes < 0 else '+', abs(minutes) // 60, abs(minutes) % 60)
+
+
+def _nth_weekday(year: int, month: int, weekday: int, nth: int) -> datetime.date:
+    """
+    :return: the nth weekday of the month, counting back from the end of the month if nth is negative
+    """
+    if nth > 0:
+        first = datetime.date(year, month, 1)
+        return first + datetime.timedelta(days=(weekday - first.weekday()) % 7 + 7 * (nth - 1))
+
+    last = datetime.date(year, month, calendar.monthrange(year, month)[1])
+    return last - datetime.timedelta(days=(last.weekday() - weekday) % 7 + 7 * (-nth - 1))
+
+
+def _vtimezone(name: str, year: int) -> List[str]:
+    """
+    :return: the lines of a VTIMEZONE for the time zone, which repeats the changes the zone makes in the year every
+    year, from 1970 onwards
+    """
+    zone = pytz.timezone(name)
+    lines = ['BEGIN:VTIMEZONE', 'TZID:' + name]
+
+    # pytz has no public way of listing a zone's changes. Each change is the UTC time it happens at, and the offset,
+    # daylight saving and abbreviation from then on.
+    times = getattr(zone, '_utc_transition_times', [])
+    infos = getattr(zone, '_transition_info', [])
+    changes = [(time, infos[i - 1], infos[i]) for i, time in enumerate(times) if i and time.year == year]
+
+    if not changes:
+        local = zone.localize(datetime.datetime(year, 1, 1))
+        lines += ['BEGIN:STANDARD',
+                  'DTSTART:19700101T000000',
+                  'TZOFFSETFROM:' + _offset(local.utcoffset()),
+                  'TZOFFSETTO:' + _offset(local.utcoffset()),
+                  'TZNAME:' + local.tzname(),
+                  'END:STANDARD']
+
+    for time, (offset_from, _, _), (offset_to, dst, tzname) in changes:
+        # Changes happen on a weekday of the month, e.g. the last Sunday of March, at a local time
+        onset = time + offset_from
+        nth = -1 if onset.day + 7 > calendar.monthrange(onset.year, onset.month)[1] else (onset.day - 1) // 7 + 1
+        component = 'DAYLIGHT' if dst else 'STANDARD'
+
+        lines += ['BEGIN:' + component,
+                  'DTSTART:' + _local(_nth_weekday(1970, onset.month, onset.weekday(), nth), onset.time()),
+                  'RRULE:FREQ=YEARLY;BYMONTH={};BYDAY={}{}'.format(onset.month, nth, WEEKDAYS[onset.weekday()]),
+                  'TZOFFSETFROM:' + _offset(offset_from),
+                  'TZOFFSETTO:' + _offset(offset_to),
+                  'TZNAME:' + tzname,
+                  'END:' + component]
+
+    lines.append('END:VTIMEZONE')
+    return lines
+
+
+def _series(instances: List[MeetingInstance]) -> Iterator[List[MeetingInstance]]:
+    """
+    Splits the MeetingInstances of a Meeting, sorted by date, into series which can each be written as a weekly RRULE
+    """
+    series = []
+
+    for instance in instances:
+        if series and (instance.date - series[0].date).days % 7 != 0:
+            yield series
+            series = []
+        series.append(instance)
+
+    if series:
+        yield series
+
+
+def _event(series: List[MeetingInstance], host: str, stamp: str) -> str:
+    """
+    :return: a VEVENT covering every MeetingInstance in the series, repeating weekly from the first one to the last
+    """
+    first = series[0]
+    meeting = first.meeting
+    tzid = 'TZID=' + settings.TIME_ZONE
+
+    weeks = (series[-1].date - first.date).days // 7 + 1
+    dates = {instance.date for instance in series}
+    excluded = [first.date + datetime.timedelta(weeks=week) for week in range(weeks)
+                if first.date + datetime.timedelta(weeks=week) not in dates]
+
+    lines = ['BEGIN:VEVENT',
+             'UID:{}-{}-{}-{}@{}'.format(meeting.pk, first.room_id, first.lecturer_id, first.date.strftime('%Y%m%d'),
+                                         host),
+             'DTSTAMP:' + stamp,
+             'DTSTART;{}:{}'.format(tzid, _local(first.date, meeting.time_start)),
+             'DTEND;{}:{}'.format(tzid, _local(first.date, meeting.time_end))]
+
+    if weeks > 1:
+        # COUNT includes the excluded dates
+        lines.append('RRULE:FREQ=WEEKLY;COUNT={}'.format(weeks))
+    if excluded:
+        lines.append('EXDATE;{}:{}'.format(tzid, ','.join(_local(date, meeting.time_start) for date in excluded)))
+
+    lines.append('SUMMARY:' + _escape(str(meeting.class_rel)))
+    if first.room is not None:
+        lines.append('LOCATION:' + _escape('{}, {}'.format(first.room.room_code, first.room.building.name)))
+    if first.lecturer is not None:
+        lines.append('DESCRIPTION:' + _escape('Lecturer: {}'.format(first.lecturer.name)))
+    lines.append('END:VEVENT')
+
+    return ''.join(_fold(line) for line in lines)
+
+
+def timetable_calendar(username: str, instances: Iterable[MeetingInstance], host: str) -> Iterator[str]:
+    """
+    Writes the MeetingInstances in a Student's timetable as an iCalendar file, a few lines at a time. The
+    MeetingInstances of each Meeting which share a Room and Lecturer are written as one weekly repeating event, rather
+    than one event each.
+    :param username: the Student's username
+    :param instances: the MeetingInstances, sorted by Meeting, Room, Lecturer and then date
+    :param host: the host name used to make the events' UIDs unique
+    """
+    stamp = timezone.now().astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+    # The events' times are in settings.TIME_ZONE, which has to be described for them
+    yield ''.join(_fold(line) for line in ['BEGIN:VCALENDAR',
+                                           'VERSION:2.0',
+                                           'PRODID:-//Beacon Registration//Timetable//EN',
+                                           'CALSCALE:GREGORIAN',
+                                           'X-WR-CALNAME:' + _escape('Timetable for {}'.format(username))] +
+                  _vtimezone(settings.TIME_ZONE, timezone.now().year))
+
+    for _, group in itertools.groupby(instances, lambda instance: (instance.meeting_id, instance.room_id,
+                                                                  instance.lecturer_id)):
+        for series in _series(list(group)):
+            yield _event(series, host, stamp)
+
+    yield _fold('END:VCALENDAR')
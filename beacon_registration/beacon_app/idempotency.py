@@ -0,0 +1,38 @@
+import functools
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import status
+from rest_framework.response import Response
+
+
+def idempotent(view_method):
+    """
+    Lets clients safely retry a request by sending an Idempotency-Key header. The response to the first successful
+    request with a key is cached for settings.IDEMPOTENCY_KEY_TIMEOUT seconds, and replayed for any repeat of that key
+    by the same user without running the view again.
+    """
+
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if not key:
+            return view_method(self, request, *args, **kwargs)
+
+        digest = hashlib.sha1(key.encode('UTF-8')).hexdigest()
+        cache_key = 'idempotency:{}:{}:{}'.format(request.user.pk, view_method.__name__, digest)
+
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return Response(cached['data'], status=cached['status'])
+
+        response = view_method(self, request, *args, **kwargs)
+
+        if status.is_success(response.status_code):
+            cache.set(cache_key, {'data': response.data, 'status': response.status_code},
+                      settings.IDEMPOTENCY_KEY_TIMEOUT)
+
+        return response
+
+    return wrapper
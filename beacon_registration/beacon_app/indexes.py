@@ -0,0 +1,593 @@
+import bisect
+import datetime
+import heapq
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Set, Tuple, Union
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Beacon, ShuffledID, Meeting, MeetingInstance, AttendanceRecord
+from .signals import attendance_recorded, bulk_saved
+
+BeaconKey = Tuple[str, int, int]
+
+
+def beacon_key(uuid, major: int, minor: int) -> BeaconKey:
+    return str(uuid), int(major), int(minor)
+
+
+class BeaconIndex:
+    """
+    An in-memory map from the (uuid, major, minor) identifiers broadcast by a beacon to the Beacon and Room they
+    belong to. Covers the real identifiers of every Beacon, along with the ShuffledIDs which are still valid or expired
+    less than settings.SHUFFLED_ID_GRACE ago, so that sightings buffered since then still resolve. Sightings from before
+    the grace window are looked up in the database.
+
+    The index is loaded on first use, kept up to date as Beacons and ShuffledIDs are saved or deleted in this process,
+    and reloaded in full once it is older than settings.BEACON_INDEX_MAX_AGE, to pick up changes made elsewhere.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded_at = None
+
+        self._beacons = {}  # type: Dict[BeaconKey, Beacon]
+        self._beacon_keys = {}  # type: Dict[int, BeaconKey]
+
+        self._shuffled = {}  # type: Dict[BeaconKey, Tuple[datetime.datetime, Beacon, int]]
+        self._shuffled_keys = {}  # type: Dict[int, BeaconKey]
+        self._expiry_heap = []
+
+    def clear(self):
+        """
+        Drops everything in the index, so that it is reloaded from the database on next use
+        """
+        with self._lock:
+            self._loaded_at = None
+            self._beacons = {}
+            self._beacon_keys = {}
+            self._shuffled = {}
+            self._shuffled_keys = {}
+            self._expiry_heap = []
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded_at is not None
+
+    def _load(self, now: datetime.datetime):
+        self.clear()
+
+        for beacon in Beacon.objects.select_related('room'):
+            self._add_beacon(beacon)
+
+        kept_after = now - settings.SHUFFLED_ID_GRACE
+        for shuffled_id in ShuffledID.objects.filter(valid_until__gte=kept_after).select_related('beacon__room'):
+            self._add_shuffled_id(shuffled_id)
+
+        self._loaded_at = now
+
+    def _ensure_loaded(self, now: datetime.datetime):
+        if self._loaded_at is None or now - self._loaded_at > settings.BEACON_INDEX_MAX_AGE:
+            self._load(now)
+        else:
+            self._expire(now)
+
+    def _expire(self, now: datetime.datetime):
+        kept_after = now - settings.SHUFFLED_ID_GRACE
+        while self._expiry_heap and self._expiry_heap[0][0] < kept_after:
+            valid_until, key = heapq.heappop(self._expiry_heap)
+
+            entry = self._shuffled.get(key)
+
+            # The key may have been given a later valid_until since this heap entry was pushed
+            if entry is not None and entry[0] == valid_until:
+                self._remove_shuffled_id(entry[2])
+
+    def _add_beacon(self, beacon: Beacon):
+        self._remove_beacon(beacon.pk)
+
+        key = beacon_key(beacon.uuid, beacon.major, beacon.minor)
+        self._beacons[key] = beacon
+        self._beacon_keys[beacon.pk] = key
+
+    def _remove_beacon(self, pk: int):
+        key = self._beacon_keys.pop(pk, None)
+        if key is not None:
+            self._beacons.pop(key, None)
+
+    def _add_shuffled_id(self, shuffled_id: ShuffledID):
+        self._remove_shuffled_id(shuffled_id.pk)
+
+        key = beacon_key(shuffled_id.uuid, shuffled_id.major, shuffled_id.minor)
+        self._shuffled[key] = (shuffled_id.valid_until, shuffled_id.beacon, shuffled_id.pk)
+        self._shuffled_keys[shuffled_id.pk] = key
+        heapq.heappush(self._expiry_heap, (shuffled_id.valid_until, key))
+
+    def _remove_shuffled_id(self, pk: int):
+        key = self._shuffled_keys.pop(pk, None)
+        if key is not None:
+            self._shuffled.pop(key, None)
+
+    def resolve(self, uuid, major: int, minor: int,
+                seen_at: Union[datetime.datetime, None] = None) -> Union[Beacon, None]:
+        """
+        :param seen_at: the time that the identifiers were broadcast, defaults to now
+        :return: the Beacon which broadcast these identifiers, or None if they aren't known
+        """
+        return self.resolve_many([(beacon_key(uuid, major, minor), seen_at or timezone.now())])[0]
+
+    def resolve_many(self, sightings: List[Tuple[BeaconKey, datetime.datetime]]) -> List[Union[Beacon, None]]:
+        """
+        Like resolve(), for many sightings at once. Sightings from before the grace window which the index can't
+        resolve are looked up in the database together, with a single query.
+        :param sightings: pairs of the identifiers broadcast, made with beacon_key(), and the time they were broadcast
+        :return: the Beacon which broadcast each sighting's identifiers, or None if they aren't known, in the same order
+        """
+        now = timezone.now()
+        kept_after = now - settings.SHUFFLED_ID_GRACE
+
+        beacons = []
+        missed = []
+
+        with self._lock:
+            self._ensure_loaded(now)
+
+            for position, (key, seen_at) in enumerate(sightings):
+                beacon = self._beacons.get(key)
+                entry = self._shuffled.get(key)
+
+                if beacon is None and entry is not None and seen_at <= entry[0]:
+                    beacon = entry[1]
+                elif beacon is None and entry is None and seen_at < kept_after:
+                    missed.append(position)
+
+                beacons.append(beacon)
+
+        if missed:
+            # Shuffled identifiers which expired before the grace window have been dropped from the index
+            keys = {sightings[position][0] for position in missed}
+            shuffled_ids = ShuffledID.objects.filter(uuid__in={key[0] for key in keys},
+                                                     major__in={key[1] for key in keys},
+                                                     minor__in={key[2] for key in keys},
+                                                     valid_until__gte=min(sightings[position][1]
+                                                                          for position in missed))
+            shuffled = {beacon_key(shuffled_id.uuid, shuffled_id.major, shuffled_id.minor): shuffled_id
+                        for shuffled_id in shuffled_ids.select_related('beacon__room')}
+
+            for position in missed:
+                key, seen_at = sightings[position]
+                shuffled_id = shuffled.get(key)
+                if shuffled_id is not None and seen_at <= shuffled_id.valid_until:
+                    beacons[position] = shuffled_id.beacon
+
+        return beacons
+
+    def beacon_saved(self, beacon: Beacon):
+        with self._lock:
+            if self.loaded:
+                self._add_beacon(beacon)
+
+    def beacon_deleted(self, beacon: Beacon):
+        with self._lock:
+            if self.loaded:
+                self._remove_beacon(beacon.pk)
+
+                for pk, key in list(self._shuffled_keys.items()):
+                    if self._shuffled[key][1].pk == beacon.pk:
+                        self._remove_shuffled_id(pk)
+
+    def shuffled_id_saved(self, shuffled_id: ShuffledID):
+        with self._lock:
+            if self.loaded:
+                if shuffled_id.valid_until >= timezone.now() - settings.SHUFFLED_ID_GRACE:
+                    self._add_shuffled_id(shuffled_id)
+                else:
+                    self._remove_shuffled_id(shuffled_id.pk)
+
+    def shuffled_id_deleted(self, shuffled_id: ShuffledID):
+        with self._lock:
+            if self.loaded:
+                self._remove_shuffled_id(shuffled_id.pk)
+
+
+beacon_index = BeaconIndex()
+
+
+@receiver(post_save, sender=Beacon)
+def _beacon_saved(sender, instance, **kwargs):
+    beacon_index.beacon_saved(instance)
+
+
+@receiver(post_delete, sender=Beacon)
+def _beacon_deleted(sender, instance, **kwargs):
+    beacon_index.beacon_deleted(instance)
+
+
+@receiver(post_save, sender=ShuffledID)
+def _shuffled_id_saved(sender, instance, **kwargs):
+    beacon_index.shuffled_id_saved(instance)
+
+
+@receiver(post_delete, sender=ShuffledID)
+def _shuffled_id_deleted(sender, instance, **kwargs):
+    beacon_index.shuffled_id_deleted(instance)
+
+
+class RoomSchedule:
+    """
+    The MeetingInstances taking place in a single Room on a single date, sorted by start time so that the instances
+    on at a particular time can be found with a binary search
+    """
+
+    def __init__(self, instances: Iterable[MeetingInstance]):
+        self.instances = sorted(instances, key=lambda i: (i.meeting.time_start, i.meeting.time_end, i.pk))
+        self.starts = [instance.meeting.time_start for instance in self.instances]
+
+        # max_ends[i] is the latest time_end of any of the first i + 1 instances, which bounds the backwards scan
+        self.max_ends = []
+        for instance in self.instances:
+            latest = self.max_ends[-1] if self.max_ends else instance.meeting.time_end
+            self.max_ends.append(max(latest, instance.meeting.time_end))
+
+    def on_at(self, time: datetime.time) -> List[MeetingInstance]:
+        """
+        :return: the instances in this Room which have started and not yet ended at the time, latest starting first
+        """
+        on = []
+
+        i = bisect.bisect_right(self.starts, time) - 1
+        while i >= 0 and self.max_ends[i] >= time:
+            if self.instances[i].meeting.time_end >= time:
+                on.append(self.instances[i])
+            i -= 1
+
+        return on
+
+
+class DayMeetings:
+    """
+    Every MeetingInstance scheduled on a date, indexed by Room, along with the set of Students enrolled in each Meeting
+    """
+
+    def __init__(self, date: datetime.date, instances: Iterable[MeetingInstance],
+                 students_by_meeting: Dict[int, Set[int]]):
+        self.date = date
+        self.instances = {instance.pk: instance for instance in instances}
+        self.students_by_meeting = students_by_meeting
+        self.rooms = {}  # type: Dict[int, RoomSchedule]
+
+        # Built on first use, and dropped whenever the instances or enrollments change
+        self._by_student = None  # type: Dict[int, List[MeetingInstance]]
+
+        self._index_rooms(self.instances.values())
+
+    @classmethod
+    def build(cls, date: datetime.date) -> 'DayMeetings':
+        instances = list(MeetingInstance.objects.filter(date=date).select_related('meeting__class_rel',
+                                                                                  'room__building',
+                                                                                  'lecturer'))
+
+        students_by_meeting = {instance.meeting_id: set() for instance in instances}
+        enrollments = Meeting.students.through.objects.filter(meeting_id__in=students_by_meeting.keys())
+        for meeting_id, student_id in enrollments.values_list('meeting_id', 'student_id'):
+            students_by_meeting[meeting_id].add(student_id)
+
+        return cls(date, instances, students_by_meeting)
+
+    def _index_rooms(self, instances: Iterable[MeetingInstance]):
+        room_ids = {instance.room_id for instance in instances if instance.room_id is not None}
+
+        for room_id in room_ids:
+            self.rooms[room_id] = RoomSchedule(instance for instance in self.instances.values()
+                                               if instance.room_id == room_id)
+
+    def find(self, student_id: int, room_id: int, time: datetime.time) -> Union[MeetingInstance, None]:
+        """
+        :return: the instance that the Student is enrolled in, taking place in the Room at the time
+        """
+        schedule = self.rooms.get(room_id)
+        if schedule is None:
+            return None
+
+        for instance in schedule.on_at(time):
+            if student_id in self.students_by_meeting.get(instance.meeting_id, ()):
+                return instance
+
+        return None
+
+    def student_instances(self, student_id: int) -> List[MeetingInstance]:
+        """
+        :return: every instance that the Student is enrolled in, in pk order
+        """
+        if self._by_student is None:
+            by_student = {}
+            for instance in sorted(self.instances.values(), key=lambda i: i.pk):
+                for enrolled_id in self.students_by_meeting.get(instance.meeting_id, ()):
+                    by_student.setdefault(enrolled_id, []).append(instance)
+
+            self._by_student = by_student
+
+        return self._by_student.get(student_id, [])
+
+    def on_at(self, student_id: int, time: datetime.time) -> List[MeetingInstance]:
+        """
+        :return: every instance that the Student is enrolled in which is taking place at the time
+        """
+        return [instance for instance in self.student_instances(student_id)
+                if instance.meeting.time_start <= time <= instance.meeting.time_end]
+
+    def instance_saved(self, instance: MeetingInstance):
+        self._by_student = None
+        old = self.instances.pop(instance.pk, None)
+
+        if instance.date == self.date:
+            self.instances[instance.pk] = instance
+
+            if instance.meeting_id not in self.students_by_meeting:
+                self.students_by_meeting[instance.meeting_id] = set(
+                    Meeting.students.through.objects.filter(meeting_id=instance.meeting_id).values_list('student_id',
+                                                                                                        flat=True))
+
+        self._index_rooms(i for i in (old, instance) if i is not None)
+
+    def instance_deleted(self, instance: MeetingInstance):
+        self._by_student = None
+        if self.instances.pop(instance.pk, None) is not None:
+            self._index_rooms([instance])
+
+    def enrollment_changed(self, meeting_ids: Iterable[int], student_ids: Iterable[int], enrolled: bool):
+        self._by_student = None
+        for meeting_id in meeting_ids:
+            students = self.students_by_meeting.get(meeting_id)
+            if students is None:
+                continue
+
+            if enrolled:
+                students.update(student_ids)
+            else:
+                students.difference_update(student_ids)
+
+
+class MeetingIndex:
+    """
+    Keeps a DayMeetings index for each of the most recently used dates, so that the MeetingInstance a Student is in at
+    a particular time and place can be found without a database query.
+
+    Each date is built once on first use, and patched as MeetingInstances and Meeting enrollments change in this
+    process. Dates are rebuilt once they are older than settings.MEETING_INDEX_MAX_AGE, and at most
+    settings.MEETING_INDEX_MAX_DAYS dates are kept.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._days = OrderedDict()  # type: Dict[datetime.date, Tuple[datetime.datetime, DayMeetings]]
+
+    def clear(self):
+        with self._lock:
+            self._days = OrderedDict()
+
+    def has_day(self, date: datetime.date) -> bool:
+        """
+        :return: whether the date can be used without building it
+        """
+        with self._lock:
+            entry = self._days.get(date)
+            return entry is not None and timezone.now() - entry[0] <= settings.MEETING_INDEX_MAX_AGE
+
+    def day(self, date: datetime.date) -> DayMeetings:
+        now = timezone.now()
+
+        with self._lock:
+            entry = self._days.get(date)
+
+            if entry is None or now - entry[0] > settings.MEETING_INDEX_MAX_AGE:
+                entry = (now, DayMeetings.build(date))
+                self._days[date] = entry
+
+                while len(self._days) > settings.MEETING_INDEX_MAX_DAYS:
+                    self._days.popitem(last=False)
+
+            self._days.move_to_end(date)
+
+            return entry[1]
+
+    def find(self, student_id: int, room_id: int, at: datetime.datetime) -> Union[MeetingInstance, None]:
+        """
+        :return: the MeetingInstance that the Student is enrolled in, taking place in the Room at the time
+        """
+        return self.day(at.date()).find(student_id, room_id, at.time())
+
+    def on_at(self, student_id: int, at: datetime.datetime) -> List[MeetingInstance]:
+        """
+        :return: every MeetingInstance that the Student is enrolled in which is taking place at the time
+        """
+        return self.day(at.date()).on_at(student_id, at.time())
+
+    def _cached_days(self) -> List[DayMeetings]:
+        return [entry[1] for entry in self._days.values()]
+
+    def instance_saved(self, instance: MeetingInstance):
+        with self._lock:
+            for day in self._cached_days():
+                if instance.date == day.date or instance.pk in day.instances:
+                    day.instance_saved(instance)
+
+    def instance_deleted(self, instance: MeetingInstance):
+        with self._lock:
+            for day in self._cached_days():
+                day.instance_deleted(instance)
+
+    def dates_changed(self, dates: Iterable[datetime.date]):
+        """
+        Drops the dates, so that they are rebuilt on next use. Used when many MeetingInstances change at once.
+        """
+        with self._lock:
+            for date in set(dates):
+                self._days.pop(date, None)
+
+    def meeting_saved(self, meeting: Meeting):
+        with self._lock:
+            for date, entry in list(self._days.items()):
+                if meeting.pk in entry[1].students_by_meeting:
+                    # The times of the meeting may have changed, so the instances need to be re-sorted
+                    del self._days[date]
+
+    def enrollment_changed(self, meeting_ids: Iterable[int], student_ids: Iterable[int], enrolled: bool):
+        meeting_ids = list(meeting_ids)
+        student_ids = list(student_ids)
+
+        with self._lock:
+            for day in self._cached_days():
+                day.enrollment_changed(meeting_ids, student_ids, enrolled)
+
+
+meeting_index = MeetingIndex()
+
+
+@receiver(post_save, sender=MeetingInstance)
+def _meeting_instance_saved(sender, instance, **kwargs):
+    meeting_index.instance_saved(instance)
+
+
+@receiver(post_delete, sender=MeetingInstance)
+def _meeting_instance_deleted(sender, instance, **kwargs):
+    meeting_index.instance_deleted(instance)
+
+
+@receiver(bulk_saved, sender=MeetingInstance)
+def _meeting_instances_bulk_saved(sender, instances, **kwargs):
+    meeting_index.dates_changed(instance.date for instance in instances)
+
+
+@receiver(post_save, sender=Meeting)
+def _meeting_saved(sender, instance, created, **kwargs):
+    if not created:
+        meeting_index.meeting_saved(instance)
+
+
+@receiver(post_delete, sender=Meeting)
+def _meeting_deleted(sender, instance, **kwargs):
+    meeting_index.meeting_saved(instance)
+
+
+@receiver(m2m_changed, sender=Meeting.students.through)
+def _meeting_students_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if action == 'pre_clear':
+        # The removed objects aren't provided after a clear, so they need to be looked up first
+        if reverse:
+            pk_set = set(instance.meeting_set.values_list('pk', flat=True))
+        else:
+            pk_set = set(instance.students.values_list('pk', flat=True))
+
+    enrolled = action == 'post_add'
+
+    if reverse:
+        # instance is a Student, pk_set contains Meeting pks
+        meeting_index.enrollment_changed(pk_set, [instance.pk], enrolled)
+    else:
+        meeting_index.enrollment_changed([instance.pk], pk_set, enrolled)
+
+
+class AttendedIndex:
+    """
+    Remembers which MeetingInstances each recently active Student has attended on recently used dates, so that
+    repeated sightings of an instance that has already been attended don't need a query.
+
+    Each Student's entry is loaded a date at a time, updated as AttendanceRecords are written or deleted in this
+    process, and reloaded once it is older than settings.ATTENDED_INDEX_MAX_AGE. At most
+    settings.ATTENDED_INDEX_MAX_STUDENTS Students are kept.
+    """
+
+    class _Entry:
+        __slots__ = ('loaded_at', 'dates', 'instance_ids')
+
+        def __init__(self, loaded_at: datetime.datetime):
+            self.loaded_at = loaded_at
+            self.dates = set()
+            self.instance_ids = set()
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._students = OrderedDict()  # type: Dict[int, AttendedIndex._Entry]
+
+    def clear(self):
+        with self._lock:
+            self._students = OrderedDict()
+
+    def attended(self, student_id: int, dates: Iterable[datetime.date]) -> Set[int]:
+        """
+        :return: a set which contains the pk of every MeetingInstance on the dates that the Student has attended. It
+        may also contain MeetingInstances on other dates.
+        """
+        return self.attended_many([student_id], dates)[student_id]
+
+    def attended_many(self, student_ids: Iterable[int], dates: Iterable[datetime.date]) -> Dict[int, Set[int]]:
+        """
+        Like attended(), for many Students at once. Anything not already loaded is fetched with a single query.
+        :return: a dictionary mapping from each Student's pk to the set of MeetingInstance pks they attended
+        """
+        now = timezone.now()
+        dates = set(dates)
+
+        with self._lock:
+            entries = {}
+            for student_id in student_ids:
+                entry = self._students.get(student_id)
+
+                if entry is None or now - entry.loaded_at > settings.ATTENDED_INDEX_MAX_AGE:
+                    entry = self._Entry(now)
+                    self._students[student_id] = entry
+
+                self._students.move_to_end(student_id)
+                entries[student_id] = entry
+
+            missing = {student_id: dates - entry.dates for student_id, entry in entries.items()
+                       if not dates <= entry.dates}
+
+            if missing:
+                records = AttendanceRecord.objects.filter(student_id__in=missing.keys(),
+                                                          meeting_instance__date__in=set().union(*missing.values()))
+
+                for student_id, instance_id in records.values_list('student_id', 'meeting_instance_id'):
+                    entries[student_id].instance_ids.add(instance_id)
+
+                for student_id, missing_dates in missing.items():
+                    entries[student_id].dates.update(missing_dates)
+
+            while len(self._students) > settings.ATTENDED_INDEX_MAX_STUDENTS:
+                self._students.popitem(last=False)
+
+            return {student_id: set(entry.instance_ids) for student_id, entry in entries.items()}
+
+    def records_added(self, records: Iterable[AttendanceRecord]):
+        with self._lock:
+            for record in records:
+                entry = self._students.get(record.student_id)
+                if entry is not None:
+                    entry.instance_ids.add(record.meeting_instance_id)
+
+    def record_deleted(self, record: AttendanceRecord):
+        with self._lock:
+            entry = self._students.get(record.student_id)
+            if entry is not None:
+                entry.instance_ids.discard(record.meeting_instance_id)
+
+
+attended_index = AttendedIndex()
+
+
+@receiver(attendance_recorded)
+def _attendance_recorded(sender, records, **kwargs):
+    attended_index.records_added(records)
+
+
+@receiver(post_delete, sender=AttendanceRecord)
+def _attendance_record_deleted(sender, instance, **kwargs):
+    attended_index.record_deleted(instance)
@@ -0,0 +1,167 @@
+import datetime
+from collections import OrderedDict
+from typing import Dict, List, Tuple, Union
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+
+from .indexes import beacon_index, beacon_key, meeting_index, attended_index
+from .models import MeetingInstance, AttendanceRecord, Student
+from .signals import attendance_recorded
+
+Sighting = Dict
+
+
+def find_meeting_instance(student: Student, room_id: int,
+                          seen_at: datetime.datetime) -> Union[MeetingInstance, None]:
+    """
+    :return: the MeetingInstance that the Student is enrolled in, taking place in the Room at the time
+    """
+    instance = meeting_index.find(student.pk, room_id, seen_at)
+
+    if instance is None:
+        # The index can lag behind timetable syncs made by other processes, so confirm the miss with the database
+        matched = _query_meeting_instances(student, [(seen_at, room_id)])
+        if matched:
+            instance = matched[0][1]
+
+    return instance
+
+
+def _query_meeting_instances(student: Student,
+                             located: List[Tuple[datetime.datetime, int]]) -> List[Tuple[int, MeetingInstance]]:
+    """
+    Finds the MeetingInstances that sightings took place in, using a single query over the window of rooms and dates
+    covered by the sightings
+    :param located: pairs of sighting times and the pk of the Room that the sighted beacon is in
+    :return: pairs of positions in located and the MeetingInstance seen in, for sightings made during a meeting
+    """
+    if not located:
+        return []
+
+    room_ids = {room_id for _, room_id in located}
+    dates = {seen_at.date() for seen_at, _ in located}
+
+    instances = MeetingInstance.objects.filter(room_id__in=room_ids,
+                                               date__in=dates,
+                                               meeting__students=student).select_related('meeting').order_by('pk')
+
+    instances_by_room_date = {}
+    for instance in instances:
+        instances_by_room_date.setdefault((instance.room_id, instance.date), []).append(instance)
+
+    matched = []
+    for position, (seen_at, room_id) in enumerate(located):
+        seen_at_time = seen_at.time()
+
+        for instance in instances_by_room_date.get((room_id, seen_at.date()), ()):
+            if instance.meeting.time_start <= seen_at_time <= instance.meeting.time_end:
+                matched.append((position, instance))
+                break
+
+    return matched
+
+
+def match_meeting_instances(student: Student,
+                            located: List[Tuple[Sighting, int]]) -> List[Tuple[Sighting, MeetingInstance]]:
+    """
+    Finds the MeetingInstance that each sighting took place in. Sightings are matched using the MeetingIndex, and any
+    that it can't place are checked against the database with a single query. When the sightings span more dates than
+    the MeetingIndex keeps, only the dates it already has are used, and the rest are left to the query.
+    :param student: the Student who made the sightings
+    :param located: pairs of sightings and the pk of the Room that the sighted beacon is in
+    :return: pairs of sightings and the MeetingInstance they were seen in, for sightings made during a meeting
+    """
+    matched = {}
+    unmatched = []
+
+    indexed_dates = {sighting['seen_at_time'].date() for sighting, _ in located}
+    if len(indexed_dates) > settings.MEETING_INDEX_MAX_DAYS:
+        # Building a date loads every MeetingInstance on it, and the dates would only push each other out of the index
+        indexed_dates = {date for date in indexed_dates if meeting_index.has_day(date)}
+
+    for position, (sighting, room_id) in enumerate(located):
+        if sighting['seen_at_time'].date() in indexed_dates:
+            instance = meeting_index.find(student.pk, room_id, sighting['seen_at_time'])
+        else:
+            instance = None
+
+        if instance is not None:
+            matched[position] = instance
+        else:
+            unmatched.append(position)
+
+    queried = _query_meeting_instances(student, [(located[position][0]['seen_at_time'], located[position][1])
+                                                 for position in unmatched])
+    for unmatched_position, instance in queried:
+        matched[unmatched[unmatched_position]] = instance
+
+    return [(located[position][0], matched[position]) for position in sorted(matched)]
+
+
+def record_sightings(student: Student, sightings: List[Sighting]) -> List[AttendanceRecord]:
+    """
+    Creates AttendanceRecords for every MeetingInstance that the Student was seen in, ignoring sightings of unknown
+    beacons and sightings made outside of the Student's meetings. Runs a fixed number of queries however many
+    sightings are included.
+    :param student: the Student who made the sightings
+    :param sightings: validated beacon sightings, in the order they were received
+    :return: the newly created AttendanceRecords, in the order of the sightings that created them
+    """
+    beacons = beacon_index.resolve_many([(beacon_key(sighting['uuid'], sighting['major'], sighting['minor']),
+                                          sighting['seen_at_time']) for sighting in sightings])
+    located = [(sighting, beacon.room_id) for sighting, beacon in zip(sightings, beacons) if beacon is not None]
+
+    matched = match_meeting_instances(student, located)
+
+    if not matched:
+        return []
+
+    already_attended = attended_index.attended(student.pk, {instance.date for _, instance in matched})
+
+    # The first sighting of each MeetingInstance decides the time that the Student attended it
+    new_records = OrderedDict()
+    for sighting, instance in matched:
+        if instance.pk in already_attended or instance.pk in new_records:
+            continue
+
+        new_records[instance.pk] = AttendanceRecord(student=student, meeting_instance=instance,
+                                                    time_attended=sighting['seen_at_time'])
+
+    # The MeetingIndex may not have seen enrollment changes made by other processes yet
+    unenrolled = AttendanceRecord.unenrolled(new_records.values())
+    for record in unenrolled:
+        del new_records[record.meeting_instance_id]
+
+    return create_records(list(new_records.values()))
+
+
+def create_records(records: List[AttendanceRecord]) -> List[AttendanceRecord]:
+    """
+    Inserts new AttendanceRecords with a single query. The records' enrollments must already have been checked.
+    :return: the records which were inserted
+    """
+    if not records:
+        return []
+
+    try:
+        with transaction.atomic():
+            AttendanceRecord.objects.bulk_create(records)
+    except IntegrityError:
+        # Another request recorded some of these MeetingInstances first, so insert one at a time and skip those.
+        # save() sends attendance_recorded for each record itself.
+        created = []
+        for record in records:
+            try:
+                with transaction.atomic():
+                    record.save(enrollment_checked=True)
+                created.append(record)
+            except (IntegrityError, ValidationError):
+                continue
+
+        return created
+
+    attendance_recorded.send(sender=AttendanceRecord, records=records)
+
+    return records
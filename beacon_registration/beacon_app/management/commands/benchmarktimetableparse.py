@@ -0,0 +1,99 @@
+import datetime
+import json
+import timeit
+from collections import defaultdict
+
+import dateutil.parser
+from django.core.management import BaseCommand
+
+from beacon_app.meetingbuilder import json_to_courses, parse_date, parse_name, parse_time, split_room
+
+
+def _baseline_json_to_courses(json_data):
+    """
+    Parses and groups a timetable as json_to_courses() did before the fast path: a transform for each key of each
+    event, with strptime and dateutil and nothing remembered, then grouping by course and by Meeting in two passes which
+    pop keys off the parsed events
+    """
+    def identity(val):
+        return val
+
+    def make_room(val):
+        if val is None:
+            return val
+
+        return tuple(val.split(':', 1))
+
+    def make_time(val):
+        return datetime.datetime.strptime(val, '%Y-%m-%d %X').time()
+
+    def make_date(val):
+        if type(val) == int:
+            return datetime.datetime.utcfromtimestamp(val / 1000).date()
+        elif type(val) == str:
+            return dateutil.parser.parse(val).date()
+
+    def make_name(val):
+        if val is None:
+            return val
+
+        names = [name.strip() for name in val.split(',', 1)]
+        if len(names) == 2:
+            names[0], names[1] = names[1], names[0]
+
+        return ' '.join(names)
+
+    keys_and_transforms = [('room', make_room), ('roomid', identity), ('course', identity), ('start', make_time),
+                           ('end', make_time), ('date', make_date), ('lecturer', make_name)]
+
+    events = [{key: transform(event.get(key, None)) for key, transform in keys_and_transforms} for event in json_data]
+
+    events_by_course = defaultdict(list)
+    for event in events:
+        events_by_course[event.pop('course', None)].append(event)
+
+    courses = {}
+    for course_name, course_events in events_by_course.items():
+        courses[course_name] = defaultdict(list)
+        for event in course_events:
+            key = (event['date'].weekday(), event.pop('start', None), event.pop('end', None))
+            courses[course_name][key].append(event)
+
+    return courses
+
+
+def _clear_caches():
+    for parser in (parse_date, parse_name, parse_time, split_room):
+        parser.cache_clear()
+
+
+class Command(BaseCommand):
+    help = 'Times how long a timetable takes to parse and group into courses, with the parsers starting empty and ' \
+           'already warmed up by an earlier timetable, against the parsing and grouping used before the fast path.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', action='store', dest='file', type=str,
+                            default='beacon_app/testdata/events.json',
+                            help='A timetable from events.m (default beacon_app/testdata/events.json)')
+        parser.add_argument('--repeat', action='store', dest='repeat', type=int, default=200,
+                            help='How many times to parse the timetable (default 200)')
+
+    def handle(self, *args, **options):
+        with open(options['file'], 'r') as f:
+            json_data = json.load(f)
+
+        repeat = options['repeat']
+
+        def cold():
+            _clear_caches()
+            json_to_courses(json_data)
+
+        timings = [('baseline', timeit.timeit(lambda: _baseline_json_to_courses(json_data), number=repeat)),
+                   ('cold', timeit.timeit(cold, number=repeat)),
+                   ('warm', timeit.timeit(lambda: json_to_courses(json_data), number=repeat))]
+
+        for name, seconds in timings:
+            self.stdout.write('{:8} {:8.3f} ms per timetable of {} events'.format(name, seconds * 1000 / repeat,
+                                                                                  len(json_data)))
+
+        self.stdout.write(self.style.SUCCESS('Parsed {} times'.format(repeat)))
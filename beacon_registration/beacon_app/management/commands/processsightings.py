@@ -0,0 +1,44 @@
+import time
+from datetime import timedelta
+
+from django.core.management import BaseCommand
+
+from beacon_app.sightingqueue import drain, release_abandoned_batches
+
+
+class Command(BaseCommand):
+    help = 'Turns queued beacon sightings into attendance records'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', action='store', dest='workers', default=4,
+                            type=int, help='The number of worker threads (default 4)')
+
+        parser.add_argument('--batch-size', action='store', dest='batch_size', default=500,
+                            type=int, help='The number of queued uploads to claim at once (default 500)')
+
+        parser.add_argument('--poll-interval', action='store', dest='poll_interval', default=1.0,
+                            type=float, help='Seconds to wait when the queue is empty (default 1)')
+
+        parser.add_argument('--claim-timeout', action='store', dest='claim_timeout', default=300,
+                            type=int, help='Seconds before uploads claimed by a crashed worker are retried '
+                                           '(default 300)')
+
+        parser.add_argument('--once', action='store_true', dest='once', default=False,
+                            help='Empty the queue and then exit, instead of waiting for more uploads')
+
+    def handle(self, *args, **options):
+        claim_timeout = timedelta(seconds=options['claim_timeout'])
+
+        while True:
+            release_abandoned_batches(claim_timeout)
+
+            processed = drain(batch_size=options['batch_size'], workers=options['workers'])
+
+            if processed:
+                self.stdout.write('Processed {} uploads'.format(processed))
+            elif options['once']:
+                break
+            else:
+                time.sleep(options['poll_interval'])
+
+        self.stdout.write(self.style.SUCCESS('Sighting queue is empty'))
@@ -0,0 +1,12 @@
+from django.core.management import BaseCommand
+
+from beacon_app.counters import refresh_stale_counters
+
+
+class Command(BaseCommand):
+    help = 'Brings forward attendance counters which have expired or been invalidated. Run after midnight, and ' \
+           'regularly through the day, so that attendance percentages are ready before they are read.'
+
+    def handle(self, *args, **options):
+        refreshed = refresh_stale_counters()
+        self.stdout.write(self.style.SUCCESS('Refreshed {} attendance counters'.format(refreshed)))
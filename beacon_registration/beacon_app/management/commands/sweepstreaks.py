@@ -0,0 +1,12 @@
+from django.core.management import BaseCommand
+
+from beacon_app.streaks import sweep_streaks
+
+
+class Command(BaseCommand):
+    help = 'Brings stored attendance streaks forward for meetings which have ended. Run every few minutes, so that ' \
+           'streaks are ready before they are read.'
+
+    def handle(self, *args, **options):
+        swept = sweep_streaks()
+        self.stdout.write(self.style.SUCCESS('Updated the streaks of {} students'.format(swept)))
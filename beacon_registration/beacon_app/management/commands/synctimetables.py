@@ -0,0 +1,50 @@
+import time
+from datetime import timedelta
+
+from django.core.management import BaseCommand
+
+from beacon_app.syncqueue import SyncWorkers, expire_queued_syncs, release_abandoned_syncs
+
+
+class Command(BaseCommand):
+    help = 'Syncs the timetables of students who have logged in from the timetable service, stalest first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', action='store', dest='workers', default=4,
+                            type=int, help='The number of worker threads (default 4)')
+
+        parser.add_argument('--batch-size', action='store', dest='batch_size', default=100,
+                            type=int, help='The number of queued syncs to claim at once (default 100)')
+
+        parser.add_argument('--rate', action='store', dest='rate', default=None,
+                            type=float, help='The most timetables to fetch each second '
+                                             '(default settings.TIMETABLE_SYNC_RATE)')
+
+        parser.add_argument('--poll-interval', action='store', dest='poll_interval', default=1.0,
+                            type=float, help='Seconds to wait when the queue is empty (default 1)')
+
+        parser.add_argument('--claim-timeout', action='store', dest='claim_timeout', default=300,
+                            type=int, help='Seconds before syncs claimed by a crashed worker are retried '
+                                           '(default 300)')
+
+        parser.add_argument('--once', action='store_true', dest='once', default=False,
+                            help='Empty the queue and then exit, instead of waiting for more syncs')
+
+    def handle(self, *args, **options):
+        claim_timeout = timedelta(seconds=options['claim_timeout'])
+
+        with SyncWorkers(workers=options['workers'], rate=options['rate']) as workers:
+            while True:
+                release_abandoned_syncs(claim_timeout)
+                expire_queued_syncs()
+
+                synced = workers.drain(batch_size=options['batch_size'])
+
+                if synced:
+                    self.stdout.write('Synced {} timetables'.format(synced))
+                elif options['once']:
+                    break
+                else:
+                    time.sleep(options['poll_interval'])
+
+        self.stdout.write(self.style.SUCCESS('Timetable sync queue is empty'))
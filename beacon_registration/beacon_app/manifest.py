@@ -0,0 +1,80 @@
+from typing import Dict, Iterable, Union
+
+from django.db.models import Max
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Beacon, BeaconChange, Building, Room, ShuffledID
+
+# Whether the Beacons without a BeaconChange have been given one by this process
+_history_seeded = False
+
+
+def beacons_changed(beacon_ids: Iterable[int]):
+    """
+    Records that the Beacons have changed, so that clients fetch them again
+    """
+    BeaconChange.objects.bulk_create([BeaconChange(beacon_id=beacon_id) for beacon_id in set(beacon_ids)])
+
+
+def _seed_history():
+    """
+    Records a BeaconChange for each Beacon which has none, such as those added before BeaconChanges were recorded, so
+    that clients holding any cursor are sent them. Only checked once in each process.
+    """
+    global _history_seeded
+
+    if not _history_seeded:
+        beacons_changed(Beacon.objects.exclude(pk__in=BeaconChange.objects.values('beacon_id'))
+                        .values_list('pk', flat=True))
+        _history_seeded = True
+
+
+def beacon_manifest(since: Union[int, None]) -> Dict:
+    """
+    Lists the Beacons which have changed since a cursor, along with every ShuffledID which is still valid.
+    :param since: a cursor from an earlier manifest, or None to list every Beacon
+    :return: a dictionary of the new cursor, whether the manifest lists every Beacon, the added or changed Beacons,
+    the pks of the removed Beacons, and the valid ShuffledIDs
+    """
+    _seed_history()
+
+    # Taken before reading the Beacons, so that changes made while reading are sent again next time
+    cursor = BeaconChange.objects.aggregate(cursor=Max('pk'))['cursor'] or 0
+
+    beacons = Beacon.objects.select_related('room__building').order_by('pk')
+    removed = []
+
+    full = since is None or since > cursor
+    if not full:
+        changed_ids = set(BeaconChange.objects.filter(pk__gt=since).values_list('beacon_id', flat=True))
+        beacons = list(beacons.filter(pk__in=changed_ids))
+        removed = sorted(changed_ids - {beacon.pk for beacon in beacons})
+
+    now = timezone.now()
+
+    return {'cursor': cursor,
+            'full': full,
+            'beacons': beacons,
+            'removed': removed,
+            'shuffled_ids': ShuffledID.objects.filter(valid_until__gte=now).order_by('beacon', 'valid_until')}
+
+
+@receiver(post_save, sender=Beacon)
+@receiver(post_delete, sender=Beacon)
+def _beacon_changed(sender, instance, raw=False, **kwargs):
+    beacons_changed([instance.pk])
+
+
+@receiver(post_save, sender=Room)
+def _room_saved(sender, instance, created, raw=False, **kwargs):
+    # New Rooms have no Beacons yet, and timetable syncs only ever create Rooms
+    if not created:
+        beacons_changed(instance.beacons.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=Building)
+def _building_saved(sender, instance, created, raw=False, **kwargs):
+    if not created:
+        beacons_changed(Beacon.objects.filter(room__building=instance).values_list('pk', flat=True))
@@ -1,133 +1,444 @@
+import calendar
 import datetime
-import dateutil.parser
+import hashlib
+import json
 from collections import defaultdict
-from typing import Dict, List, Any, Tuple, Union
+from functools import lru_cache
+
+import dateutil.parser
+from typing import Dict, List, Any, Tuple, Union, Callable, Hashable, Iterable, Set
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Model, QuerySet
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
 
-from .models import Class, Student, Meeting, Building, Room, MeetingInstance, Lecturer
+from .models import Class, Student, Meeting, Building, Room, MeetingInstance, Lecturer, TimetableSyncState, \
+    CourseSchedule
+from .signals import send_bulk_saved
+from .timetablecache import bump_timetable_versions
+
+# How many rows are read or written by each query during a sync
+BATCH_SIZE = 500
 
 EventsJson=List[Dict[Any, Any]]
 EventComponent = Any
 Event = Dict[str, EventComponent]
-Courses = Dict[str, List[Event]]
 MeetingInstancesT = List[Event]
 MeetingT = Tuple[int, datetime.time, datetime.time]
 
 
-def parse_events(events: EventsJson) -> List[Event]:
-    def identity(val):
+# How many distinct values of each kind are remembered once parsed. A timetable repeats the same few times, dates and
+# lecturers many times over, and so do the timetables of students on the same courses.
+PARSE_CACHE_SIZE = 4096
+
+MONTHS = {month: number for number, month in enumerate(calendar.month_abbr) if month}
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_time(val: str) -> datetime.time:
+    """
+    :param val: a date and time, like '2016-09-26 12:00:00'
+    :return: the time
+    """
+    if len(val) == 19 and val[10] == ' ' and val[13] == ':' and val[16] == ':':
+        try:
+            return datetime.time(int(val[11:13]), int(val[14:16]), int(val[17:19]))
+        except ValueError:
+            pass
+
+    return datetime.datetime.strptime(val, '%Y-%m-%d %X').time()
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_date(val: Union[int, str]) -> Union[datetime.date, None]:
+    """
+    :param val: a timestamp in milliseconds, or a date like 'Mon Sep 26 12:00:00 BST 2016'. Other formats are left to
+    dateutil.
+    :return: the date
+    """
+    if type(val) == int:
+        return datetime.datetime.utcfromtimestamp(val / 1000).date()
+    elif type(val) != str:
+        return None
+
+    parts = val.split()
+    if len(parts) == 6 and parts[1] in MONTHS and parts[2].isdigit() and parts[5].isdigit():
+        try:
+            return datetime.date(int(parts[5]), MONTHS[parts[1]], int(parts[2]))
+        except ValueError:
+            pass
+
+    return dateutil.parser.parse(val).date()
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_name(val: Union[str, None]) -> Union[str, None]:
+    """
+    :param val: a name like 'Williamson, Dr John'
+    :return: the name in order, like 'Dr John Williamson'
+    """
+    if val is None:
         return val
 
-    def split_room(val: str) -> Union[Tuple[str, ...], None]:
-        if val is None:
-            return val
-
-        return tuple(val.split(':', 1))
+    names = [name.strip() for name in val.split(',', 1)]
+    return ' '.join(reversed(names))
 
-    def make_time(val: str) -> datetime.time:
-        return datetime.datetime.strptime(val, '%Y-%m-%d %X').time()
 
-    def make_date(val: Union[int, str]) -> datetime.date:
-        if type(val) == int:
-            return datetime.datetime.utcfromtimestamp(val / 1000).date()
-        elif type(val) == str:
-            return dateutil.parser.parse(val).date()
-
-    def parse_name(val: str) -> Union[str, None]:
-        if val is None:
-            return val
-
-        names = val.split(',', 1)
-
-        for i, name in enumerate(names):
-            names[i] = name.strip()
-
-        if len(names) == 2:
-            names[0], names[1] = names[1], names[0]
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def split_room(val: Union[str, None]) -> Union[Tuple[str, ...], None]:
+    if val is None:
+        return val
 
-        return ' '.join(names)
+    return tuple(val.split(':', 1))
 
-    keys_and_transforms = [('room', split_room), ('roomid', identity), ('course', identity), ('start', make_time), ('end', make_time),
-                           ('date', make_date), ('lecturer', parse_name)]
 
+def parse_events(events: EventsJson) -> List[Event]:
     parsed_events = []
+
     for event in events:
-        new_event = {keep_key[0]: keep_key[1](event.get(keep_key[0], None)) for keep_key in keys_and_transforms}
+        get = event.get
+        start, end = get('start'), get('end')
 
-        parsed_events.append(new_event)
+        parsed_events.append({'room': split_room(get('room')),
+                              'roomid': get('roomid'),
+                              'course': get('course'),
+                              'start': parse_time(start) if start is not None else None,
+                              'end': parse_time(end) if end is not None else None,
+                              'date': parse_date(get('date')),
+                              'lecturer': parse_name(get('lecturer'))})
 
     return parsed_events
 
 
-def events_to_courses(events: List[Event]) -> Courses:
-    events_by_course = defaultdict(list)
+def json_to_courses(json_data: List[Dict]) -> Dict[str, Dict[MeetingT, MeetingInstancesT]]:
+    """
+    Parses the events, and groups them by course and then by Meeting, in a single pass
+    """
+    courses = defaultdict(lambda: defaultdict(list))
 
-    for event in events:
-        course = event.pop('course', None)
-        events_by_course[course].append(event)
+    for event in parse_events(json_data):
+        courses[event['course']][(event['date'].weekday(), event['start'], event['end'])].append(event)
 
-    return events_by_course
+    return courses
 
 
-def course_to_meetings(events: List[Event]) -> Dict[MeetingT, MeetingInstancesT]:
-    events_by_weekday = defaultdict(list)
+def _fetch(queryset: QuerySet, field: str, values: Iterable) -> List[Model]:
+    """
+    Fetches the rows of the queryset whose field is one of the values, a batch at a time so that the number of query
+    parameters stays within the database's limits
+    """
+    values = list(values)
+    rows = []
+
+    for i in range(0, len(values), BATCH_SIZE):
+        rows.extend(queryset.filter(**{field + '__in': values[i:i + BATCH_SIZE]}))
+
+    return rows
+
+
+def _create(model, rows: List[Model], key: Callable[[Model], Hashable], field: str) -> Dict[Hashable, Model]:
+    """
+    Inserts the rows, and then fetches them again by the field, as bulk_create() doesn't set their pks
+    :return: a dictionary mapping from key(row) to each created row
+    """
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+    except IntegrityError:
+        # Another sync created some of the same rows first
+        for row in rows:
+            row_fields = {f.attname: getattr(row, f.attname) for f in model._meta.concrete_fields if not f.primary_key}
+            model.objects.get_or_create(**{field: row_fields.pop(field)}, defaults=row_fields)
+
+    created = _fetch(model.objects.order_by('pk'), field, {getattr(row, field) for row in rows})
+    send_bulk_saved(model, created, created=True)
+
+    by_key = {}
+    for row in created:
+        by_key.setdefault(key(row), row)
+
+    return by_key
+
+
+def _get_or_create_named(model, field: str, names: Set[str]) -> Dict[str, Model]:
+    """
+    :return: a dictionary mapping from each name to the row of the model with that name in the field, creating the rows
+    that don't exist yet
+    """
+    rows = {}
+    for row in _fetch(model.objects.order_by('pk'), field, names):
+        rows.setdefault(getattr(row, field), row)
+
+    missing = names - rows.keys()
+    if missing:
+        rows.update(_create(model, [model(**{field: name}) for name in missing], lambda row: getattr(row, field),
+                            field))
+
+    return rows
+
+
+def _schedule_hash(course_name: str, meetings: Dict[MeetingT, MeetingInstancesT]) -> str:
+    """
+    :return: a hash of the course and the weekday, times, date, room and lecturer of each of its events
+    """
+    rows = sorted(json.dumps([weekday, str(start), str(end), str(instance['date']), instance['roomid'],
+                              instance['room'], instance['lecturer']])
+                  for (weekday, start, end), instances in meetings.items() for instance in instances)
+
+    return hashlib.sha256(json.dumps([course_name] + rows).encode('UTF-8')).hexdigest()
+
+
+def _shared_meetings(schedule_hashes: Iterable[str]) -> Dict[str, Set[int]]:
+    """
+    :return: a dictionary mapping from each of the hashes with a stored CourseSchedule to the pks of its Meetings
+    """
+    meetings = defaultdict(set)
+    through = CourseSchedule.meetings.through.objects.values_list('courseschedule__schedule_hash', 'meeting')
+
+    for schedule_hash, meeting_id in _fetch(through, 'courseschedule__schedule_hash', set(schedule_hashes)):
+        meetings[schedule_hash].add(meeting_id)
+
+    return meetings
+
+
+def _store_schedules(meetings_by_hash: Dict[str, Set[int]]):
+    """
+    Stores the Meetings made for each course schedule, for the next Student with the same schedule
+    """
+    if not meetings_by_hash:
+        return
+
+    try:
+        with transaction.atomic():
+            CourseSchedule.objects.bulk_create([CourseSchedule(schedule_hash=schedule_hash)
+                                                for schedule_hash in meetings_by_hash], batch_size=BATCH_SIZE)
+            schedules = _fetch(CourseSchedule.objects.all(), 'schedule_hash', meetings_by_hash)
+
+            CourseSchedule.meetings.through.objects.bulk_create(
+                [CourseSchedule.meetings.through(courseschedule_id=schedule.pk, meeting_id=meeting_id)
+                 for schedule in schedules for meeting_id in meetings_by_hash[schedule.schedule_hash]],
+                batch_size=BATCH_SIZE)
+    except IntegrityError:
+        # Another sync stored the same schedules first
+        pass
+
+
+def get_or_create_meetings(json_data: List[Dict], student: Student, only_courses: Set[str] = None) -> List[Meeting]:
+    """
+    Brings the Student's Meetings and their MeetingInstances into line with their timetable. The existing rows for
+    everything in the timetable are fetched with a few queries, compared with the timetable, and only the differences
+    are written, in bulk.
+    :param json_data: the events in the Student's timetable
+    :param only_courses: if given, json_data only holds the events of these courses, and the Student's Meetings for
+    other courses are left as they are
+    :return: the Meetings that the Student was enrolled in, but no longer is
+    """
+    courses = json_to_courses(json_data)
+    schedule_hashes = {course_name: _schedule_hash(course_name, meetings) for course_name, meetings in courses.items()}
+
+    with transaction.atomic():
+        # Students who share a course's schedule with someone who has already synced it only need enrolling
+        shared = _shared_meetings(schedule_hashes.values())
+        new_courses = {course_name: meetings for course_name, meetings in courses.items()
+                       if schedule_hashes[course_name] not in shared}
+
+        events = [(course_name, meeting, instance) for course_name, meetings in new_courses.items()
+                  for meeting, instances in meetings.items() for instance in instances]
+
+        classes = _get_or_create_named(Class, 'class_code', set(new_courses))
+        lecturers = _get_or_create_named(Lecturer, 'name', {instance['lecturer'] for _, _, instance in events
+                                                            if instance['lecturer'] is not None})
+        buildings = _get_or_create_named(Building, 'name', {instance['room'][0] for _, _, instance in events
+                                                            if instance['room'] is not None})
+
+        # Rooms are identified by their room_id
+        room_details = {instance['roomid']: instance['room'] for _, _, instance in events
+                        if instance['room'] is not None}
+        rooms = {room.room_id: room for room in _fetch(Room.objects.all(), 'room_id', room_details)}
+        missing_rooms = room_details.keys() - rooms.keys()
+        if missing_rooms:
+            rooms.update(_create(Room, [Room(room_id=room_id, building=buildings[room_details[room_id][0]],
+                                             room_code=room_details[room_id][1]) for room_id in missing_rooms],
+                                 lambda room: room.room_id, 'room_id'))
+
+        def meeting_key(meeting: Meeting) -> Tuple[int, int, datetime.time, datetime.time]:
+            return meeting.class_rel_id, meeting.day_of_week, meeting.time_start, meeting.time_end
+
+        meeting_keys = {(classes[course_name].pk, ) + meeting for course_name, meeting, _ in events}
+        meetings = {}
+        for meeting in _fetch(Meeting.objects.order_by('pk'), 'class_rel', {key[0] for key in meeting_keys}):
+            meetings.setdefault(meeting_key(meeting), meeting)
+
+        missing_meetings = meeting_keys - meetings.keys()
+        if missing_meetings:
+            Meeting.objects.bulk_create([Meeting(class_rel_id=class_id, day_of_week=day_of_week, time_start=start,
+                                                 time_end=end)
+                                         for class_id, day_of_week, start, end in missing_meetings],
+                                        batch_size=BATCH_SIZE)
+            created = [meeting for meeting in _fetch(Meeting.objects.order_by('pk'), 'class_rel',
+                                                     {key[0] for key in missing_meetings})
+                       if meeting_key(meeting) in missing_meetings]
+            for meeting in created:
+                meetings.setdefault(meeting_key(meeting), meeting)
+            send_bulk_saved(Meeting, created, created=True)
+
+        # Enrollments are changed through the relation, so that the m2m_changed receivers see them
+        built_meeting_pks = {meetings[key].pk for key in meeting_keys}
+        active_meeting_pks = built_meeting_pks.union(*(shared[schedule_hashes[course_name]]
+                                                      for course_name in courses.keys() - new_courses.keys()))
+        enrolled = Meeting.objects.filter(students=student)
+        if only_courses is not None:
+            enrolled = enrolled.filter(class_rel__class_code__in=only_courses)
+        enrolled = list(enrolled)
+        inactive_meetings = [meeting for meeting in enrolled if meeting.pk not in active_meeting_pks]
+
+        new_meeting_pks = active_meeting_pks - {meeting.pk for meeting in enrolled}
+        if new_meeting_pks:
+            student.meeting_set.add(*new_meeting_pks)
+        if inactive_meetings:
+            student.meeting_set.remove(*inactive_meetings)
+
+        # The lecturer of each MeetingInstance, keyed like the unique constraint on MeetingInstances
+        wanted = {}
+        for course_name, meeting, instance in events:
+            room = rooms[instance['roomid']] if instance['room'] is not None else None
+            lecturer = lecturers[instance['lecturer']] if instance['lecturer'] is not None else None
+
+            key = (meetings[(classes[course_name].pk, ) + meeting].pk, instance['date'], room.pk if room else None)
+            wanted[key] = lecturer.pk if lecturer else None
+
+        existing = {(instance.meeting_id, instance.date, instance.room_id): instance for instance in
+                    _fetch(MeetingInstance.objects.all(), 'meeting', built_meeting_pks)}
+
+        new_instances = [MeetingInstance(meeting_id=meeting_id, date=date, room_id=room_id, lecturer_id=lecturer_id)
+                         for (meeting_id, date, room_id), lecturer_id in wanted.items()
+                         if (meeting_id, date, room_id) not in existing]
+        if new_instances:
+            try:
+                with transaction.atomic():
+                    MeetingInstance.objects.bulk_create(new_instances, batch_size=BATCH_SIZE)
+            except IntegrityError:
+                # Another sync of the same course created some of the same MeetingInstances first
+                for instance in new_instances:
+                    MeetingInstance.objects.get_or_create(meeting_id=instance.meeting_id, date=instance.date,
+                                                          room_id=instance.room_id,
+                                                          defaults={'lecturer_id': instance.lecturer_id})
+            send_bulk_saved(MeetingInstance, new_instances, created=True)
+
+        # Without bulk_update, changed lecturers are set with one UPDATE for each lecturer
+        changed_instances = defaultdict(list)
+        for key, lecturer_id in wanted.items():
+            instance = existing.get(key)
+            if instance is not None and instance.lecturer_id != lecturer_id:
+                instance.lecturer_id = lecturer_id
+                changed_instances[lecturer_id].append(instance)
+
+        for lecturer_id, instances in changed_instances.items():
+            for i in range(0, len(instances), BATCH_SIZE):
+                MeetingInstance.objects.filter(pk__in=[instance.pk for instance in instances[i:i + BATCH_SIZE]])\
+                    .update(lecturer=lecturer_id)
+        if changed_instances:
+            changed = [instance for instances in changed_instances.values() for instance in instances]
+            # Before the schedules below are stored, so that the ones made with the new lecturers are kept
+            _forget_schedules(instance.meeting_id for instance in changed)
+            send_bulk_saved(MeetingInstance, changed, created=False)
+
+        _store_schedules({schedule_hashes[course_name]: {meetings[(classes[course_name].pk, ) + meeting].pk
+                                                         for meeting in course_meetings}
+                          for course_name, course_meetings in new_courses.items()})
+
+        if missing_meetings or new_meeting_pks or inactive_meetings or new_instances or changed_instances:
+            # The student's cached timetable pages are no longer valid
+            bump_timetable_versions([student.pk])
 
-    for event in events:
-        weekday = event['date'].weekday()
-        start_time = event.pop('start', None)
-        end_time = event.pop('end', None)
+    return inactive_meetings
 
-        events_by_weekday[(weekday, start_time, end_time)].append(event)
 
-    return events_by_weekday
+def _hash(events: List[Dict]) -> str:
+    """
+    :return: a hash of the events which doesn't depend on their order, or on the order of their keys
+    """
+    canonical = sorted(json.dumps(event, sort_keys=True, separators=(',', ':')) for event in events)
+    return hashlib.sha256('\n'.join(canonical).encode('UTF-8')).hexdigest()
 
 
-def json_to_courses(json_data: List[Dict]) -> Dict[str, Dict[MeetingT, MeetingInstancesT]]:
-    events = parse_events(json_data)
-    courses = events_to_courses(events)
+def _sync_cache_key(student: Student) -> str:
+    return 'timetable-sync:{}'.format(student.pk)
 
-    for course_name in courses:
-        courses[course_name] = course_to_meetings(courses[course_name])
 
-    return courses
+def sync_timetable(json_data: List[Dict], student: Student) -> List[Meeting]:
+    """
+    Applies the Student's timetable with get_or_create_meetings(), skipping the parts of it which haven't changed since
+    it was last applied. An identical timetable is skipped without touching the database, unless it was last applied
+    more than settings.TIMETABLE_SYNC_MAX_AGE ago.
+    :param json_data: the events in the Student's timetable
+    :return: the Meetings that the Student was enrolled in, but no longer is
+    """
+    payload_hash = _hash(json_data)
+    if cache.get(_sync_cache_key(student)) == payload_hash:
+        return []
 
+    events_by_course = defaultdict(list)
+    for event in json_data:
+        events_by_course[event.get('course', None)].append(event)
+    course_hashes = {course: _hash(events) for course, events in events_by_course.items()}
+
+    now = timezone.now()
+    state = TimetableSyncState.objects.filter(student=student).first()
+
+    if state is not None and now - state.synced_at < settings.TIMETABLE_SYNC_MAX_AGE:
+        if state.payload_hash == payload_hash:
+            cache.set(_sync_cache_key(student), payload_hash,
+                      (state.synced_at + settings.TIMETABLE_SYNC_MAX_AGE - now).total_seconds())
+            return []
+
+        old_hashes = json.loads(state.course_hashes)
+        changed = {course for course, course_hash in course_hashes.items() if old_hashes.get(course) != course_hash}
+        # Courses which have gone from the timetable are replaced with nothing
+        changed.update(old_hashes.keys() - course_hashes.keys())
+
+        inactive_meetings = get_or_create_meetings([event for course in changed if course in events_by_course
+                                                    for event in events_by_course[course]], student, changed)
+        synced_at = state.synced_at
+    else:
+        inactive_meetings = get_or_create_meetings(json_data, student)
+        synced_at = now
+
+    TimetableSyncState.objects.update_or_create(student=student, defaults={
+        'payload_hash': payload_hash, 'course_hashes': json.dumps(course_hashes), 'synced_at': synced_at})
+    cache.set(_sync_cache_key(student), payload_hash,
+              (synced_at + settings.TIMETABLE_SYNC_MAX_AGE - now).total_seconds())
 
-def get_or_create_meetings(json_data: List[Dict], student: Student):
-    courses = json_to_courses(json_data)
-    active_meeting_pks = []
+    return inactive_meetings
 
-    for course_name, meetings in courses.items():
-        class_ = Class.objects.get_or_create(class_code=course_name)[0]
 
-        for meeting, instances in meetings.items():
-            meeting, created = Meeting.objects.get_or_create(time_start=meeting[1], time_end=meeting[2],
-                                                             day_of_week=meeting[0],
-                                                             class_rel=class_)
+def _forget_schedules(meeting_ids: Iterable[int]):
+    CourseSchedule.objects.filter(meetings__in=set(meeting_ids)).delete()
 
-            meeting.students.add(student)
-            meeting.save()
 
-            active_meeting_pks.append(meeting.pk)
+@receiver(post_save, sender=MeetingInstance)
+def _meeting_instance_saved(sender, instance, created, raw=False, **kwargs):
+    # Adding a MeetingInstance to a Meeting doesn't stop it matching the schedules it is in, as syncs never remove
+    # MeetingInstances, but changing one does
+    if not created and not raw:
+        _forget_schedules([instance.meeting_id])
 
-            for instance in instances:
-                if instance['lecturer'] is not None:
-                    lecturer = Lecturer.objects.get_or_create(name=instance['lecturer'])[0]
-                else:
-                    lecturer = None
 
-                if instance['room'] is not None:
-                    building = Building.objects.get_or_create(name=instance['room'][0])[0]
-                    room = Room.objects.get_or_create(room_id=instance['roomid'], building=building, room_code=instance['room'][1])[0]
-                else:
-                    room = None
+@receiver(post_delete, sender=MeetingInstance)
+def _meeting_instance_deleted(sender, instance, **kwargs):
+    _forget_schedules([instance.meeting_id])
 
-                meet_inst = MeetingInstance.objects.get_or_create(date=instance['date'], room=room, meeting=meeting)[0]
-                meet_inst.lecturer = lecturer
-                meet_inst.save()
 
-    student_meetings = Meeting.objects.filter(students=student)
-    inactive_meetings = student_meetings.exclude(pk__in=active_meeting_pks)
+@receiver(post_save, sender=Meeting)
+def _meeting_saved(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        _forget_schedules([instance.pk])
 
-    for meeting in inactive_meetings:
-        meeting.students.remove(student)
 
-    return inactive_meetings
+@receiver(pre_delete, sender=Meeting)
+def _meeting_deleted(sender, instance, **kwargs):
+    _forget_schedules([instance.pk])
@@ -1,12 +1,13 @@
 import calendar
 import datetime
+import uuid
 from enum import Enum
-from typing import Dict, List, Union
+from typing import Dict, Iterable, List, Tuple, Union
 
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.db import models
-from django.db.models import F
+from django.db.models import Case, Count, F, Min, When
 from django.db.models import Q
 from django.db.models import QuerySet
 from django.utils import timezone
@@ -14,6 +15,16 @@ from django.utils import timezone
 from beacon_app.utils import Streak
 
 
+def attendance_percentage(attended: int, contributing: int) -> float:
+    """
+    :return: the percentage of contributing MeetingInstances which were attended, or 100 if there were none
+    """
+    if contributing != 0:
+        return (attended / contributing) * 100.0
+    else:
+        return 100.0
+
+
 class LocationStatus(Enum):
     """
     Indicates current student location status
@@ -36,9 +47,28 @@ class LocationStatus(Enum):
 
 
 class Location:
+    """
+    An immutable pairing of the MeetingInstance a student should be in, if any, and whether they've been seen there
+    """
+    __slots__ = ('meeting_instance', 'location_status', 'status')
+
     def __init__(self, meeting_instance: 'MeetingInstance', location_status: LocationStatus):
-        self.meeting_instance = meeting_instance
-        self.location_status = location_status
+        object.__setattr__(self, 'meeting_instance', meeting_instance)
+        object.__setattr__(self, 'location_status', location_status)
+
+        # The serialized form of location_status
+        object.__setattr__(self, 'status', location_status.value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Locations can't be changed")
+
+    def __reduce__(self):
+        # Copying and unpickling would otherwise restore the slots with __setattr__
+        return Location, (self.meeting_instance, self.location_status)
+
+
+# Shared by every student without a class on
+NO_CLASS = Location(None, LocationStatus.NO_CLASS)
 
 
 class Student(models.Model):
@@ -67,56 +97,27 @@ class Student(models.Model):
                                         received_friendships__initiating_student=self)).exclude(pk=self.pk).distinct()
 
     @property
-    def location(self) -> Dict:
-        location_dict = {'meeting_instance': None, 'location_status': None}
-
-        current_datetime = datetime.datetime.now()
-        classes_on_now = MeetingInstance.objects.filter(
-            meeting__in=self.meeting_set.filter(
-                time_start__lte=current_datetime.time(),
-                time_end__gte=current_datetime.time()),
-            date=current_datetime.date()
-        )
+    def current_location(self) -> Location:
+        """
+        :return: the MeetingInstance the student should currently be in, if any, and whether they've been seen there
+        """
+        from .presence import presence_map
 
-        if not classes_on_now.exists():
-            location_dict['location_status'] = LocationStatus.NO_CLASS.value
-            return location_dict
-        else:
-            student_attendances = AttendanceRecord.objects.filter(student=self)
+        return presence_map.location(self.pk)
 
-            for meeting_instance in classes_on_now:
-                if student_attendances.filter(meeting_instance=meeting_instance).exists():
-                    location_dict['meeting_instance'] = meeting_instance
-                    location_dict['location_status'] = LocationStatus.IN_CLASS.value
-                    return location_dict
+    @property
+    def location(self) -> Dict:
+        current_location = self.current_location
 
-            location_dict['meeting_instance'] = classes_on_now[0]
-            location_dict['location_status'] = LocationStatus.NOT_SEEN_IN_CLASS.value
-            return location_dict
+        return {'meeting_instance': current_location.meeting_instance,
+                'location_status': current_location.status}
 
     @property
     def location_status(self) -> LocationStatus:
         """
         :return: a location status for the student at the current time
         """
-        current_datetime = datetime.datetime.now()
-        classes_on_now = MeetingInstance.objects.filter(
-            meeting__in=self.meeting_set.filter(
-                time_start__lte=current_datetime.time(),
-                time_end__gte=current_datetime.time()),
-            date=current_datetime.date()
-        )
-
-        if not classes_on_now.exists():
-            return LocationStatus.NO_CLASS
-        else:
-            student_attendances = AttendanceRecord.objects.filter(student=self)
-
-            for meeting_instance in classes_on_now:
-                if student_attendances.filter(meeting_instance=meeting_instance).exists():
-                    return LocationStatus.IN_CLASS
-
-            return LocationStatus.NOT_SEEN_IN_CLASS
+        return self.current_location.location_status
 
     @property
     def friendships(self) -> QuerySet:
@@ -145,11 +146,52 @@ class Student(models.Model):
         """
         :return: a dictionary mapping from Class objects to float attendance percentages
         """
-        attendances = {}
-        for class_ in self.classes:
-            attendances[class_] = class_.attendance(self)
+        from .counters import attendance_counters, counters_stamp
+
+        classes = list(self.classes)
+        counters = attendance_counters(self, [class_.pk for class_ in classes])
+
+        # Kept for the response's ETag, which is made from the same counters
+        self._counters_version = counters_stamp(counters.values())
+
+        return {class_: counters[class_.pk].percentage for class_ in classes}
+
+    def contributing_instances(self) -> QuerySet:
+        """
+        :return: the MeetingInstances which count towards the Student's attendance. These are the ones since the
+        Student registered, in a room which had a beacon, which have either already happened or are later today.
+        """
+        today = datetime.date.today()
+        time_now = datetime.datetime.now().time()
+
+        instances = MeetingInstance.objects.filter(meeting__students=self)
+
+        return instances.filter(Q(date__gte=self.date_registered) &
+                                ((Q(date__lt=today) | Q(date=today, meeting__time_start__gte=time_now)) &
+                                 Q(room__beacons__isnull=False) &
+                                 Q(room__beacons__date_added__lte=F('date')))
+                                )
+
+    def attendance_counts(self, class_: 'Class' = None) -> Dict[int, Tuple[int, int]]:
+        """
+        Counts the MeetingInstances which count towards the Student's attendance, and how many of those they attended,
+        for every Class at once using a single grouped query
+        :param class_: only count the MeetingInstances of this Class
+        :return: a dictionary mapping from Class pks to pairs of attended and contributing MeetingInstance counts.
+        Classes without any contributing MeetingInstances are left out.
+        """
+        contributing = self.contributing_instances()
+        if class_ is not None:
+            contributing = contributing.filter(meeting__class_rel=class_)
+
+        attended_ids = AttendanceRecord.objects.filter(student=self).values('meeting_instance')
 
-        return attendances
+        # A Room with several beacons joins each MeetingInstance once per beacon, so instances are counted distinctly
+        counts = contributing.values('meeting__class_rel').annotate(
+            contributing=Count('pk', distinct=True),
+            attended=Count(Case(When(pk__in=attended_ids, then='pk')), distinct=True)).order_by()
+
+        return {row['meeting__class_rel']: (row['attended'], row['contributing']) for row in counts}
 
     def class_streaks(self, class_: 'Class') -> List[Streak]:
         """
@@ -163,12 +205,11 @@ class Student(models.Model):
         """
         :return: a dictionary mapping from Class objects to lists of attendance Streaks
         """
-        streaks = {}
+        from .streaks import student_streaks
 
-        for class_ in self.classes:
-            streaks[class_] = class_.attendance_streaks(self)
+        _, by_class = student_streaks(self)
 
-        return streaks
+        return {class_: by_class.get(class_.pk, []) for class_ in self.classes}
 
     @property
     def overall_streaks(self) -> List[Streak]:
@@ -265,6 +306,15 @@ class Room(models.Model):
         """
         return self.beacons.filter(date_added__lte=date).exists()
 
+    @staticmethod
+    def first_beacon_dates(room_ids: Iterable[int]) -> Dict[int, datetime.date]:
+        """
+        Finds when each Room got its first beacon, using a single query
+        :return: a dictionary mapping from Room pks to the date their first beacon was added, for Rooms with beacons
+        """
+        first_added = Beacon.objects.filter(room__in=room_ids).values('room').annotate(first=Min('date_added'))
+        return {row['room']: row['first'] for row in first_added.order_by()}
+
 
 class Class(models.Model):
     """
@@ -279,25 +329,9 @@ class Class(models.Model):
         verbose_name_plural = 'Classes'
 
     def attendance(self, student: Student) -> float:
-        today = datetime.date.today()
-        time_now = datetime.datetime.now().time()
-        meetings = student.meeting_set.filter(class_rel=self)
-        instances = MeetingInstance.objects.filter(meeting__in=meetings)
-        contributing = instances.filter(Q(date__gte=student.date_registered) &
-                                        ((Q(date__lt=today) | Q(date=today, meeting__time_start__gte=time_now)) &
-                                         Q(room__beacons__isnull=False) &
-                                         Q(room__beacons__date_added__lte=F('date')))
-                                        )
-
-        count = 0
-        for instance in contributing:
-            if instance.attended_by(student):
-                count += 1
-
-        if contributing.count() != 0:
-            return (count / contributing.count()) * 100.0
-        else:
-            return 100.0
+        from .counters import attendance_counters
+
+        return attendance_counters(student, [self.pk])[self.pk].percentage
 
     def attendance_streaks(self, student: Student) -> List[Streak]:
         return attendance_streaks(student, class_=self)
@@ -363,11 +397,23 @@ class MeetingInstance(models.Model):
         return '{} in room {} on {}'.format(self.meeting, self.room, self.date)
 
     def clean(self):
-        if self.date.weekday() != self.meeting.day_of_week:
+        if self.date.weekday() != self.meeting_day_of_week():
             raise ValidationError("This instance's date falls on a {}, but its related Meeting is on a {}".format(
                 calendar.day_name[self.date.weekday()],
                 self.meeting.weekday()))
 
+    def meeting_day_of_week(self) -> int:
+        """
+        :return: the day_of_week of the related Meeting, without loading the whole Meeting if it isn't already loaded
+        """
+        if MeetingInstance.meeting.is_cached(self):
+            return self.meeting.day_of_week
+
+        try:
+            return Meeting.objects.values_list('day_of_week', flat=True).get(pk=self.meeting_id)
+        except Meeting.DoesNotExist:
+            raise ValidationError({'meeting': "Meeting {} does not exist".format(self.meeting_id)})
+
     def attended_by(self, student: Student):
         return AttendanceRecord.objects.filter(meeting_instance=self, student=student).exists()
 
@@ -379,7 +425,10 @@ class MeetingInstance(models.Model):
         return self.room.had_beacon(self.date)
 
     def save(self, *args, **kwargs):
-        self.full_clean()
+        # Looking up the Meeting's day_of_week in clean() also confirms that the Meeting exists
+        self.clean_fields(exclude=['meeting'])
+        self.clean()
+        self.validate_unique()
         return super(MeetingInstance, self).save(*args, **kwargs)
 
 
@@ -403,16 +452,50 @@ class AttendanceRecord(models.Model):
                                              self.time_attended)
 
     def clean(self):
-        if self.student not in self.meeting_instance.meeting.students.all():
+        if not self.student_enrolled():
             raise ValidationError("Can't create attendance record, student {} is not enrolled in meeting {}".format(
                 self.student,
                 self.meeting_instance.meeting))
 
+    def student_enrolled(self) -> bool:
+        """
+        :return: if the Student is enrolled in the Meeting that the MeetingInstance belongs to
+        """
+        return MeetingInstance.objects.filter(pk=self.meeting_instance_id,
+                                              meeting__students=self.student_id).exists()
+
+    @staticmethod
+    def unenrolled(records: Iterable['AttendanceRecord']) -> List['AttendanceRecord']:
+        """
+        Checks the enrollment of many records with a single query
+        :return: the records whose Student is not enrolled in the Meeting that their MeetingInstance belongs to
+        """
+        records = list(records)
+        if not records:
+            return []
+
+        enrolled = set(MeetingInstance.objects.filter(
+            pk__in={record.meeting_instance_id for record in records},
+            meeting__students__in={record.student_id for record in records}
+        ).values_list('pk', 'meeting__students'))
+
+        return [record for record in records if (record.meeting_instance_id, record.student_id) not in enrolled]
+
     def attended_by(self, student: Student) -> bool:
         return AttendanceRecord.objects.filter(meeting_instance=self, student=student).exists()
 
-    def save(self, *args, **kwargs):
-        self.full_clean()
+    def save(self, *args, enrollment_checked=False, **kwargs):
+        """
+        Validates and saves the record. Uniqueness is left to the database constraint, which raises IntegrityError.
+        :param enrollment_checked: True if the caller has already checked that the Student is enrolled, so that the
+        check can be skipped
+        """
+        # The enrollment check also confirms that the Student and MeetingInstance exist
+        self.clean_fields(exclude=['student', 'meeting_instance'])
+
+        if not enrollment_checked:
+            self.clean()
+
         return super(AttendanceRecord, self).save(*args, **kwargs)
 
 
@@ -432,51 +515,30 @@ class ShuffledID(models.Model):
         verbose_name = 'Shuffled ID'
 
 
-def attendance_streaks(student: Student, class_: Union[None, Class] = None) -> List[Streak]:
-    today = datetime.date.today()
-    time_now = datetime.datetime.now().time()
-
-    if class_ is not None:
-        meetings = student.meeting_set.filter(class_rel=class_)
-    else:
-        meetings = student.meeting_set.all()
-
-    instances = MeetingInstance.objects.filter(meeting__in=meetings)
-    contributing = instances.filter(Q(date__gte=student.date_registered) &
-                                    (Q(date__lt=today) | Q(date=today, meeting__time_end__lte=time_now)))
-
-    sorted_ = contributing.order_by('date')
-
-    streaks = []
-
-    streak_start = None
-    for instance in sorted_:
-        attended = instance.attended_by(student)
+class BeaconChange(models.Model):
+    """
+    Records that a Beacon was added, moved or removed, or that the details of its Room or Building changed. The pk of
+    the latest BeaconChange is given to clients as a cursor, so that they can ask for only the Beacons which have
+    changed since.
+    """
+    # Not a ForeignKey, as the Beacon may have been deleted
+    beacon_id = models.IntegerField()
+    time = models.DateTimeField(default=timezone.now)
 
-        if attended and streak_start is None:
-            # Start of a streak
-            streak_start = instance
-        elif not attended and streak_start is not None:
-            # End of a streak
-            streaks.append(Streak(streak_start.date, instance.date))
-            streak_start = None
 
-    if streak_start is not None:
-        # A streak started, but has not yet ended
-        valid_instances = instances.order_by('-date')
-        if len(valid_instances) > 0:
-            last_date_of_year = valid_instances[0].date
-        else:
-            last_date_of_year = today
+def attendance_streaks(student: Student, class_: Union[None, Class] = None) -> List[Streak]:
+    """
+    :param class_: the Class to get Streaks for, or None for the Student's overall Streaks
+    :return: the Student's attendance Streaks
+    """
+    from .streaks import student_streaks
 
-        if last_date_of_year > today:
-            # There is another meeting after today, so the streak can go to today
-            streaks.append(Streak(streak_start.date, today))
-        else:
-            # There are no more meetings after today, so just set the streak as reaching to the last meeting
-            streaks.append(Streak(streak_start.date, last_date_of_year))
+    overall, by_class = student_streaks(student)
 
-    return streaks
+    if class_ is not None:
+        return by_class.get(class_.pk, [])
+    else:
+        return overall
 
 
 class LogEntry(models.Model):
@@ -518,3 +580,207 @@ class LogEntry(models.Model):
 
     class Meta:
         verbose_name_plural = 'Log Entries'
+
+
+class SightingBatch(models.Model):
+    """
+    A batch of beacon sightings uploaded by a Student, queued to be turned into AttendanceRecords in the background
+    """
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (PENDING, PENDING),
+        (PROCESSING, PROCESSING),
+        (DONE, DONE),
+        (FAILED, FAILED)
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    student = models.ForeignKey(Student, related_name='sighting_batches')
+
+    # JSON list of the validated sightings
+    sightings = models.TextField(editable=False)
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    # Set when a worker takes the batch from the queue, so that batches held by crashed workers can be released
+    claimed_by = models.CharField(max_length=32, blank=True, editable=False)
+    claimed_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    processed_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    # JSON list of the AttendanceRecords created from the batch, in the same format as the synchronous response
+    result = models.TextField(blank=True, editable=False)
+    error = models.TextField(blank=True, editable=False)
+
+    class Meta:
+        verbose_name_plural = 'Sighting batches'
+
+    def __str__(self):
+        return "Sighting batch {} from {}, status: {}".format(self.id, self.student, self.status)
+
+
+class AttendanceCounter(models.Model):
+    """
+    The number of a Class's MeetingInstances which count towards a Student's attendance, and how many of them the
+    Student attended. Kept up to date by beacon_app.counters, so that attendance percentages can be read without
+    counting the Student's whole history.
+    """
+    student = models.ForeignKey(Student, related_name='attendance_counters')
+    class_rel = models.ForeignKey(Class, related_name='attendance_counters', verbose_name='Class')
+
+    # Counts of the contributing MeetingInstances before counted_through
+    attended = models.PositiveIntegerField(default=0)
+    contributing = models.PositiveIntegerField(default=0)
+    counted_through = models.DateField(null=True, blank=True)
+
+    # Counts of the MeetingInstances on counted_through which had not started when the counter was refreshed
+    upcoming_attended = models.PositiveIntegerField(default=0)
+    upcoming_contributing = models.PositiveIntegerField(default=0)
+
+    # When the next MeetingInstance starts or the day ends, after which the counter must be brought forward
+    valid_until = models.DateTimeField(null=True, blank=True)
+
+    # Set when beacons or the timetable change, so that the counts must be recalculated from the start
+    dirty = models.BooleanField(default=True)
+
+    class Meta:
+        unique_together = ('student', 'class_rel')
+
+    @property
+    def percentage(self) -> float:
+        return attendance_percentage(self.attended + self.upcoming_attended,
+                                     self.contributing + self.upcoming_contributing)
+
+    def __str__(self):
+        return "{} attended {} of {} of {}".format(self.student, self.attended + self.upcoming_attended,
+                                                    self.contributing + self.upcoming_contributing, self.class_rel)
+
+
+class StreakState(models.Model):
+    """
+    How far through a Student's MeetingInstances their stored Streaks have been worked out, for one Class or, when
+    class_rel is None, for their timetable overall. Kept up to date by beacon_app.streaks.
+    """
+    student = models.ForeignKey(Student, related_name='streak_states')
+    class_rel = models.ForeignKey(Class, null=True, blank=True, related_name='streak_states', verbose_name='Class')
+
+    # Every MeetingInstance which ended at or before processed_through has been counted
+    processed_through = models.DateTimeField()
+
+    # When the next MeetingInstance ends, after which the state must be brought forward
+    valid_until = models.DateTimeField()
+
+    # The start of the Streak which is still going, if there is one
+    current_start = models.DateField(null=True, blank=True)
+
+    # The date of the last MeetingInstance counted
+    last_date = models.DateField(null=True, blank=True)
+
+    # Set when attendance or the timetable changes in the past, so that the Streaks must be worked out from the start
+    dirty = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('student', 'class_rel')
+
+    def __str__(self):
+        return "Streaks of {} for {} through {}".format(self.student, self.class_rel or "all classes",
+                                                        self.processed_through)
+
+
+class StreakRecord(models.Model):
+    """
+    A finished attendance Streak of a Student for one Class or, when class_rel is None, for their timetable overall
+    """
+    student = models.ForeignKey(Student, related_name='streak_records')
+    class_rel = models.ForeignKey(Class, null=True, blank=True, related_name='streak_records', verbose_name='Class')
+    start = models.DateField()
+    end = models.DateField()
+
+    def __str__(self):
+        return "{} for {}: {}/{}".format(self.student, self.class_rel or "all classes", self.start, self.end)
+
+
+class TimetableSyncState(models.Model):
+    """
+    Hashes of the timetable most recently applied for a Student, so that syncing the same timetable again can be
+    skipped, and syncing a partly changed one only has to apply the courses which changed
+    """
+    student = models.OneToOneField(Student, related_name='timetable_sync_state')
+    payload_hash = models.CharField(max_length=64)
+    # A JSON object mapping from course names to the hash of the course's events
+    course_hashes = models.TextField()
+    synced_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return "Timetable of {} synced at {}".format(self.student, self.synced_at)
+
+
+class CourseSchedule(models.Model):
+    """
+    The Meetings made for a course's timetable, identified by a hash of the course's events, so that the next Student
+    with exactly the same schedule for the course can be enrolled in the Meetings without processing the events again
+    """
+    schedule_hash = models.CharField(max_length=64, unique=True)
+    meetings = models.ManyToManyField(Meeting, related_name='course_schedules')
+
+    def __str__(self):
+        return self.schedule_hash
+
+
+class TimetableSyncStatus(models.Model):
+    """
+    Whether a Student's timetable is waiting to be synced in the background, is being synced, or how its last sync went
+    """
+    QUEUED = 'queued'
+    SYNCING = 'syncing'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (QUEUED, QUEUED),
+        (SYNCING, SYNCING),
+        (DONE, DONE),
+        (FAILED, FAILED)
+    )
+
+    student = models.OneToOneField(Student, related_name='timetable_sync_status')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    queued_at = models.DateTimeField(default=timezone.now)
+
+    # The cookies of the session opened with the timetable service when the Student logged in, encrypted with
+    # PasswordCrypto, and kept until the sync has been run or has waited too long
+    session_cookies = models.TextField(blank=True, editable=False)
+
+    # Set when a worker takes the sync from the queue, so that syncs held by crashed workers can be released
+    claimed_by = models.CharField(max_length=32, blank=True, editable=False)
+    claimed_at = models.DateTimeField(null=True, blank=True, editable=False)
+    # Set when the Student logs in again while their timetable is being synced, to queue it again once the sync ends
+    rerun = models.BooleanField(default=False, editable=False)
+
+    # When the timetable was last fetched successfully. Queued syncs are run stalest first.
+    synced_at = models.DateTimeField(null=True, blank=True, editable=False)
+    finished_at = models.DateTimeField(null=True, blank=True, editable=False)
+    error = models.TextField(blank=True, editable=False)
+
+    class Meta:
+        verbose_name_plural = 'Timetable sync statuses'
+
+    def __str__(self):
+        return "Timetable sync for {}, status: {}".format(self.student, self.status)
+
+
+class Version(models.Model):
+    """
+    A counter which is bumped whenever what it covers changes, such as a model's rows or a Student's timetable. ETags
+    and cached timetable pages are made from Versions, so that every process sees the same ones.
+    """
+    key = models.CharField(max_length=100, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return "{}: {}".format(self.key, self.value)
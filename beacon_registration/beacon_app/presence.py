@@ -0,0 +1,199 @@
+import datetime
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Tuple
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from .indexes import meeting_index, attended_index
+from .models import NO_CLASS, Location, LocationStatus, Meeting, MeetingInstance, AttendanceRecord
+from .signals import attendance_recorded, bulk_saved
+
+
+class PresenceMap:
+    """
+    An in-memory map from Students to their current Location.
+
+    Each Student's Location is worked out from the MeetingIndex and AttendedIndex, and then kept until the next time
+    that one of their meetings starts or ends, or for settings.PRESENCE_MAX_AGE if that is sooner. Attendance and
+    enrollment changes made in this process drop the affected Students' Locations straight away. Changes made by other
+    processes, such as sightings ingested by processsightings, are only seen once PRESENCE_MAX_AGE has passed.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._locations = {}  # type: Dict[int, Tuple[datetime.datetime, Location]]
+        self._waiters = 0
+
+    def clear(self):
+        with self._lock:
+            self._locations = {}
+            self._changed.notify_all()
+
+    def forget(self, student_ids: Iterable[int]):
+        with self._lock:
+            for student_id in student_ids:
+                self._locations.pop(student_id, None)
+            self._changed.notify_all()
+
+    @contextmanager
+    def waiting(self):
+        """
+        Reserves one of the settings.LOCATION_CHANGES_MAX_WAITERS places to wait for changes in, as each waiter holds a
+        worker for as long as it waits
+        :return: a context manager giving whether a place was free
+        """
+        with self._lock:
+            reserved = self._waiters < settings.LOCATION_CHANGES_MAX_WAITERS
+            if reserved:
+                self._waiters += 1
+
+        try:
+            yield reserved
+        finally:
+            if reserved:
+                with self._lock:
+                    self._waiters -= 1
+
+    def wait_for_change(self, student_ids: List[int], timeout: float):
+        """
+        Blocks until one of the Students' Locations may have changed, or until the timeout in seconds has passed.
+        Locations may change when they are forgotten, or when they reach the end of the time they were valid for.
+        """
+        deadline = time.monotonic() + timeout
+
+        with self._lock:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+
+                entries = [self._locations.get(student_id) for student_id in student_ids]
+                if None in entries:
+                    return
+
+                now = datetime.datetime.now()
+                valid_for = min((entry[0] - now).total_seconds() for entry in entries) if entries else remaining
+                if valid_for <= 0:
+                    return
+
+                notified = self._changed.wait(min(remaining, valid_for))
+                if not notified and valid_for < remaining:
+                    # One of the Locations has expired
+                    return
+
+    @staticmethod
+    def _next_change(student_id: int, now: datetime.datetime) -> datetime.datetime:
+        """
+        :return: the next time that one of the Student's meetings today starts or ends
+        """
+        changes = [datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())]
+
+        for instance in meeting_index.day(now.date()).student_instances(student_id):
+            start = datetime.datetime.combine(now.date(), instance.meeting.time_start)
+            end = datetime.datetime.combine(now.date(), instance.meeting.time_end)
+
+            if start > now:
+                changes.append(start)
+            elif end >= now:
+                # Instances are still on at exactly their time_end
+                changes.append(end + datetime.timedelta(microseconds=1))
+
+        return min(changes)
+
+    @staticmethod
+    def _compute(student_ids: List[int], now: datetime.datetime) -> Dict[int, Location]:
+        classes_on_now = {student_id: meeting_index.on_at(student_id, now) for student_id in student_ids}
+
+        # Attendance only needs checking for the Students who have a class on, and is fetched for all of them at once
+        attended = attended_index.attended_many([student_id for student_id, instances in classes_on_now.items()
+                                                 if instances], [now.date()])
+
+        locations = {}
+        for student_id, instances in classes_on_now.items():
+            if not instances:
+                locations[student_id] = NO_CLASS
+                continue
+
+            attended_instances = [instance for instance in instances if instance.pk in attended[student_id]]
+
+            if attended_instances:
+                locations[student_id] = Location(attended_instances[0], LocationStatus.IN_CLASS)
+            else:
+                locations[student_id] = Location(instances[0], LocationStatus.NOT_SEEN_IN_CLASS)
+
+        return locations
+
+    def location(self, student_id: int, now: datetime.datetime = None) -> Location:
+        """
+        :return: where the Student should be at the time, defaulting to now
+        """
+        return self.locations([student_id], now)[student_id]
+
+    def locations(self, student_ids: Iterable[int], now: datetime.datetime = None) -> Dict[int, Location]:
+        """
+        Like location(), for many Students at once
+        :return: a dictionary mapping from each Student's pk to their Location
+        """
+        if now is None:
+            now = datetime.datetime.now()
+
+        with self._lock:
+            locations = {}
+            stale = []
+
+            for student_id in student_ids:
+                entry = self._locations.get(student_id)
+
+                if entry is None or now >= entry[0]:
+                    stale.append(student_id)
+                else:
+                    locations[student_id] = entry[1]
+
+            for student_id, location in self._compute(stale, now).items():
+                # Attendance recorded by other processes is picked up after PRESENCE_MAX_AGE
+                valid_until = min(self._next_change(student_id, now), now + settings.PRESENCE_MAX_AGE)
+                self._locations[student_id] = (valid_until, location)
+                locations[student_id] = location
+
+            return locations
+
+
+presence_map = PresenceMap()
+
+
+@receiver(attendance_recorded)
+def _attendance_recorded(sender, records, **kwargs):
+    presence_map.forget(record.student_id for record in records)
+
+
+@receiver(post_delete, sender=AttendanceRecord)
+def _attendance_record_deleted(sender, instance, **kwargs):
+    presence_map.forget([instance.student_id])
+
+
+@receiver(post_save, sender=MeetingInstance)
+@receiver(post_delete, sender=MeetingInstance)
+@receiver(bulk_saved, sender=MeetingInstance)
+@receiver(post_save, sender=Meeting)
+@receiver(post_delete, sender=Meeting)
+def _schedule_changed(sender, **kwargs):
+    presence_map.clear()
+
+
+@receiver(m2m_changed, sender=Meeting.students.through)
+def _meeting_students_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if reverse:
+        # instance is a Student
+        presence_map.forget([instance.pk])
+    elif pk_set:
+        presence_map.forget(pk_set)
+    else:
+        presence_map.clear()
@@ -1,11 +1,17 @@
+import json
+from collections import OrderedDict
+from typing import Set, Union
+
 import dateutil.parser
 from django.contrib.auth.models import User
 from rest_framework import serializers
+from rest_framework.relations import HyperlinkedRelatedField, ManyRelatedField
 from rest_framework.validators import UniqueValidator
 
+from .streaks import stored_streaks
 from .utils import Streak
 from .models import Room, Beacon, Building, Class, Meeting, Student, MeetingInstance, AttendanceRecord, LogEntry,\
-    Friendship
+    Friendship, SightingBatch, ShuffledID
 
 
 class BuildingSerializer(serializers.HyperlinkedModelSerializer):
@@ -41,6 +47,22 @@ class BeaconSerializer(serializers.HyperlinkedModelSerializer):
         fields = ('uuid', 'major', 'minor', 'room')
 
 
+class ManifestBeaconSerializer(serializers.ModelSerializer):
+    room_id = serializers.CharField(source='room.room_id')
+    room_code = serializers.CharField(source='room.room_code')
+    building_name = serializers.CharField(source='room.building.name')
+
+    class Meta:
+        model = Beacon
+        fields = ('id', 'uuid', 'major', 'minor', 'room_id', 'room_code', 'building_name')
+
+
+class ManifestShuffledIDSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ShuffledID
+        fields = ('uuid', 'major', 'minor', 'valid_until', 'beacon')
+
+
 class BeaconSightingDeserializer(serializers.Serializer):
     uuid = serializers.UUIDField(required=True)
     major = serializers.IntegerField(required=True)
@@ -104,12 +126,61 @@ class ReservedNameHyperlinkedModelSerializer(serializers.HyperlinkedModelSeriali
 
         fields = self.fields
 
-        for field_name in fields:
+        for field_name in list(fields):
             if field_name.endswith("_"):
                 fields[field_name[:-1]] = fields.pop(field_name)
 
 
-class MeetingInstanceSerializer(serializers.HyperlinkedModelSerializer):
+def requested_fields(request) -> Union[Set[str], None]:
+    """
+    :return: the names of the fields asked for with ?fields=, or None if every field should be included
+    """
+    fields = request.query_params.get('fields', None) if request is not None else None
+    if not fields:
+        return None
+
+    return {field.strip() for field in fields.split(',')}
+
+
+def related_as_pks(request) -> bool:
+    """
+    :return: whether ?related=pk asked for related objects to be shown as pks rather than hyperlinks
+    """
+    return request is not None and request.query_params.get('related', None) == 'pk'
+
+
+class ProjectedFieldsMixin:
+    """
+    Lets requests choose which fields are included with ?fields=, and ask for related objects as pks rather than
+    hyperlinks with ?related=pk. Showing pks saves a reverse() for every related object, and adds an id field.
+    """
+
+    def get_fields(self):
+        fields = super(ProjectedFieldsMixin, self).get_fields()
+        request = self.context.get('request', None)
+
+        if related_as_pks(request):
+            projected = OrderedDict([('id', serializers.ReadOnlyField())])
+
+            for name, field in fields.items():
+                if isinstance(field, ManyRelatedField) and isinstance(field.child_relation, HyperlinkedRelatedField):
+                    field = serializers.PrimaryKeyRelatedField(many=True, read_only=True, source=field.source)
+                elif isinstance(field, HyperlinkedRelatedField):
+                    field = serializers.PrimaryKeyRelatedField(read_only=True, source=field.source)
+                projected[name] = field
+
+            fields = projected
+
+        names = requested_fields(request)
+        if names is not None:
+            # Reserved names like class_ are asked for without the trailing '_'
+            fields = OrderedDict((name, field) for name, field in fields.items()
+                                 if name in names or (name.endswith('_') and name[:-1] in names))
+
+        return fields
+
+
+class MeetingInstanceSerializer(ProjectedFieldsMixin, serializers.HyperlinkedModelSerializer):
     lecturer = serializers.CharField()
 
     class Meta:
@@ -117,7 +188,7 @@ class MeetingInstanceSerializer(serializers.HyperlinkedModelSerializer):
         fields = ('room', 'date', 'meeting', 'lecturer')
 
 
-class MeetingSerializer(ReservedNameHyperlinkedModelSerializer):
+class MeetingSerializer(ProjectedFieldsMixin, ReservedNameHyperlinkedModelSerializer):
     day_of_week = serializers.CharField(source='weekday')
     class_ = serializers.HyperlinkedRelatedField(source='class_rel', view_name='class-detail', many=False,
                                                  read_only=True)
@@ -127,7 +198,7 @@ class MeetingSerializer(ReservedNameHyperlinkedModelSerializer):
         fields = ('time_start', 'time_end', 'day_of_week', 'class_', 'instances')
 
 
-class ClassSerializer(serializers.HyperlinkedModelSerializer):
+class ClassSerializer(ProjectedFieldsMixin, serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Class
         fields = ('class_code', 'meetings')
@@ -169,6 +240,10 @@ class LocationSerializer(serializers.Serializer):
     class_name = serializers.CharField(required=False)
 
 
+class FriendLocationSerializer(LocationSerializer):
+    username = serializers.CharField(required=True)
+
+
 class FriendRequestSerializer(serializers.Serializer):
     from_user_username = serializers.CharField(source='user.username')
     from_user_nickname = serializers.CharField(source='nickname')
@@ -219,22 +294,36 @@ class TimetableSerializer(serializers.Serializer):
     date = serializers.DateField(read_only=True)
     class_name = serializers.CharField(source='meeting.class_rel.class_code', read_only=True)
     attended = serializers.BooleanField(source='_attended', read_only=True)
-    room_has_beacon = serializers.BooleanField(source='had_beacon', read_only=True)
+    room_has_beacon = serializers.BooleanField(source='_had_beacon', read_only=True)
     room_name = serializers.CharField(source='room.room_code', read_only=True)
     building_name = serializers.CharField(source='room.building', read_only=True)
     room_id = serializers.CharField(source='room.room_id', read_only=True)
     lecturer = serializers.CharField(read_only=True)
     self = serializers.HyperlinkedIdentityField(view_name='meetinginstance-detail', read_only=True)
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, instance, *args, **kwargs):
+        # The MeetingInstances are loaded once here, and should have their meeting, class, room, building and lecturer
+        # selected along with them
+        instance = list(instance)
+
         # Instantiate the superclass normally
-        super(TimetableSerializer, self).__init__(*args, **kwargs)
+        super(TimetableSerializer, self).__init__(instance, *args, **kwargs)
+
+        attended_meeting_ids = set(AttendanceRecord.objects.filter(
+            student=self.context['student'],
+            meeting_instance__in=[meeting_instance.pk for meeting_instance in instance]
+        ).values_list('meeting_instance', flat=True))
 
-        attended_meetings = AttendanceRecord.objects.filter(student=self.context['student'])
-        attended_meeting_ids = attended_meetings.values_list('meeting_instance__id', flat=True)
+        first_beacon_dates = Room.first_beacon_dates({meeting_instance.room_id for meeting_instance in instance
+                                                      if meeting_instance.room_id is not None})
 
-        for meeting_instance in self.instance:
-            meeting_instance._attended = meeting_instance.id in attended_meeting_ids
+        for meeting_instance in instance:
+            meeting_instance._attended = meeting_instance.pk in attended_meeting_ids
+
+            if meeting_instance.room_id is not None:
+                first_beacon_date = first_beacon_dates.get(meeting_instance.room_id)
+                meeting_instance._had_beacon = (first_beacon_date is not None and
+                                                first_beacon_date <= meeting_instance.date)
 
 
 class AttendanceRecordSerializer(serializers.ModelSerializer):
@@ -243,6 +332,22 @@ class AttendanceRecordSerializer(serializers.ModelSerializer):
         fields = ('meeting_instance', 'time_attended')
 
 
+class SightingBatchSerializer(serializers.ModelSerializer):
+    batch_id = serializers.UUIDField(source='id', read_only=True)
+    url = serializers.HyperlinkedIdentityField(view_name='sighting-batch-detail', read_only=True)
+    attendance_records = serializers.SerializerMethodField()
+
+    class Meta:
+        model = SightingBatch
+        fields = ('batch_id', 'url', 'status', 'created_at', 'processed_at', 'attendance_records')
+
+    def get_attendance_records(self, batch: SightingBatch):
+        if batch.status != SightingBatch.DONE:
+            return None
+
+        return json.loads(batch.result)
+
+
 class StreakField(serializers.Field):
     def __init__(self, many=False, *args, **kwargs):
         self.many = many
@@ -254,12 +359,9 @@ class StreakField(serializers.Field):
             many = self.many
 
         if many:
-            reprs = []
-            for v in value:
-                reprs.append(self.to_representation(v, False))
-            return reprs
+            return [streak.iso for streak in value]
 
-        return str(value)
+        return value.iso
 
     def to_internal_value(self, data) -> Streak:
         if self.many:
@@ -280,13 +382,16 @@ class ClassStreaksSerializer(serializers.Serializer):
 
     def to_representation(self, instance):
         # A bit of a hack since otherwise we don't have the required instance access
-        instance._streaks = instance.attendance_streaks(self.context['student'])
+        if 'class_streaks' in self.context:
+            instance._streaks = self.context['class_streaks'].get(instance.pk, [])
+        else:
+            instance._streaks = instance.attendance_streaks(self.context['student'])
         serialized = super(ClassStreaksSerializer, self).to_representation(instance)
         return serialized
 
 
 class StreaksSerializer(serializers.ModelSerializer):
-    overall = StreakField(read_only=True, many=True, source='overall_streaks')
+    overall = StreakField(read_only=True, many=True, source='_overall_streaks')
 
     def __init__(self, *args, **kwargs):
         super(StreaksSerializer, self).__init__(*args, **kwargs)
@@ -294,6 +399,11 @@ class StreaksSerializer(serializers.ModelSerializer):
         # Need to do this here so that we have access to the context
         self.fields['class_streaks'] = ClassStreaksSerializer(many=True, context=self.context, source='classes')
 
+    def to_representation(self, instance):
+        # The overall and per-class Streaks are all read from the stored StreakRecords at once
+        instance._overall_streaks, self.context['class_streaks'] = stored_streaks(instance)
+        return super(StreaksSerializer, self).to_representation(instance)
+
     class Meta:
         model = Student
         fields = ('overall', 'class_streaks')
@@ -0,0 +1,106 @@
+import datetime
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import dateutil.parser
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .ingest import record_sightings
+from .models import SightingBatch, Student
+from .serializers import AttendanceRecordSerializer
+
+
+def enqueue_sightings(student: Student, sightings: List[Dict]) -> SightingBatch:
+    """
+    Stores validated sightings so that they can be processed by a worker later
+    :return: the queued SightingBatch
+    """
+    serialized = [{'uuid': str(s['uuid']), 'major': s['major'], 'minor': s['minor'],
+                   'seen_at_time': s['seen_at_time'].isoformat()} for s in sightings]
+
+    return SightingBatch.objects.create(student=student, sightings=json.dumps(serialized))
+
+
+def release_abandoned_batches(timeout: datetime.timedelta) -> int:
+    """
+    Puts batches which have been held by a worker for longer than the timeout back into the queue
+    :return: the number of batches released
+    """
+    return SightingBatch.objects.filter(status=SightingBatch.PROCESSING,
+                                        claimed_at__lt=timezone.now() - timeout).update(status=SightingBatch.PENDING,
+                                                                                         claimed_by='',
+                                                                                         claimed_at=None)
+
+
+def claim_batches(limit: int) -> List[SightingBatch]:
+    """
+    Takes up to limit of the oldest pending batches from the queue. A batch can only be claimed by one caller, even
+    when several workers claim at the same time.
+    """
+    claim = uuid.uuid4().hex
+
+    with transaction.atomic():
+        pending = list(SightingBatch.objects.filter(status=SightingBatch.PENDING)
+                       .order_by('created_at').values_list('pk', flat=True)[:limit])
+
+        SightingBatch.objects.filter(pk__in=pending, status=SightingBatch.PENDING).update(
+            status=SightingBatch.PROCESSING,
+            claimed_by=claim,
+            claimed_at=timezone.now())
+
+    return list(SightingBatch.objects.filter(claimed_by=claim).select_related('student').order_by('created_at'))
+
+
+def process_batch(batch: SightingBatch):
+    """
+    Creates the AttendanceRecords for a claimed batch, and stores the result against it
+    """
+    try:
+        sightings = json.loads(batch.sightings)
+        for sighting in sightings:
+            sighting['seen_at_time'] = dateutil.parser.parse(sighting['seen_at_time'])
+
+        records = record_sightings(batch.student, sightings)
+
+        batch.result = json.dumps(AttendanceRecordSerializer(records, many=True).data)
+        batch.status = SightingBatch.DONE
+    except Exception as e:
+        batch.error = repr(e)
+        batch.status = SightingBatch.FAILED
+
+    batch.processed_at = timezone.now()
+    batch.save(update_fields=['result', 'error', 'status', 'processed_at'])
+
+
+def _process_batches_in_thread(batches: List[SightingBatch]):
+    try:
+        for batch in batches:
+            process_batch(batch)
+    finally:
+        # Each worker thread has its own database connection
+        connection.close()
+
+
+def drain(batch_size: int = 500, workers: int = 1) -> int:
+    """
+    Claims up to batch_size batches and processes them, spread across a number of worker threads.
+    Batches from the same Student are always processed by the same worker, one after the other.
+    :return: the number of batches processed
+    """
+    batches = claim_batches(batch_size)
+
+    if workers <= 1:
+        for batch in batches:
+            process_batch(batch)
+    else:
+        by_student = {}
+        for batch in batches:
+            by_student.setdefault(batch.student_id, []).append(batch)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_process_batches_in_thread, by_student.values()))
+
+    return len(batches)
@@ -0,0 +1,29 @@
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import Signal, receiver
+
+from .models import AttendanceRecord
+
+# Sent whenever new AttendanceRecords are written, including by bulk inserts which don't send post_save.
+# records is a list of the new AttendanceRecords.
+attendance_recorded = Signal(providing_args=['records'])
+
+# Sent by the sender model after its rows are written with bulk_create() or update(), which don't send post_save, and
+# the transaction they were written in has committed. Use send_bulk_saved() to send it.
+# instances is a list of the written rows, and created is True if they are new. Rows created by bulk_create() may not
+# have their pks set.
+bulk_saved = Signal(providing_args=['instances', 'created'])
+
+
+def send_bulk_saved(sender, instances, created: bool):
+    """
+    Sends bulk_saved once the current transaction commits. Its receivers drop cached rows and bump versions, and doing
+    that before the commit would let other requests cache the old rows again under the new versions.
+    """
+    transaction.on_commit(lambda: bulk_saved.send(sender=sender, instances=instances, created=created))
+
+
+@receiver(post_save, sender=AttendanceRecord)
+def _attendance_record_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        attendance_recorded.send(sender=AttendanceRecord, records=[instance])
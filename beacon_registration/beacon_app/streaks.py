@@ -0,0 +1,422 @@
+import datetime
+from typing import Dict, Iterable, List, Tuple, Union
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import AttendanceRecord, Meeting, MeetingInstance, Student, StreakRecord, StreakState
+from .signals import attendance_recorded, bulk_saved
+from .utils import Streak
+
+# How far ahead to look for the next MeetingInstance to end. A week covers every weekly Meeting.
+LOOKAHEAD = datetime.timedelta(days=7)
+
+
+class _Sequence:
+    """
+    A chronological sequence of MeetingInstances, stored as a bit array with a set bit for each one that was attended
+    """
+    __slots__ = ('dates', 'attended', 'last_date')
+
+    def __init__(self):
+        self.dates = []  # type: List[datetime.date]
+        self.attended = 0
+        self.last_date = None  # type: datetime.date
+
+    def append(self, date: datetime.date, attended: bool):
+        if attended:
+            self.attended |= 1 << len(self.dates)
+        self.dates.append(date)
+
+    def runs(self) -> List[Tuple[int, int]]:
+        """
+        :return: the positions of the first and last MeetingInstance of every run of attended MeetingInstances
+        """
+        bits = self.attended
+
+        # The starts and ends of all of the runs are found at once
+        starts = bits & ~(bits << 1)
+        ends = bits & ~(bits >> 1)
+
+        runs = []
+        while starts:
+            runs.append(((starts & -starts).bit_length() - 1, (ends & -ends).bit_length() - 1))
+
+            starts &= starts - 1
+            ends &= ends - 1
+
+        return runs
+
+    def streaks(self, today: datetime.date) -> List[Streak]:
+        """
+        :return: a Streak for every run of attended MeetingInstances. A Streak ends on the date of the first
+        MeetingInstance that was missed, or today if none have been missed yet and there are more to come.
+        """
+        streaks = []
+        for start, end in self.runs():
+            if end + 1 < len(self.dates):
+                streaks.append(Streak(self.dates[start], self.dates[end + 1]))
+            else:
+                streaks.append(Streak(self.dates[start], _current_end(self.last_date, today)))
+
+        return streaks
+
+
+def _current_end(last_date: Union[datetime.date, None], today: datetime.date) -> datetime.date:
+    if last_date is not None and last_date > today:
+        # There is another meeting after today, so the streak can go to today
+        return today
+    else:
+        # There are no more meetings after today, so just set the streak as reaching to the last meeting
+        return last_date or today
+
+
+def _ended_by(date: datetime.date, time_end: datetime.time, now: datetime.datetime) -> bool:
+    return date < now.date() or (date == now.date() and time_end <= now.time())
+
+
+def _sequences(student: Student, now: datetime.datetime) -> Tuple[_Sequence, Dict[int, _Sequence],
+                                                                   datetime.datetime]:
+    """
+    Builds the bit arrays of all of a Student's finished MeetingInstances, using two queries
+    :return: the overall sequence, a dictionary mapping from Class pks to their sequences, and when the next
+    MeetingInstance ends
+    """
+    instances = MeetingInstance.objects.filter(meeting__students=student).order_by(
+        'date', 'meeting__time_end', 'meeting__time_start', 'pk').values_list(
+        'pk', 'date', 'meeting__class_rel', 'meeting__time_end')
+
+    attended_ids = set(AttendanceRecord.objects.filter(student=student).values_list('meeting_instance', flat=True))
+
+    overall = _Sequence()
+    by_class = {}  # type: Dict[int, _Sequence]
+    next_end = None
+
+    for pk, date, class_id, time_end in instances:
+        sequence = by_class.get(class_id)
+        if sequence is None:
+            sequence = by_class[class_id] = _Sequence()
+
+        # Instances arrive in date order, so the last one seen is the last date of the year
+        sequence.last_date = overall.last_date = date
+
+        # Only meetings which have finished since the Student registered count towards their streaks
+        if not _ended_by(date, time_end, now):
+            if next_end is None:
+                next_end = datetime.datetime.combine(date, time_end)
+            continue
+
+        if date < student.date_registered:
+            continue
+
+        attended = pk in attended_ids
+        overall.append(date, attended)
+        sequence.append(date, attended)
+
+    return overall, by_class, next_end
+
+
+def student_streaks(student: Student) -> Tuple[List[Streak], Dict[int, List[Streak]]]:
+    """
+    Works out all of a Student's attendance Streaks from scratch in one pass, using two queries
+    :return: the Student's overall Streaks, and a dictionary mapping from Class pks to the Streaks for that Class
+    """
+    now = datetime.datetime.now()
+    overall, by_class, _ = _sequences(student, now)
+
+    return overall.streaks(now.date()), {class_id: sequence.streaks(now.date())
+                                         for class_id, sequence in by_class.items()}
+
+
+def _valid_until(next_end: Union[datetime.datetime, None], now: datetime.datetime) -> datetime.datetime:
+    if next_end is None:
+        next_end = datetime.datetime.combine(now.date() + LOOKAHEAD, datetime.time())
+
+    return timezone.make_aware(next_end)
+
+
+def rebuild_streaks(student: Student):
+    """
+    Works out and stores all of a Student's Streaks from scratch
+    """
+    # Made naive from the aware time, as the local time is ambiguous when the clocks go back
+    processed_through = timezone.now()
+    now = timezone.make_naive(processed_through)
+    overall, by_class, next_end = _sequences(student, now)
+
+    valid_until = _valid_until(next_end, now)
+
+    states = []
+    records = []
+    for class_id, sequence in [(None, overall)] + list(by_class.items()):
+        state = StreakState(student=student, class_rel_id=class_id, processed_through=processed_through,
+                            valid_until=valid_until, last_date=sequence.dates[-1] if sequence.dates else None)
+
+        for start, end in sequence.runs():
+            if end + 1 < len(sequence.dates):
+                records.append(StreakRecord(student=student, class_rel_id=class_id, start=sequence.dates[start],
+                                            end=sequence.dates[end + 1]))
+            else:
+                state.current_start = sequence.dates[start]
+
+        states.append(state)
+
+    with transaction.atomic():
+        # Rebuilds of the same Student's Streaks take turns, so that one can't insert between the other's delete and
+        # insert. The overall StreakState's NULL class_rel escapes unique_together on some databases.
+        Student.objects.select_for_update().get(pk=student.pk)
+
+        StreakState.objects.filter(student=student).delete()
+        StreakRecord.objects.filter(student=student).delete()
+
+        StreakState.objects.bulk_create(states)
+        StreakRecord.objects.bulk_create(records)
+
+
+def catch_up_streaks(student: Student) -> List[StreakState]:
+    """
+    Brings a Student's stored Streaks forward, counting only the MeetingInstances which have ended since they were
+    last processed. Catch-ups of the same Student take turns, and each reads the StreakStates again once it has its
+    turn, so that two can't replay the same MeetingInstances.
+    :return: the Student's StreakStates, including any new ones
+    """
+    with transaction.atomic():
+        Student.objects.select_for_update().get(pk=student.pk)
+        states = list(StreakState.objects.filter(student=student))
+
+        if None not in {state.class_rel_id for state in states} or any(state.dirty for state in states):
+            # Marked dirty while waiting for the lock
+            rebuild_streaks(student)
+            return list(StreakState.objects.filter(student=student))
+
+        aware_now = timezone.now()
+        if all(aware_now < state.valid_until for state in states):
+            # Caught up by someone else while waiting for the lock
+            return states
+
+        now = timezone.make_naive(aware_now)
+        processed_through = timezone.make_naive(min(state.processed_through for state in states))
+
+        instances = MeetingInstance.objects.filter(meeting__students=student,
+                                                   date__gte=processed_through.date(),
+                                                   date__lte=now.date() + LOOKAHEAD).order_by(
+            'date', 'meeting__time_end', 'meeting__time_start', 'pk').values_list(
+            'pk', 'date', 'meeting__class_rel', 'meeting__time_end')
+
+        attended_ids = set(AttendanceRecord.objects.filter(student=student,
+                                                           meeting_instance__date__gte=processed_through.date())
+                           .values_list('meeting_instance', flat=True))
+
+        by_class = {state.class_rel_id: state for state in states}
+        records = []
+        next_end = None
+
+        for pk, date, class_id, time_end in instances:
+            if not _ended_by(date, time_end, now):
+                next_end = datetime.datetime.combine(date, time_end)
+                break
+
+            if datetime.datetime.combine(date, time_end) <= processed_through or date < student.date_registered:
+                continue
+
+            if class_id not in by_class:
+                by_class[class_id] = StreakState(student=student, class_rel_id=class_id)
+
+            attended = pk in attended_ids
+
+            for state in (by_class[None], by_class[class_id]):
+                state.last_date = date
+
+                if attended and state.current_start is None:
+                    state.current_start = date
+                elif not attended and state.current_start is not None:
+                    records.append(StreakRecord(student=student, class_rel_id=state.class_rel_id,
+                                                start=state.current_start, end=date))
+                    state.current_start = None
+
+        for state in by_class.values():
+            state.processed_through = aware_now
+            state.valid_until = _valid_until(next_end, now)
+
+            if state.pk is None:
+                state.save()
+            else:
+                StreakState.objects.filter(pk=state.pk).update(processed_through=state.processed_through,
+                                                               valid_until=state.valid_until,
+                                                               current_start=state.current_start,
+                                                               last_date=state.last_date)
+
+        StreakRecord.objects.bulk_create(records)
+
+    return list(by_class.values())
+
+
+def stored_streaks(student: Student) -> Tuple[List[Streak], Dict[int, List[Streak]]]:
+    """
+    Reads a Student's Streaks from the stored StreakStates and StreakRecords, bringing them up to date first if they
+    need it. Falls back to working them out from scratch when they are missing or out of date.
+    :return: the Student's overall Streaks, and a dictionary mapping from Class pks to the Streaks for that Class
+    """
+    now = timezone.now()
+    today = datetime.date.today()
+
+    states = list(StreakState.objects.filter(student=student))
+
+    if None not in {state.class_rel_id for state in states} or any(state.dirty for state in states):
+        rebuild_streaks(student)
+        states = list(StreakState.objects.filter(student=student))
+    elif any(now >= state.valid_until for state in states):
+        states = catch_up_streaks(student)
+
+    # Kept for the response's ETag, which is made from the same StreakStates
+    student._streaks_version = streaks_stamp(states)
+
+    streaks = {state.class_rel_id: [] for state in states}
+    for record in StreakRecord.objects.filter(student=student).order_by('start'):
+        streaks.setdefault(record.class_rel_id, []).append(Streak(record.start, record.end))
+
+    current = [state for state in states if state.current_start is not None]
+    if current:
+        # Streaks which are still going reach today if there are more meetings to come, including later today
+        upcoming = set(MeetingInstance.objects.filter(meeting__students=student, date__gte=today)
+                       .values_list('meeting__class_rel', flat=True).distinct())
+
+        for state in current:
+            has_upcoming = bool(upcoming) if state.class_rel_id is None else state.class_rel_id in upcoming
+            end = today if has_upcoming else _current_end(state.last_date, today)
+            streaks[state.class_rel_id].append(Streak(state.current_start, end))
+
+    overall = streaks.pop(None, [])
+    return overall, streaks
+
+
+def streaks_stamp(states: Iterable[StreakState]) -> Union[Tuple, None]:
+    """
+    :return: a value which changes whenever the StreakStates are brought up to date, or None if they need bringing up to
+    date first
+    """
+    states = list(states)
+    now = timezone.now()
+
+    if None not in {state.class_rel_id for state in states} or \
+            any(state.dirty or now >= state.valid_until for state in states):
+        return None
+
+    # Streaks which are still going are shown as reaching today
+    return len(states), min(state.valid_until for state in states).timestamp(), \
+        max(state.processed_through for state in states).timestamp(), datetime.date.today()
+
+
+def streaks_version(student: Student) -> Union[Tuple, None]:
+    """
+    :return: a value which changes whenever the Student's StreakStates are brought up to date, or None if they need
+    bringing up to date first. Free once the Student's stored Streaks have been read.
+    """
+    stamp = getattr(student, '_streaks_version', None)
+    if stamp is not None:
+        return stamp
+
+    return streaks_stamp(StreakState.objects.filter(student=student)
+                         .only('class_rel', 'dirty', 'valid_until', 'processed_through'))
+
+
+def sweep_streaks() -> int:
+    """
+    Brings forward the stored Streaks of every Student whose MeetingInstances have ended since they were last
+    processed
+    :return: the number of Students whose Streaks were updated
+    """
+    now = timezone.now()
+
+    by_student = {}
+    for state in StreakState.objects.filter(student__in=StreakState.objects.filter(valid_until__lte=now)
+                                            .values('student')).select_related('student'):
+        by_student.setdefault(state.student_id, []).append(state)
+
+    for states in by_student.values():
+        student = states[0].student
+
+        if any(state.dirty for state in states) or None not in {state.class_rel_id for state in states}:
+            rebuild_streaks(student)
+        else:
+            catch_up_streaks(student)
+
+    return len(by_student)
+
+
+def _mark_dirty(student_ids: Iterable[int] = None, meeting_ids: Iterable[int] = None):
+    states = StreakState.objects.all()
+
+    if student_ids is not None:
+        states = states.filter(student__in=student_ids)
+    if meeting_ids is not None:
+        states = states.filter(student__meeting__in=meeting_ids)
+
+    states.update(dirty=True)
+
+
+def _attendance_changed(records: Iterable[AttendanceRecord]):
+    now = datetime.datetime.now()
+
+    for record in records:
+        instance = record.meeting_instance
+        ended_at = datetime.datetime.combine(instance.date, instance.meeting.time_end)
+
+        # Attendance for a MeetingInstance which hasn't ended yet is counted when it ends, which is the usual case.
+        # Otherwise the Streaks have to be worked out again if they have already counted it as missed.
+        if ended_at <= now:
+            StreakState.objects.filter(student=record.student_id,
+                                       processed_through__gte=timezone.make_aware(ended_at)).update(dirty=True)
+
+
+@receiver(attendance_recorded)
+def _attendance_recorded(sender, records, **kwargs):
+    _attendance_changed(records)
+
+
+@receiver(post_delete, sender=AttendanceRecord)
+def _attendance_record_deleted(sender, instance, **kwargs):
+    _mark_dirty(student_ids=[instance.student_id])
+
+
+def _meeting_instances_changed(instances: Iterable[MeetingInstance]):
+    # Future MeetingInstances are counted when they end, and timetable syncs mostly add those
+    today = datetime.date.today()
+    meeting_ids = {instance.meeting_id for instance in instances if instance.date <= today}
+
+    if meeting_ids:
+        _mark_dirty(meeting_ids=meeting_ids)
+
+
+@receiver(post_save, sender=MeetingInstance)
+def _meeting_instance_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        _meeting_instances_changed([instance])
+
+
+@receiver(bulk_saved, sender=MeetingInstance)
+def _meeting_instances_bulk_saved(sender, instances, created, **kwargs):
+    if created:
+        _meeting_instances_changed(instances)
+
+
+@receiver(post_delete, sender=MeetingInstance)
+def _meeting_instance_deleted(sender, instance, **kwargs):
+    _meeting_instances_changed([instance])
+
+
+@receiver(m2m_changed, sender=Meeting.students.through)
+def _meeting_students_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # Clearing a Meeting's Students has to be handled before they are removed
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if reverse:
+        # instance is a Student
+        _mark_dirty(student_ids=[instance.pk])
+    elif pk_set:
+        _mark_dirty(student_ids=pk_set)
+    else:
+        _mark_dirty(meeting_ids=[instance.pk])
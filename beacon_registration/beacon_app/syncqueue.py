@@ -0,0 +1,227 @@
+import calendar
+import datetime
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import requests
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Case, CharField, DateTimeField, F, TextField, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from requests import Session
+from requests.utils import add_dict_to_cookiejar, dict_from_cookiejar
+
+from .crypto import PasswordCrypto
+from .meetingbuilder import sync_timetable
+from .models import Student, TimetableSyncStatus
+
+# Timetables which have never been synced sort before every timetable which has
+NEVER_SYNCED = timezone.make_aware(datetime.datetime(1970, 1, 1), timezone.utc)
+
+
+def do_sync(session: Session, student: Student):
+    """
+    Fetches the Student's timetable from the timetable service, using a session which is logged in as them, and applies
+    it
+    """
+    next_year = datetime.datetime.utcnow() + datetime.timedelta(days=365)
+    next_year_timestamp = calendar.timegm(next_year.utctimetuple())
+
+    r = session.get(settings.TIMETABLE_API_URL, params={'start': 0, 'end': next_year_timestamp},
+                    timeout=settings.TIMETABLE_REQUEST_TIMEOUT)
+    r.raise_for_status()
+
+    new_timetable_json = r.json()
+
+    if new_timetable_json is not None:
+        sync_timetable(new_timetable_json, student)
+
+
+def enqueue_sync(student: Student, session: Session) -> TimetableSyncStatus:
+    """
+    Queues a sync of the Student's timetable, to be run later with the cookies of a session which is logged in as them.
+    Queueing a Student whose timetable is already being synced runs the sync again once it has finished, rather than
+    letting a second worker sync it at the same time.
+    :return: the Student's TimetableSyncStatus
+    """
+    # Without a worker running, cookies would otherwise be kept for as long as the Student doesn't log in again
+    expire_queued_syncs()
+
+    cookies = json.dumps(dict_from_cookiejar(session.cookies))
+    fields = {'queued_at': timezone.now(),
+              'session_cookies': PasswordCrypto(student.user).encrypt(cookies).decode('UTF-8')}
+    statuses = TimetableSyncStatus.objects.filter(student=student)
+
+    if not statuses.filter(status=TimetableSyncStatus.SYNCING).update(rerun=True, **fields) and \
+            not statuses.exclude(status=TimetableSyncStatus.SYNCING).update(status=TimetableSyncStatus.QUEUED,
+                                                                             **fields):
+        try:
+            with transaction.atomic():
+                return TimetableSyncStatus.objects.create(student=student, **fields)
+        except IntegrityError:
+            # Queued by another login at the same time, or claimed between the updates
+            return enqueue_sync(student, session)
+
+    return statuses.get()
+
+
+def expire_queued_syncs() -> int:
+    """
+    Fails the queued syncs which have waited longer than settings.TIMETABLE_SYNC_QUEUE_TIMEOUT, and drops their cookies,
+    as the sessions they were queued with will have ended
+    :return: the number of syncs expired
+    """
+    expired_before = timezone.now() - settings.TIMETABLE_SYNC_QUEUE_TIMEOUT
+
+    return TimetableSyncStatus.objects.filter(status=TimetableSyncStatus.QUEUED, queued_at__lt=expired_before).update(
+        status=TimetableSyncStatus.FAILED,
+        session_cookies='',
+        finished_at=timezone.now(),
+        error='Expired before it was synced')
+
+
+def release_abandoned_syncs(timeout: datetime.timedelta) -> int:
+    """
+    Puts syncs which have been held by a worker for longer than the timeout back into the queue
+    :return: the number of syncs released
+    """
+    return TimetableSyncStatus.objects.filter(status=TimetableSyncStatus.SYNCING,
+                                              claimed_at__lt=timezone.now() - timeout).update(
+        status=TimetableSyncStatus.QUEUED,
+        claimed_by='',
+        claimed_at=None,
+        rerun=False)
+
+
+def claim_syncs(limit: int) -> List[TimetableSyncStatus]:
+    """
+    Takes up to limit queued syncs from the queue, starting with the Students whose timetables are the most out of date,
+    and then those who have been waiting longest. A sync can only be claimed by one caller, even when several workers
+    claim at the same time.
+    """
+    claim = uuid.uuid4().hex
+
+    never_synced = Value(NEVER_SYNCED, output_field=DateTimeField())
+    stalest_first = TimetableSyncStatus.objects.annotate(staleness=Coalesce('synced_at', never_synced)) \
+        .order_by('staleness', 'queued_at')
+
+    with transaction.atomic():
+        queued = list(stalest_first.filter(status=TimetableSyncStatus.QUEUED).values_list('pk', flat=True)[:limit])
+
+        TimetableSyncStatus.objects.filter(pk__in=queued, status=TimetableSyncStatus.QUEUED).update(
+            status=TimetableSyncStatus.SYNCING,
+            claimed_by=claim,
+            claimed_at=timezone.now())
+
+    return list(stalest_first.filter(claimed_by=claim).select_related('student__user'))
+
+
+class RateLimiter:
+    """
+    Spaces out calls to wait() from any number of threads, so that they go ahead at no more than a number per second
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_at = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            go_at = max(now, self.next_at)
+            self.next_at = go_at + self.interval
+
+        time.sleep(go_at - now)
+
+
+def run_sync(sync: TimetableSyncStatus, session: Session, rate_limiter: RateLimiter):
+    """
+    Runs a claimed sync with the cookies it was queued with, and stores how it went against it
+    """
+    try:
+        cookies = PasswordCrypto(sync.student.user).decrypt(sync.session_cookies)
+        add_dict_to_cookiejar(session.cookies, json.loads(cookies))
+        rate_limiter.wait()
+        do_sync(session, sync.student)
+
+        status, outcome = TimetableSyncStatus.DONE, {'synced_at': timezone.now(), 'error': ''}
+    except Exception as e:
+        status, outcome = TimetableSyncStatus.FAILED, {'error': repr(e)}
+    finally:
+        # The session is used for other Students next
+        session.cookies.clear()
+
+    # A sync queued again while this one ran goes back into the queue with its new cookies. This is one UPDATE, so that
+    # it can't miss a login which happens as the sync finishes.
+    TimetableSyncStatus.objects.filter(pk=sync.pk, claimed_by=sync.claimed_by).update(
+        status=Case(When(rerun=True, then=Value(TimetableSyncStatus.QUEUED)), default=Value(status),
+                    output_field=CharField()),
+        session_cookies=Case(When(rerun=True, then=F('session_cookies')), default=Value(''), output_field=TextField()),
+        rerun=False, claimed_by='', claimed_at=None, finished_at=timezone.now(), **outcome)
+
+
+class SyncWorkers:
+    """
+    A fixed number of worker threads which run queued syncs. Each worker keeps its own requests Session, so that
+    connections to the timetable service are reused from one sync to the next, and the workers share a RateLimiter.
+    """
+
+    def __init__(self, workers: int = 1, rate: float = None):
+        self.workers = workers
+        self.rate_limiter = RateLimiter(settings.TIMETABLE_SYNC_RATE if rate is None else rate)
+
+        self._local = threading.local()
+        self._sessions = []
+        self._sessions_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _session(self) -> Session:
+        session = getattr(self._local, 'session', None)
+
+        if session is None:
+            session = self._local.session = requests.Session()
+            with self._sessions_lock:
+                self._sessions.append(session)
+
+        return session
+
+    def _run_sync_in_thread(self, sync: TimetableSyncStatus):
+        try:
+            run_sync(sync, self._session(), self.rate_limiter)
+        finally:
+            # Each worker thread has its own database connection
+            connection.close()
+
+    def drain(self, batch_size: int = 100) -> int:
+        """
+        Claims up to batch_size queued syncs and runs them, spread across the workers
+        :return: the number of syncs run
+        """
+        syncs = claim_syncs(batch_size)
+
+        if self._executor is None:
+            for sync in syncs:
+                run_sync(sync, self._session(), self.rate_limiter)
+        else:
+            list(self._executor.map(self._run_sync_in_thread, syncs))
+
+        return len(syncs)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+        for session in self._sessions:
+            session.close()
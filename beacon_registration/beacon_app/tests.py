@@ -1,16 +1,55 @@
+import copy
 import datetime
 import json
+import pickle
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
 
+import requests
+
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
 from freezegun import freeze_time
 from rest_framework.authtoken.models import Token
 import dateutil.parser
 from rest_framework.test import APIRequestFactory, force_authenticate, RequestsClient
-from .meetingbuilder import get_or_create_meetings
-from .models import Student, Meeting, Class, Building, Room, MeetingInstance, Beacon, Friendship, AttendanceRecord
-from .views import TimetableViewSet, AttendanceRecordViewSet
+from . import meetingbuilder
+from .indexes import beacon_index, beacon_key, meeting_index, attended_index
+from .presence import presence_map
+from .signals import attendance_recorded
+from .etags import model_version_key
+from .timetablecache import timetable_version
+from .versions import bump_version
+from .meetingbuilder import get_or_create_meetings, sync_timetable, json_to_courses, parse_date, parse_time
+from .models import Student, Meeting, Class, Building, Room, MeetingInstance, Beacon, Friendship, AttendanceRecord, \
+    ShuffledID, SightingBatch, Location, LocationStatus, AttendanceCounter, StreakState, StreakRecord, Lecturer, \
+    TimetableSyncStatus, CourseSchedule, BeaconChange
+from .views import TimetableViewSet, AttendanceRecordViewSet, FriendViewSet, AttendancePercentageViewSet, \
+    StreakViewSet, RoomViewSet, BeaconManifestViewSet, MeetingViewSet, MeetingInstanceViewSet
+from .counters import refresh_counters, refresh_stale_counters
+from .streaks import catch_up_streaks, sweep_streaks
+from .utils import Streak
 from .crypto import PasswordCrypto
+from .sightingqueue import drain
+from .syncqueue import RateLimiter, SyncWorkers, claim_syncs, enqueue_sync, expire_queued_syncs, run_sync
+
+
+
+def run_commit_hooks():
+    """
+    Runs the transaction.on_commit() callbacks queued so far, which TestCase's transactions would otherwise never run
+    """
+    hooks, connection.run_on_commit = connection.run_on_commit, []
+    for _, hook in hooks:
+        hook()
 
 
 class Timetables(TestCase):
@@ -114,6 +153,136 @@ class Timetables(TestCase):
         response = client.get('http://testserver/api/timetables/2072452z/')
         self.assertEqual(response.status_code, 404)
 
+    def test_parse_events(self):
+        with open('beacon_app/testdata/events.json', 'r') as f:
+            data = json.load(f)
+        original = copy.deepcopy(data)
+
+        courses = json_to_courses(data)
+
+        # The events are left as they were
+        self.assertEqual(data, original)
+        self.assertEqual(sum(len(instances) for meetings in courses.values() for instances in meetings.values()),
+                         len(data))
+
+        for event in data:
+            self.assertEqual(parse_date(event['date']), dateutil.parser.parse(event['date']).date())
+            self.assertEqual(parse_time(event['start']),
+                             datetime.datetime.strptime(event['start'], '%Y-%m-%d %X').time())
+
+        instance = next(instance for instance in courses['CVMA (H)'][(0, datetime.time(12), datetime.time(13))]
+                        if instance['date'] == datetime.date(2016, 9, 26))
+        self.assertEqual(instance['room'], ('ADAM SMITH', '916'))
+        self.assertEqual(instance['lecturer'], 'Dr John Williamson')
+
+        # Formats without a fast path fall back to dateutil
+        self.assertEqual(parse_date('2016-09-26T12:00:00+01:00'), datetime.date(2016, 9, 26))
+        self.assertEqual(parse_date(1474891200000), datetime.date(2016, 9, 26))
+
+    def test_sync_skips_unchanged_courses(self):
+        cache.clear()
+        with open('beacon_app/testdata/events.json', 'r') as f:
+            data = json.loads(f.read())
+
+        sync_timetable(data, self.student)
+        enrolled = set(self.student.meeting_set.values_list('pk', flat=True))
+
+        # The same events in any order are skipped without any queries
+        with self.assertNumQueries(0):
+            self.assertEqual(sync_timetable(list(reversed(data)), self.student), [])
+
+        # Only the changed courses are applied again, and removed courses are dropped
+        cvma = [event for event in data if event['course'] == 'CVMA (H)']
+        cvma[0]['lecturer'] = 'Snooze, Dr'
+        others = [event for event in data if event['course'] not in ('CVMA (H)', 'Machine Learning (H)')]
+
+        with CaptureQueriesContext(connection) as partial_sync:
+            inactive = sync_timetable(cvma + others, self.student)
+
+        self.assertTrue(inactive)
+        self.assertTrue(all(meeting.class_rel.class_code == 'Machine Learning (H)' for meeting in inactive))
+        self.assertEqual(set(self.student.meeting_set.values_list('pk', flat=True)),
+                         enrolled - {meeting.pk for meeting in inactive})
+        self.assertFalse([query for query in partial_sync.captured_queries if 'Artificial Intelligence (H)' in
+                          query['sql'] and 'timetablesyncstate' not in query['sql']])
+        self.assertTrue(MeetingInstance.objects.filter(lecturer__name='Dr Snooze').exists())
+
+        # Once the last sync is too old, the whole timetable is applied again
+        self.student.meeting_set.clear()
+        cache.clear()
+        with freeze_time(datetime.datetime.now() + datetime.timedelta(days=8)):
+            sync_timetable(cvma + others, self.student)
+        self.assertEqual(set(self.student.meeting_set.values_list('pk', flat=True)),
+                         enrolled - {meeting.pk for meeting in inactive})
+
+    def test_sync_survives_concurrent_inserts(self):
+        with open('beacon_app/testdata/events.json', 'r') as f:
+            data = json.loads(f.read())
+
+        get_or_create_meetings(copy.deepcopy(data), self.student)
+        instance_count = MeetingInstance.objects.count()
+        CourseSchedule.objects.all().delete()
+
+        # As if another sync inserted the MeetingInstances after this one looked for them
+        fetch = meetingbuilder._fetch
+        with mock.patch.object(meetingbuilder, '_fetch', lambda queryset, field, values: [] if
+                               queryset.model is MeetingInstance else fetch(queryset, field, values)):
+            get_or_create_meetings(copy.deepcopy(data), self.student2)
+
+        self.assertEqual(MeetingInstance.objects.count(), instance_count)
+        self.assertEqual(set(self.student2.meeting_set.all()), set(self.student.meeting_set.all()))
+
+    def test_sync_writes_only_changes(self):
+        with open('beacon_app/testdata/events.json', 'r') as f:
+            data = json.loads(f.read())
+
+        with CaptureQueriesContext(connection) as first_sync:
+            get_or_create_meetings(copy.deepcopy(data), self.student)
+
+        # A fixed number of queries for each kind of row, rather than several for each of the 191 events
+        self.assertLess(len(first_sync), 50)
+
+        # Other Students with the same courses are enrolled in the same Meetings, without processing the events
+        with CaptureQueriesContext(connection) as shared_sync:
+            get_or_create_meetings(copy.deepcopy(data), self.student2)
+
+        self.assertEqual(set(self.student2.meeting_set.all()), set(self.student.meeting_set.all()))
+        self.assertFalse([query for query in shared_sync.captured_queries if 'beacon_app_meetinginstance' in
+                          query['sql'] or 'beacon_app_room' in query['sql']])
+
+        # Syncing an unchanged timetable only reads
+        instance_count = MeetingInstance.objects.count()
+        before = timetable_version(self.student2.pk)
+        with CaptureQueriesContext(connection) as second_sync:
+            self.assertEqual(get_or_create_meetings(copy.deepcopy(data), self.student), [])
+
+        self.assertFalse([query for query in second_sync.captured_queries
+                          if not query['sql'].startswith('SELECT') and 'SAVEPOINT' not in query['sql']])
+        self.assertEqual(MeetingInstance.objects.count(), instance_count)
+        self.assertEqual(timetable_version(self.student2.pk), before)
+
+        # A changed lecturer is written, and everyone in the Meeting sees it
+        data[0]['lecturer'] = 'Snooze, Dr'
+        get_or_create_meetings(copy.deepcopy(data), self.student)
+        # Not until the sync has committed
+        self.assertEqual(timetable_version(self.student2.pk), before)
+        run_commit_hooks()
+        changed = MeetingInstance.objects.get(meeting__class_rel__class_code='CVMA (H)',
+                                              date=datetime.date(2016, 9, 26), meeting__time_start=datetime.time(12))
+        self.assertEqual(changed.lecturer.name, 'Dr Snooze')
+        self.assertNotEqual(timetable_version(self.student2.pk), before)
+
+        # Which means that the original schedule for the course no longer matches its Meetings
+        data[0]['lecturer'] = 'Williamson, Dr John'
+        get_or_create_meetings(copy.deepcopy(data), self.student2)
+        changed.refresh_from_db()
+        self.assertEqual(changed.lecturer.name, 'Dr John Williamson')
+
+        # Dropped courses are returned, and the Student is no longer enrolled in them
+        inactive = get_or_create_meetings([event for event in data if event['course'] != 'CVMA (H)'], self.student)
+        self.assertTrue(inactive and all(meeting.class_rel.class_code == 'CVMA (H)' for meeting in inactive))
+        self.assertFalse(self.student.meeting_set.filter(pk__in=[meeting.pk for meeting in inactive]).exists())
+
 
 class Tokens(TestCase):
     @freeze_time("Jan 14th, 2020")
@@ -156,16 +325,172 @@ class Tokens(TestCase):
         self.assertEqual(response.json()['detail'], 'Token has expired')
 
 
+class StubTimetableService(BaseHTTPRequestHandler):
+    """
+    Stands in for the timetable service. Logging in with the password 'correct' sets a session cookie, and the
+    timetable is only given to requests with the cookie.
+    """
+    with open('beacon_app/testdata/events.json', 'r') as f:
+        events = f.read().encode('UTF-8')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode('UTF-8')
+        logged_in = 'password=correct' in body
+
+        self.send_response(200 if logged_in else 401)
+        if logged_in:
+            self.send_header('Set-Cookie', 'JSESSIONID=stub-session; Path=/')
+        self.end_headers()
+
+    def do_GET(self):
+        if 'JSESSIONID=stub-session' not in (self.headers['Cookie'] or ''):
+            self.send_response(403)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.events)))
+        self.end_headers()
+        self.wfile.write(self.events)
+
+    def log_message(self, *args):
+        pass
+
+
+class TimetableSyncQueue(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.server = HTTPServer(('127.0.0.1', 0), StubTimetableService)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.settings_override = override_settings(TIMETABLE_LOGIN_URL=url + '/login.m',
+                                                   TIMETABLE_API_URL=url + '/events.m')
+        self.settings_override.enable()
+
+        self.user = User.objects.create_user(username='2072452q', password='correct')
+        self.student = Student.objects.create(user=self.user, nickname="s1")
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_login_queues_sync(self):
+        auth_token = PasswordCrypto(self.user).encrypt('correct').decode('UTF-8')
+
+        client = RequestsClient()
+        response = client.post('http://testserver/api/tokens/', json={'username': '2072452q',
+                                                                      'auth_token': auth_token})
+        self.assertEqual(response.status_code, 200)
+
+        # Logging in only queues the sync
+        status = TimetableSyncStatus.objects.get(student=self.student)
+        self.assertEqual(status.status, TimetableSyncStatus.QUEUED)
+        self.assertNotIn('stub-session', status.session_cookies)
+        self.assertEqual(json.loads(PasswordCrypto(self.user).decrypt(status.session_cookies)),
+                         {'JSESSIONID': 'stub-session'})
+        self.assertEqual(len(self.student.classes), 0)
+
+        with SyncWorkers(rate=0) as workers:
+            self.assertEqual(workers.drain(), 1)
+            self.assertEqual(workers.drain(), 0)
+
+        status.refresh_from_db()
+        self.assertEqual(status.status, TimetableSyncStatus.DONE)
+        self.assertEqual(status.session_cookies, '')
+        self.assertIsNotNone(status.synced_at)
+        self.assertEqual(len(self.student.classes), 8)
+
+        # A session which the timetable service doesn't recognise fails the sync
+        with requests.Session() as session:
+            session.cookies.set('JSESSIONID', 'expired')
+            enqueue_sync(self.student, session)
+
+        with SyncWorkers(rate=0) as workers:
+            self.assertEqual(workers.drain(), 1)
+
+        status.refresh_from_db()
+        self.assertEqual(status.status, TimetableSyncStatus.FAILED)
+        self.assertIn('403', status.error)
+
+    def test_login_syncs_inline(self):
+        auth_token = PasswordCrypto(self.user).encrypt('correct').decode('UTF-8')
+
+        with self.settings(TIMETABLE_SYNC_IN_BACKGROUND=False):
+            response = RequestsClient().post('http://testserver/api/tokens/', json={'username': '2072452q',
+                                                                                   'auth_token': auth_token})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(TimetableSyncStatus.objects.exists())
+        self.assertEqual(len(self.student.classes), 8)
+
+    def test_login_while_syncing_runs_again(self):
+        with requests.Session() as session:
+            session.cookies.set('JSESSIONID', 'stub-session')
+            enqueue_sync(self.student, session)
+
+            sync, = claim_syncs(10)
+
+            # Logging in again doesn't let a second worker sync the timetable at the same time
+            enqueue_sync(self.student, session)
+            self.assertEqual(claim_syncs(10), [])
+
+        run_sync(sync, requests.Session(), RateLimiter(0))
+
+        status = TimetableSyncStatus.objects.get(student=self.student)
+        self.assertEqual(status.status, TimetableSyncStatus.QUEUED)
+        self.assertFalse(status.rerun)
+        self.assertEqual(json.loads(PasswordCrypto(self.user).decrypt(status.session_cookies)),
+                         {'JSESSIONID': 'stub-session'})
+        self.assertEqual(len(claim_syncs(10)), 1)
+
+    def test_queued_syncs_expire(self):
+        with requests.Session() as session:
+            session.cookies.set('JSESSIONID', 'stub-session')
+            enqueue_sync(self.student, session)
+
+        with freeze_time(timezone.now() + settings.TIMETABLE_SYNC_QUEUE_TIMEOUT + datetime.timedelta(minutes=1)):
+            self.assertEqual(expire_queued_syncs(), 1)
+
+        status = TimetableSyncStatus.objects.get(student=self.student)
+        self.assertEqual(status.status, TimetableSyncStatus.FAILED)
+        self.assertEqual(status.session_cookies, '')
+        self.assertEqual(claim_syncs(10), [])
+
+    def test_stalest_synced_first(self):
+        user2 = User.objects.create_user(username='2072452n')
+        user3 = User.objects.create_user(username='2072452y')
+        student2 = Student.objects.create(user=user2, nickname="s2")
+        student3 = Student.objects.create(user=user3, nickname="s3")
+
+        now = timezone.now()
+        TimetableSyncStatus.objects.create(student=self.student, synced_at=now - datetime.timedelta(days=1))
+        TimetableSyncStatus.objects.create(student=student2, synced_at=now - datetime.timedelta(days=3))
+        TimetableSyncStatus.objects.create(student=student3)
+
+        self.assertEqual([sync.student for sync in claim_syncs(2)], [student3, student2])
+        self.assertEqual([sync.student for sync in claim_syncs(2)], [self.student])
+
+
 class AttendanceRecords(TestCase):
     @freeze_time("Dec 5th, 2016")
     def setUp(self):
+        cache.clear()
+        beacon_index.clear()
+        meeting_index.clear()
+        attended_index.clear()
+        presence_map.clear()
+
         self.user = User.objects.create_user(username='2072452q')
         self.student = Student.objects.create(user=self.user)
         self.token = Token.objects.create(user=self.user)
         self.building = Building.objects.create(name="My House")
-        self.beaconed_room = Room.objects.create(building=self.building, room_code="My Room")
-        self.unbeaconed_room = Room.objects.create(building=self.building, room_code="Not My Room")
-        self.other_beaconed_room = Room.objects.create(building=self.building, room_code="Also Not My Room")
+        self.beaconed_room = Room.objects.create(building=self.building, room_code="My Room", room_id="1")
+        self.unbeaconed_room = Room.objects.create(building=self.building, room_code="Not My Room", room_id="2")
+        self.other_beaconed_room = Room.objects.create(building=self.building, room_code="Also Not My Room",
+                                                       room_id="3")
 
         self.class_ = Class.objects.create(class_code="Advanced Sleeping")
         self.beacon = Beacon.objects.create(uuid='123e4567-e89b-12d3-a456-426655440000', major=1, minor=1,
@@ -211,6 +536,262 @@ class AttendanceRecords(TestCase):
 
         self.assertTrue(response.json()[0]['attended'])
 
+    @freeze_time("Dec 5th, 2016 09:00:00")
+    def test_create_attendance_record_after_unenrolling(self):
+        factory = APIRequestFactory()
+        view = AttendanceRecordViewSet.as_view({'post': 'create'})
+        beacon_data = {'uuid': '123e4567-e89b-12d3-a456-426655440000', 'major': 1, 'minor': 1,
+                       'seen_at_time': dateutil.parser.parse("Dec 5th, 2016 09:00:00")}
+
+        # Unenrolled by another process, which this process's MeetingIndex hasn't heard about
+        Meeting.students.through.objects.filter(student=self.student, meeting=self.meeting1).delete()
+
+        with mock.patch('beacon_app.views.find_meeting_instance', return_value=self.meeting1inst1):
+            request = factory.post('/attendance-records/', beacon_data)
+            force_authenticate(request, user=self.user)
+            response = view(request)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(AttendanceRecord.objects.exists())
+
+    @freeze_time("Dec 5th, 2016 11:00:00")
+    def test_timetable(self):
+        for week in range(2, 10):
+            MeetingInstance.objects.create(date=datetime.date(2016, 12, 5) + datetime.timedelta(weeks=week),
+                                           meeting=self.meeting1, room=self.other_beaconed_room)
+
+        AttendanceRecord.objects.create(student=self.student, meeting_instance=self.meeting1inst1,
+                                        time_attended=dateutil.parser.parse("Dec 5th, 2016 09:30:00Z"))
+
+        factory = APIRequestFactory()
+        view = TimetableViewSet.as_view({'get': 'retrieve'})
+        request = factory.get('/timetables/2072452q/')
+        force_authenticate(request, user=self.user)
+
+        # The Student, the versions the page is cached under, their MeetingInstances with everything shown about them,
+        # their attendance and the beacons
+        with self.assertNumQueries(5):
+            response = view(request, username='2072452q')
+
+        timetable = {instance['date']: instance for instance in response.data}
+        self.assertEqual(len(timetable), 10)
+
+        self.assertTrue(timetable['2016-12-05']['attended'])
+        self.assertTrue(timetable['2016-12-05']['room_has_beacon'])
+        self.assertEqual(timetable['2016-12-05']['building_name'], "My House")
+        self.assertEqual(timetable['2016-12-05']['class_name'], "Advanced Sleeping")
+
+        self.assertFalse(timetable['2016-12-12']['attended'])
+        self.assertFalse(timetable['2016-12-12']['room_has_beacon'])
+        self.assertTrue(timetable['2016-12-19']['room_has_beacon'])
+
+    @freeze_time("Dec 5th, 2016 11:00:00")
+    def test_timetable_cache(self):
+        friend = Student.objects.create(user=User.objects.create_user(username='friend'), nickname='friend')
+        Friendship.objects.create(initiating_student=self.student, receiving_student=friend, accepted=True)
+
+        factory = APIRequestFactory()
+        view = TimetableViewSet.as_view({'get': 'retrieve'})
+
+        def timetable(user):
+            request = factory.get('/timetables/2072452q/', {'week': '2016-12-05'})
+            force_authenticate(request, user=user)
+            return view(request, username='2072452q').data
+
+        self.assertFalse(timetable(self.user)[0]['attended'])
+
+        # The page is served from the cache once its versions have been read, to the Student and to their friends after
+        # checking they are friends
+        with self.assertNumQueries(2):
+            self.assertFalse(timetable(self.user)[0]['attended'])
+        with self.assertNumQueries(3):
+            self.assertFalse(timetable(friend.user)[0]['attended'])
+
+        # Recording attendance replaces the page
+        AttendanceRecord.objects.create(student=self.student, meeting_instance=self.meeting1inst1,
+                                        time_attended=dateutil.parser.parse("Dec 5th, 2016 09:30:00Z"))
+        self.assertTrue(timetable(self.user)[0]['attended'])
+
+        # As do beacon changes
+        self.beacon.delete()
+        self.beacon2.delete()
+        self.assertFalse(timetable(friend.user)[0]['room_has_beacon'])
+
+    @freeze_time("Dec 12th, 2016 12:00:00")
+    def test_beacon_manifest(self):
+        factory = APIRequestFactory()
+        view = BeaconManifestViewSet.as_view({'get': 'list'})
+
+        def manifest(since=None):
+            request = factory.get('/beacon-manifest/', {'since': since} if since is not None else {})
+            force_authenticate(request, user=self.user)
+            return view(request).data
+
+        ShuffledID.objects.create(uuid='123e4567-e89b-12d3-a456-426655440001', major=5, minor=5, beacon=self.beacon,
+                                  valid_until=dateutil.parser.parse("Dec 13th, 2016 12:00:00Z"))
+        ShuffledID.objects.create(uuid='123e4567-e89b-12d3-a456-426655440001', major=6, minor=6, beacon=self.beacon,
+                                  valid_until=dateutil.parser.parse("Dec 11th, 2016 12:00:00Z"))
+
+        full = manifest()
+        self.assertTrue(full['full'])
+        self.assertEqual([(beacon['major'], beacon['room_id']) for beacon in full['beacons']], [(1, '1'), (2, '3')])
+        self.assertEqual([shuffled_id['major'] for shuffled_id in full['shuffled_ids']], [5])
+
+        delta = manifest(full['cursor'])
+        self.assertFalse(delta['full'])
+        self.assertEqual((delta['beacons'], delta['removed']), ([], []))
+
+        # Additions, moves and removals
+        added = Beacon.objects.create(uuid='123e4567-e89b-12d3-a456-426655440000', major=3, minor=1,
+                                      room=self.unbeaconed_room)
+        self.beacon2.room = self.unbeaconed_room
+        self.beacon2.save()
+        removed_pk = self.beacon.pk
+        self.beacon.delete()
+
+        delta = manifest(full['cursor'])
+        self.assertEqual([(beacon['id'], beacon['room_id']) for beacon in delta['beacons']],
+                         [(self.beacon2.pk, '2'), (added.pk, '2')])
+        self.assertEqual(delta['removed'], [removed_pk])
+        self.assertEqual(manifest(delta['cursor'])['beacons'], [])
+
+        # Renaming a Building changes the Beacons in it
+        self.unbeaconed_room.building.name = 'Renamed'
+        self.unbeaconed_room.building.save()
+        self.assertEqual({beacon['building_name'] for beacon in manifest(delta['cursor'])['beacons']}, {'Renamed'})
+
+        self.assertTrue(manifest(delta['cursor'] + 1000)['full'])
+        self.assertEqual(view(factory.get('/beacon-manifest/', {'since': 'x'})).status_code, 401)
+
+        request = factory.get('/beacon-manifest/', {'since': -1})
+        force_authenticate(request, user=self.user)
+        self.assertEqual(view(request).status_code, 400)
+
+        # Beacons added before their changes were recorded are sent to clients holding any cursor
+        BeaconChange.objects.filter(beacon_id=added.pk).delete()
+        cursor = manifest()['cursor']
+        with mock.patch('beacon_app.manifest._history_seeded', False):
+            self.assertEqual([beacon['id'] for beacon in manifest(cursor)['beacons']], [added.pk])
+        self.assertEqual(manifest(0)['removed'], [removed_pk])
+
+    def test_timetable_calendar(self):
+        lecturer = Lecturer.objects.create(name='Dr. Snooze, PhD')
+        MeetingInstance.objects.create(date=datetime.date(2016, 12, 26), meeting=self.meeting1,
+                                       room=self.unbeaconed_room)
+        MeetingInstance.objects.create(date=datetime.date(2017, 1, 2), meeting=self.meeting1, room=self.beaconed_room,
+                                       lecturer=lecturer)
+
+        request = APIRequestFactory().get('/timetables/2072452q/ics/')
+        force_authenticate(request, user=self.user)
+
+        # One query for the Student, one for all of their meetings, and one for the versions in the ETag
+        with self.assertNumQueries(3):
+            response = TimetableViewSet.as_view({'get': 'calendar'})(request, username='2072452q')
+            content = b''.join(response.streaming_content).decode('UTF-8')
+
+        self.assertEqual(response['Content-Type'], 'text/calendar; charset=utf-8')
+        self.assertTrue(content.startswith('BEGIN:VCALENDAR\r\n') and content.endswith('END:VCALENDAR\r\n'))
+        self.assertTrue(all(len(line.encode('UTF-8')) <= 75 for line in content.split('\r\n')))
+
+        # The time zone the events' times are in is described before them
+        header = content.split('BEGIN:VEVENT')[0]
+        self.assertIn('BEGIN:VTIMEZONE\r\nTZID:Europe/London\r\n', header)
+        self.assertIn('BEGIN:DAYLIGHT\r\nDTSTART:19700329T010000\r\nRRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=-1SU\r\n'
+                      'TZOFFSETFROM:+0000\r\nTZOFFSETTO:+0100\r\n', header)
+        self.assertIn('BEGIN:STANDARD\r\nDTSTART:19701025T020000\r\nRRULE:FREQ=YEARLY;BYMONTH=10;BYDAY=-1SU\r\n'
+                      'TZOFFSETFROM:+0100\r\nTZOFFSETTO:+0000\r\n', header)
+
+        # Meetings in the same room with the same lecturer repeat weekly, skipping the weeks they aren't on
+        events = content.split('BEGIN:VEVENT')[1:]
+        self.assertEqual(len(events), 3)
+        self.assertIn('RRULE:FREQ=WEEKLY;COUNT=3\r\nEXDATE;TZID=Europe/London:20161219T090000\r\n', content)
+        self.assertIn('DESCRIPTION:Lecturer: Dr. Snooze\\, PhD', content)
+        self.assertEqual(sum('RRULE' in event for event in events), 1)
+
+    def test_list_pagination(self):
+        factory = APIRequestFactory()
+        instances = MeetingInstanceViewSet.as_view({'get': 'list'})
+
+        def get(view, params):
+            request = factory.get('/list/', params)
+            force_authenticate(request, user=self.user)
+            return view(request).data
+
+        first = get(instances, {'page_size': 1})
+        self.assertEqual(len(first['results']), 1)
+        self.assertTrue(first['results'][0]['meeting'].endswith('/meetings/{}/'.format(self.meeting1.pk)))
+
+        # Pages follow on by pk, and can show only some fields, with pks instead of links
+        request = factory.get(first['next'] + '&fields=id,meeting,date&related=pk')
+        force_authenticate(request, user=self.user)
+        second = instances(request).data
+        self.assertEqual(second['next'], None)
+        self.assertEqual(dict(second['results'][0]), {'id': self.meeting1inst2.pk, 'meeting': self.meeting1.pk,
+                                                      'date': '2016-12-12'})
+
+        # The instances for every meeting on a page are fetched with one query, and the ETag's versions with another
+        Meeting.objects.create(time_start=datetime.time(9, 00), time_end=datetime.time(10, 00), day_of_week=1,
+                               class_rel=self.class_)
+        with self.assertNumQueries(3):
+            meetings = get(MeetingViewSet.as_view({'get': 'list'}), {'related': 'pk', 'fields': 'class,instances'})
+        self.assertEqual([dict(meeting) for meeting in meetings['results']],
+                         [{'class': self.class_.pk, 'instances': [self.meeting1inst1.pk, self.meeting1inst2.pk]},
+                          {'class': self.class_.pk, 'instances': []}])
+
+    @freeze_time("Dec 12th, 2016 12:00:00")
+    def test_conditional_get(self):
+        factory = APIRequestFactory()
+
+        def get(view, url, etag=None, user=None, **kwargs):
+            request = factory.get(url, HTTP_IF_NONE_MATCH=etag) if etag else factory.get(url)
+            if user is not None:
+                force_authenticate(request, user=user)
+            return view(request, **kwargs).render()
+
+        rooms = RoomViewSet.as_view({'get': 'list'})
+        response = get(rooms, '/rooms/')
+        self.assertEqual(response.status_code, 200)
+
+        # Matching requests are answered from the versions alone, which are read with a single query
+        with self.assertNumQueries(1):
+            not_modified = get(rooms, '/rooms/', 'W/"other", ' + response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+        self.assertFalse(not_modified.content)
+
+        self.unbeaconed_room.room_id = '4'
+        self.unbeaconed_room.save()
+        response = get(rooms, '/rooms/', response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+        # Versions are kept in the database, so they are the same in every process, and don't change on their own.
+        # Changes which don't send signals show once whoever made them bumps the version.
+        Room.objects.filter(pk=self.unbeaconed_room.pk).update(room_id='5')
+        with freeze_time(timezone.now() + datetime.timedelta(hours=1)):
+            self.assertEqual(get(rooms, '/rooms/', response['ETag']).status_code, 304)
+        bump_version(model_version_key(Room))
+        self.assertEqual(get(rooms, '/rooms/', response['ETag']).status_code, 200)
+
+        for view_class in (TimetableViewSet, AttendancePercentageViewSet, StreakViewSet):
+            view = view_class.as_view({'get': 'retrieve'})
+            response = get(view, '/view/2072452q/', user=self.user, username='2072452q')
+            self.assertEqual(response.status_code, 200)
+
+            # The Student, their counters or streaks if the view shows them, and the versions
+            with self.assertNumQueries(2 if view_class is TimetableViewSet else 3):
+                self.assertEqual(get(view, '/view/2072452q/', response['ETag'], self.user, username='2072452q')
+                                 .status_code, 304)
+
+            # Late attendance changes all of them
+            record = AttendanceRecord.objects.create(student=self.student, meeting_instance=self.meeting1inst1,
+                                                     time_attended=dateutil.parser.parse("Dec 5th, 2016 09:30:00Z"))
+            attendance_recorded.send(sender=AttendanceRecord, records=[record])
+
+            changed = get(view, '/view/2072452q/', response['ETag'], self.user, username='2072452q')
+            self.assertEqual(changed.status_code, 200)
+            self.assertNotEqual(changed['ETag'], response['ETag'])
+            record.delete()
+
     @freeze_time("Dec 5th, 2016 11:00:00")
     def test_wrong_time(self):
         factory = APIRequestFactory()
@@ -257,6 +838,548 @@ class AttendanceRecords(TestCase):
         self.assertEqual(response.data['detail'], 'The student is not in a class where this beacon is')
 
 
+    @freeze_time("Dec 5th, 2016 09:00:00")
+    def test_shuffled_id(self):
+        factory = APIRequestFactory()
+        view = AttendanceRecordViewSet.as_view({'post': 'create'})
+
+        ShuffledID.objects.create(uuid='f7826da6-4fa2-4e98-8024-bc5b71e0893f', major=10, minor=10,
+                                  valid_until=dateutil.parser.parse("Dec 5th, 2016 08:00:00Z"), beacon=self.beacon)
+        ShuffledID.objects.create(uuid='f7826da6-4fa2-4e98-8024-bc5b71e0893f', major=20, minor=20,
+                                  valid_until=dateutil.parser.parse("Dec 5th, 2016 12:00:00Z"), beacon=self.beacon)
+
+        # Expired shuffled identifiers don't resolve
+        beacon_data = {'uuid': 'f7826da6-4fa2-4e98-8024-bc5b71e0893f', 'major': 10, 'minor': 10,
+                       'seen_at_time': dateutil.parser.parse("Dec 5th, 2016 09:00:00")}
+        request = factory.post('/attendance-records/', beacon_data)
+        force_authenticate(request, user=self.user)
+        response = view(request)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data['detail'], 'No such beacon exists')
+
+        beacon_data = {'uuid': 'f7826da6-4fa2-4e98-8024-bc5b71e0893f', 'major': 20, 'minor': 20,
+                       'seen_at_time': dateutil.parser.parse("Dec 5th, 2016 09:00:00")}
+        request = factory.post('/attendance-records/', beacon_data)
+        force_authenticate(request, user=self.user)
+        response = view(request)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['meeting_instance'], self.meeting1inst1.pk)
+
+    def test_shuffled_id_resolves_when_seen(self):
+        uuid = 'f7826da6-4fa2-4e98-8024-bc5b71e0893f'
+        ShuffledID.objects.create(uuid=uuid, major=10, minor=10, beacon=self.beacon,
+                                  valid_until=dateutil.parser.parse("Dec 5th, 2016 08:00:00Z"))
+        seen_before_rotating = dateutil.parser.parse("Dec 5th, 2016 07:59:00Z")
+
+        # Kept in the index for the grace window after rotating
+        with freeze_time("Dec 5th, 2016 08:10:00"):
+            beacon_index.clear()
+            with self.assertNumQueries(2):
+                self.assertEqual(beacon_index.resolve(uuid, 10, 10, seen_at=seen_before_rotating), self.beacon)
+                self.assertIsNone(beacon_index.resolve(uuid, 10, 10))
+
+        # After that, sightings from before the grace window are looked up in the database
+        with freeze_time("Dec 5th, 2016 12:00:00"):
+            beacon_index.clear()
+            self.assertIsNone(beacon_index.resolve(uuid, 10, 10))
+            self.assertEqual(beacon_index.resolve(uuid, 10, 10, seen_at=seen_before_rotating), self.beacon)
+            self.assertIsNone(beacon_index.resolve(uuid, 10, 10, seen_at=dateutil.parser.parse("Dec 5th, 2016 09:00Z")))
+
+            # Identifiers which the index doesn't know, like those of other iBeacons, are looked up together
+            sightings = [(beacon_key(uuid, minor, minor), seen_before_rotating) for minor in (10, 11, 12, 13)]
+            with self.assertNumQueries(1):
+                self.assertEqual(beacon_index.resolve_many(sightings), [self.beacon, None, None, None])
+
+    def test_beacon_index_updates(self):
+        self.assertEqual(beacon_index.resolve('123e4567-e89b-12d3-a456-426655440000', 1, 1), self.beacon)
+
+        self.beacon.minor = 5
+        self.beacon.save()
+
+        self.assertIsNone(beacon_index.resolve('123e4567-e89b-12d3-a456-426655440000', 1, 1))
+        self.assertEqual(beacon_index.resolve('123e4567-e89b-12d3-a456-426655440000', 1, 5), self.beacon)
+
+        self.beacon.delete()
+
+        self.assertIsNone(beacon_index.resolve('123e4567-e89b-12d3-a456-426655440000', 1, 5))
+
+    def test_meeting_index_updates(self):
+        nine_thirty = datetime.datetime(2016, 12, 5, 9, 30)
+
+        self.assertEqual(meeting_index.find(self.student.pk, self.beaconed_room.pk, nine_thirty), self.meeting1inst1)
+        self.assertEqual(meeting_index.on_at(self.student.pk, nine_thirty), [self.meeting1inst1])
+        self.assertIsNone(meeting_index.find(self.student.pk, self.beaconed_room.pk, nine_thirty.replace(hour=10,
+                                                                                                         minute=1)))
+
+        # Moving the instance to another room is picked up
+        self.meeting1inst1.room = self.other_beaconed_room
+        self.meeting1inst1.save()
+
+        self.assertIsNone(meeting_index.find(self.student.pk, self.beaconed_room.pk, nine_thirty))
+        self.assertEqual(meeting_index.find(self.student.pk, self.other_beaconed_room.pk, nine_thirty),
+                         self.meeting1inst1)
+
+        # As are enrollment changes
+        self.student.meeting_set.remove(self.meeting1)
+        self.assertIsNone(meeting_index.find(self.student.pk, self.other_beaconed_room.pk, nine_thirty))
+
+        self.meeting1.students.add(self.student)
+        self.assertEqual(meeting_index.find(self.student.pk, self.other_beaconed_room.pk, nine_thirty),
+                         self.meeting1inst1)
+
+    @freeze_time("Dec 5th, 2016 09:00:00")
+    def test_attendance_record_validation(self):
+        other_user = User.objects.create_user(username='2072452n')
+        other_student = Student.objects.create(user=other_user, nickname="s2")
+
+        enrolled = AttendanceRecord(student=self.student, meeting_instance=self.meeting1inst1,
+                                    time_attended=dateutil.parser.parse("Dec 5th, 2016 09:00:00Z"))
+        unenrolled = AttendanceRecord(student=other_student, meeting_instance=self.meeting1inst1,
+                                      time_attended=dateutil.parser.parse("Dec 5th, 2016 09:00:00Z"))
+
+        self.assertEqual(AttendanceRecord.unenrolled([enrolled, unenrolled]), [unenrolled])
+
+        with self.assertRaises(ValidationError):
+            unenrolled.save()
+
+        # A single EXISTS for the enrollment check, the insert, and bumping the Student's timetable version
+        with self.assertNumQueries(3):
+            enrolled.save()
+
+    @freeze_time("Dec 5th, 2016 09:00:00")
+    def test_meeting_instance_validation(self):
+        with self.assertRaises(ValidationError):
+            MeetingInstance.objects.create(date=datetime.date(2016, 12, 6), meeting=self.meeting1,
+                                           room=self.beaconed_room)
+
+        # The meeting is already loaded, so only the room, uniqueness check, the insert and bumping the model's version
+        # are needed
+        with self.assertNumQueries(4):
+            MeetingInstance.objects.create(date=datetime.date(2016, 12, 19), meeting=self.meeting1,
+                                           room=self.beaconed_room)
+
+    @freeze_time("Dec 5th, 2016 10:30:00")
+    def test_create_multiple_attendance_records(self):
+        factory = APIRequestFactory()
+        view = AttendanceRecordViewSet.as_view({'post': 'create_multiple'})
+
+        sightings = [
+            # Unknown beacon
+            {'uuid': '123e4567-e89b-12d3-a456-426655440000', 'major': 9, 'minor': 9,
+             'seen_at_time': "2016-12-05T09:05:00"},
+            # Outside of any meeting
+            {'uuid': '123e4567-e89b-12d3-a456-426655440000', 'major': 1, 'minor': 1,
+             'seen_at_time': "2016-12-05T08:30:00"},
+            # Room the student doesn't have a meeting in
+            {'uuid': '123e4567-e89b-12d3-a456-426655440000', 'major': 2, 'minor': 1,
+             'seen_at_time': "2016-12-05T09:10:00"},
+        ]
+        sightings += [{'uuid': '123e4567-e89b-12d3-a456-426655440000', 'major': 1, 'minor': 1,
+                       'seen_at_time': "2016-12-05T09:{:02d}:00".format(minute)} for minute in range(10, 60)]
+
+        request = factory.post('/attendance-records/add-multiple/', sightings, format='json')
+        force_authenticate(request, user=self.user)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = view(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]['meeting_instance'], self.meeting1inst1.pk)
+        self.assertEqual(dateutil.parser.parse(response.data[0]['time_attended']).minute, 10)
+        # Loading the indexes and recording the attendance takes a fixed number of queries, not one per sighting
+        self.assertLess(len(queries), 15)
+
+        record = AttendanceRecord.objects.get(student=self.student)
+        self.assertEqual(record.meeting_instance, self.meeting1inst1)
+
+        # Sending the same sightings again shouldn't create anything new
+        request = factory.post('/attendance-records/add-multiple/', sightings, format='json')
+        force_authenticate(request, user=self.user)
+        response = view(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 0)
+        self.assertEqual(AttendanceRecord.objects.filter(student=self.student).count(), 1)
+
+    @freeze_time("Jan 30th, 2017 12:00:00")
+    def test_create_multiple_attendance_records_over_many_dates(self):
+        dates = [datetime.date(2016, 12, 5) + datetime.timedelta(weeks=week) for week in range(1, 9)]
+        for date in dates[1:]:
+            MeetingInstance.objects.create(date=date, meeting=self.meeting1, room=self.beaconed_room)
+        # One date is already in the MeetingIndex
+        meeting_index.day(dates[-1])
+
+        view = AttendanceRecordViewSet.as_view({'post': 'create_multiple'})
+        sightings = [{'uuid': '123e4567-e89b-12d3-a456-426655440000', 'major': 1, 'minor': 1,
+                      'seen_at_time': '{}T09:15:00'.format(date)} for date in dates]
+        request = APIRequestFactory().post('/attendance-records/add-multiple/', sightings, format='json')
+        force_authenticate(request, user=self.user)
+
+        with self.settings(MEETING_INDEX_MAX_DAYS=3):
+            response = view(request)
+
+        # Dates which don't fit in the MeetingIndex are matched with the windowed query instead of being built
+        self.assertEqual(len(response.data), len(dates) - 1)
+        self.assertEqual([date for date in dates if meeting_index.has_day(date)], [dates[-1]])
+
+    @freeze_time("Dec 5th, 2016 10:30:00")
+    def test_idempotent_create_multiple(self):
+        factory = APIRequestFactory()
+        view = AttendanceRecordViewSet.as_view({'post': 'create_multiple'})
+
+        sightings = [{'uuid': '123e4567-e89b-12d3-a456-426655440000', 'major': 1, 'minor': 1,
+                      'seen_at_time': "2016-12-05T09:15:00"}]
+
+        responses = []
+        for _ in range(2):
+            request = factory.post('/attendance-records/add-multiple/', sightings, format='json',
+                                   HTTP_IDEMPOTENCY_KEY='upload-1')
+            force_authenticate(request, user=self.user)
+            responses.append(view(request))
+
+        # The retry gets the original response back
+        self.assertEqual(responses[0].data, responses[1].data)
+        self.assertEqual(len(responses[1].data), 1)
+
+        # Without a key, the already attended instance is skipped without looking up its AttendanceRecord
+        request = factory.post('/attendance-records/add-multiple/', sightings, format='json')
+        force_authenticate(request, user=self.user)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = view(request)
+
+        self.assertEqual(len(response.data), 0)
+        self.assertFalse(any('beacon_app_attendancerecord' in query['sql'] for query in queries))
+
+    def test_location(self):
+        with freeze_time("Dec 5th, 2016 08:30:00"):
+            self.assertEqual(self.student.location_status, LocationStatus.NO_CLASS)
+
+        with freeze_time("Dec 5th, 2016 09:30:00"):
+            location = self.student.current_location
+            self.assertEqual(location.location_status, LocationStatus.NOT_SEEN_IN_CLASS)
+            self.assertEqual(location.meeting_instance, self.meeting1inst1)
+
+            AttendanceRecord.objects.create(student=self.student, meeting_instance=self.meeting1inst1,
+                                            time_attended=dateutil.parser.parse("Dec 5th, 2016 09:30:00Z"))
+
+            self.assertEqual(self.student.location_status, LocationStatus.IN_CLASS)
+
+            # Reading the location again is answered from memory
+            with self.assertNumQueries(0):
+                self.assertEqual(self.student.location['location_status'], LocationStatus.IN_CLASS.value)
+
+        with freeze_time("Dec 5th, 2016 10:00:01"):
+            self.assertEqual(self.student.location_status, LocationStatus.NO_CLASS)
+
+    def test_friend_location_statuses(self):
+        friends = []
+        for i in range(5):
+            friend = Student.objects.create(user=User.objects.create_user(username='friend{}'.format(i)),
+                                            nickname='friend{}'.format(i))
+            Friendship.objects.create(initiating_student=self.student, receiving_student=friend, accepted=True)
+            friends.append(friend)
+
+        self.meeting1.students.add(friends[0], friends[1])
+        AttendanceRecord.objects.create(student=friends[0], meeting_instance=self.meeting1inst1,
+                                        time_attended=dateutil.parser.parse("Dec 5th, 2016 09:10:00Z"))
+
+        factory = APIRequestFactory()
+        view = FriendViewSet.as_view({'get': 'location_statuses'})
+
+        with freeze_time("Dec 5th, 2016 09:30:00"):
+            request = factory.get('/friends/location-statuses/?include=location')
+            force_authenticate(request, user=self.user)
+
+            # The friend list, the day's meetings and the friends' attendance, however many friends there are
+            with self.assertNumQueries(4):
+                response = view(request)
+
+            self.assertEqual(response.status_code, 200)
+            statuses = {status['username']: status for status in response.data}
+
+            self.assertEqual(statuses['friend0']['location_status'], LocationStatus.IN_CLASS.value)
+            self.assertEqual(statuses['friend0']['room'], "My Room")
+            self.assertEqual(statuses['friend0']['building'], "My House")
+            self.assertEqual(statuses['friend1']['location_status'], LocationStatus.NOT_SEEN_IN_CLASS.value)
+            self.assertEqual(statuses['friend4']['location_status'], LocationStatus.NO_CLASS.value)
+            self.assertNotIn('room', statuses['friend4'])
+
+            request = factory.get('/friends/location-statuses/')
+            force_authenticate(request, user=self.user)
+
+            # Locations are remembered, so only the friend list is fetched
+            with self.assertNumQueries(1):
+                response = view(request)
+
+            self.assertEqual(len(response.data), 5)
+            self.assertNotIn('room', {status['username']: status for status in response.data}['friend0'])
+
+    @freeze_time("Dec 5th, 2016 09:30:00")
+    def test_friend_location_changes(self):
+        friends = []
+        for i in range(2):
+            friend = Student.objects.create(user=User.objects.create_user(username='friend{}'.format(i)),
+                                            nickname='friend{}'.format(i))
+            Friendship.objects.create(initiating_student=self.student, receiving_student=friend, accepted=True)
+            self.meeting1.students.add(friend)
+            friends.append(friend)
+
+        factory = APIRequestFactory()
+        view = FriendViewSet.as_view({'get': 'location_changes'})
+
+        def poll(cursor=None):
+            request = factory.get('/friends/location-changes/', {'cursor': cursor} if cursor else {})
+            force_authenticate(request, user=self.user)
+            return view(request).data
+
+        # The first poll returns every friend
+        data = poll()
+        self.assertTrue(data['full'])
+        self.assertEqual(len(data['changes']), 2)
+
+        # Nothing has changed, so the poll waits and then returns nothing
+        with self.settings(LOCATION_CHANGES_TIMEOUT=0.1):
+            data = poll(data['cursor'])
+        self.assertFalse(data['full'])
+        self.assertEqual(data['changes'], [])
+
+        # With no places left to wait in, the poll returns straight away
+        with self.settings(LOCATION_CHANGES_TIMEOUT=60, LOCATION_CHANGES_MAX_WAITERS=0):
+            started = time.monotonic()
+            data = poll(data['cursor'])
+            self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(data['changes'], [])
+
+        # Attending a class wakes up waiting polls, and only the friend who attended is returned
+        record = AttendanceRecord(student=friends[1], meeting_instance=self.meeting1inst1,
+                                  time_attended=dateutil.parser.parse("Dec 5th, 2016 09:30:00Z"))
+        AttendanceRecord.objects.bulk_create([record])
+        waiting = threading.Timer(0.1, attendance_recorded.send, kwargs={'sender': AttendanceRecord,
+                                                                         'records': [record]})
+        # The test's transaction keeps other threads from writing to the database, so the timetable version isn't
+        # bumped from the thread
+        with mock.patch('beacon_app.timetablecache.bump_timetable_versions'):
+            waiting.start()
+            data = poll(data['cursor'])
+            waiting.join()
+
+        self.assertEqual(data['changes'], [{'location_status': LocationStatus.IN_CLASS.value, 'username': 'friend1'}])
+
+        # Unknown cursors start again with every friend
+        self.assertTrue(poll('expired')['full'])
+
+    def test_attendance_percentages(self):
+        with freeze_time("Dec 5th, 2016"):
+            # A second beacon in the same room must not count the room's MeetingInstances twice
+            Beacon.objects.create(uuid='123e4567-e89b-12d3-a456-426655440000', major=3, minor=1,
+                                  room=self.beaconed_room)
+
+            meeting2 = Meeting.objects.create(time_start=datetime.time(9, 00), time_end=datetime.time(10, 00),
+                                              day_of_week=1, class_rel=self.class_)
+            MeetingInstance.objects.create(date=datetime.date(2016, 12, 6), meeting=meeting2, room=self.beaconed_room)
+            self.student.meeting_set.add(meeting2)
+
+            other_class = Class.objects.create(class_code="Intermediate Napping")
+            other_meeting = Meeting.objects.create(time_start=datetime.time(9, 00), time_end=datetime.time(10, 00),
+                                                   day_of_week=2, class_rel=other_class)
+            self.student.meeting_set.add(other_meeting)
+
+        AttendanceRecord.objects.create(student=self.student, meeting_instance=self.meeting1inst1,
+                                        time_attended=dateutil.parser.parse("Dec 5th, 2016 09:30:00Z"))
+
+        factory = APIRequestFactory()
+        view = AttendancePercentageViewSet.as_view({'get': 'retrieve'})
+
+        def percentages():
+            request = factory.get('/attendances/2072452q/')
+            force_authenticate(request, user=self.user)
+            response = view(request, username='2072452q')
+
+            return {attendance['class_name']: attendance['percentage'] for attendance in response.data}
+
+        with freeze_time("Dec 7th, 2016 12:00:00"):
+            # The first read counts every Class with a single grouped query, and stores the counts
+            self.assertEqual(percentages(), {"Advanced Sleeping": 50.0, "Intermediate Napping": 100.0})
+            self.assertEqual(self.class_.attendance(self.student), 50.0)
+
+            # Later reads only fetch the Student, their Classes and their counters. The ETag is made from the same
+            # counters, and the versions read with one query.
+            with self.assertNumQueries(4):
+                self.assertEqual(percentages(), {"Advanced Sleeping": 50.0, "Intermediate Napping": 100.0})
+
+            # Attendance recorded late for a MeetingInstance which has already been counted is added on
+            AttendanceRecord.objects.create(student=self.student, meeting_instance=meeting2.instances.get(),
+                                            time_attended=dateutil.parser.parse("Dec 6th, 2016 09:30:00Z"))
+
+            with self.assertNumQueries(4):
+                self.assertEqual(percentages()["Advanced Sleeping"], 100.0)
+
+        with freeze_time("Dec 12th, 2016 12:00:00"):
+            # Once the counters expire, only the MeetingInstances since they were counted are counted
+            self.assertEqual(percentages()["Advanced Sleeping"], 100.0)
+            counter = AttendanceCounter.objects.get(student=self.student, class_rel=self.class_)
+            self.assertEqual((counter.contributing, counter.counted_through), (2, datetime.date(2016, 12, 12)))
+
+            # Installing a beacon means the rooms' MeetingInstances have to be counted again
+            Beacon.objects.create(uuid='123e4567-e89b-12d3-a456-426655440000', major=4, minor=1,
+                                  room=self.unbeaconed_room, date_added=datetime.date(2016, 12, 1))
+            self.assertTrue(AttendanceCounter.objects.get(pk=counter.pk).dirty)
+
+            # Dec 12th's MeetingInstance started before now, so it doesn't count yet
+            self.assertEqual(percentages()["Advanced Sleeping"], 100.0)
+
+        with freeze_time("Dec 13th, 2016 12:00:00"):
+            self.assertEqual(refresh_stale_counters(), 2)
+            self.assertAlmostEqual(percentages()["Advanced Sleeping"], 200.0 / 3)
+
+    def test_refresh_counters_concurrently(self):
+        AttendanceRecord.objects.create(student=self.student, meeting_instance=self.meeting1inst1,
+                                        time_attended=dateutil.parser.parse("Dec 5th, 2016 09:30:00Z"))
+
+        with freeze_time("Dec 5th, 2016 12:00:00"):
+            refresh_counters(self.student, [AttendanceCounter(student=self.student, class_rel=self.class_)])
+
+        with freeze_time("Dec 7th, 2016 12:00:00"):
+            # Two requests read the same stale counter, and both bring it forward
+            first, second = [AttendanceCounter.objects.get(student=self.student, class_rel=self.class_)
+                             for _ in range(2)]
+            refresh_counters(self.student, [first])
+            refresh_counters(self.student, [second])
+
+            counter = AttendanceCounter.objects.get(pk=first.pk)
+            self.assertEqual((counter.attended, counter.contributing, counter.counted_through),
+                             (1, 1, datetime.date(2016, 12, 7)))
+            self.assertEqual((second.attended, second.contributing), (1, 1))
+
+    def test_immutable_values_copy(self):
+        streak = Streak(datetime.date(2016, 12, 5), datetime.date(2016, 12, 19))
+        location = Location(self.meeting1inst1, LocationStatus.IN_CLASS)
+
+        for copied in (copy.copy(streak), copy.deepcopy(streak), pickle.loads(pickle.dumps(streak))):
+            self.assertEqual(copied, streak)
+            self.assertEqual(str(copied), '2016-12-05/2016-12-19')
+
+        for copied in (copy.copy(location), copy.deepcopy(location), pickle.loads(pickle.dumps(location))):
+            self.assertEqual(copied.meeting_instance, self.meeting1inst1)
+            self.assertEqual(copied.status, LocationStatus.IN_CLASS.value)
+
+        with self.assertRaises(AttributeError):
+            streak.end = datetime.date(2017, 1, 2)
+
+    def test_streaks(self):
+        with freeze_time("Dec 5th, 2016"):
+            other_class = Class.objects.create(class_code="Intermediate Napping")
+            meeting2 = Meeting.objects.create(time_start=datetime.time(9, 00), time_end=datetime.time(10, 00),
+                                              day_of_week=1, class_rel=other_class)
+            self.student.meeting_set.add(meeting2)
+
+            instances = {datetime.date(2016, 12, 5): self.meeting1inst1,
+                         datetime.date(2016, 12, 12): self.meeting1inst2}
+            for date in (datetime.date(2016, 12, 19), datetime.date(2016, 12, 26), datetime.date(2017, 1, 2)):
+                instances[date] = MeetingInstance.objects.create(date=date, meeting=self.meeting1,
+                                                                 room=self.beaconed_room)
+            for date in (datetime.date(2016, 12, 6), datetime.date(2016, 12, 13), datetime.date(2016, 12, 20)):
+                instances[date] = MeetingInstance.objects.create(date=date, meeting=meeting2,
+                                                                 room=self.beaconed_room)
+
+        for day in (5, 12, 20, 26):
+            AttendanceRecord.objects.create(student=self.student,
+                                            meeting_instance=instances[datetime.date(2016, 12, day)],
+                                            time_attended=dateutil.parser.parse("Dec {}th, 2016 09:30:00Z".format(day)))
+
+        factory = APIRequestFactory()
+        view = StreakViewSet.as_view({'get': 'retrieve'})
+
+        def streaks():
+            request = factory.get('/streaks/2072452q/')
+            force_authenticate(request, user=self.user)
+            response = view(request, username='2072452q')
+
+            class_streaks = {streaks['class_name']: streaks['streaks'] for streaks in response.data['class_streaks']}
+            return response.data['overall'], class_streaks
+
+        with freeze_time("Dec 27th, 2016 12:00:00"):
+            overall, class_streaks = streaks()
+
+            self.assertEqual(overall, ['2016-12-05/2016-12-06', '2016-12-12/2016-12-13', '2016-12-20/2016-12-27'])
+
+            # A streak reaches today while there are meetings to come, or else to the last meeting
+            self.assertEqual(class_streaks, {"Advanced Sleeping": ['2016-12-05/2016-12-19', '2016-12-26/2016-12-27'],
+                                             "Intermediate Napping": ['2016-12-20/2016-12-20']})
+
+            # Working the streaks out from scratch gives the same answer
+            self.assertEqual([str(streak) for streak in self.class_.attendance_streaks(self.student)],
+                             class_streaks["Advanced Sleeping"])
+
+            streak = self.student.overall_streaks[0]
+            self.assertEqual(streak, Streak(datetime.date(2016, 12, 5), datetime.date(2016, 12, 6)))
+            self.assertEqual(len(streak), 1)
+            with self.assertRaises(AttributeError):
+                streak.end = datetime.date(2016, 12, 7)
+
+            # Once stored, the Student, the stored streaks, whether there are more meetings, the Student's Classes and
+            # the ETag's versions
+            with self.assertNumQueries(6):
+                self.assertEqual(streaks(), (overall, class_streaks))
+
+        with freeze_time("Jan 3rd, 2017 12:00:00"):
+            # The missed meeting on Jan 2nd is added on to the stored streaks by the sweep
+            self.assertEqual(sweep_streaks(), 1)
+            self.assertFalse(StreakState.objects.filter(student=self.student, dirty=True).exists())
+
+            # A request which read the StreakStates before the sweep brought them forward doesn't replay the same
+            # meetings once it has its turn
+            records = StreakRecord.objects.filter(student=self.student).count()
+            self.assertEqual(len(catch_up_streaks(self.student)), 3)
+            self.assertEqual(StreakRecord.objects.filter(student=self.student).count(), records)
+
+            overall, class_streaks = streaks()
+            self.assertEqual(overall[-1], '2016-12-20/2017-01-02')
+            self.assertEqual(class_streaks["Advanced Sleeping"][-1], '2016-12-26/2017-01-02')
+
+            # Attendance recorded late for a meeting which has already been counted means starting again
+            AttendanceRecord.objects.create(student=self.student,
+                                            meeting_instance=instances[datetime.date(2017, 1, 2)],
+                                            time_attended=dateutil.parser.parse("Jan 2nd, 2017 09:30:00Z"))
+            self.assertTrue(StreakState.objects.filter(student=self.student, dirty=True).exists())
+
+            overall, class_streaks = streaks()
+            self.assertEqual(overall[-1], '2016-12-20/2017-01-02')
+            self.assertEqual(class_streaks["Advanced Sleeping"], ['2016-12-05/2016-12-19', '2016-12-26/2017-01-02'])
+
+    @freeze_time("Dec 5th, 2016 10:30:00")
+    def test_create_multiple_attendance_records_async(self):
+        factory = APIRequestFactory()
+        view = AttendanceRecordViewSet.as_view({'post': 'create_multiple'})
+
+        sightings = [{'uuid': '123e4567-e89b-12d3-a456-426655440000', 'major': 1, 'minor': 1,
+                      'seen_at_time': "2016-12-05T09:15:00"}]
+
+        request = factory.post('/attendance-records/add-multiple/?async=true', sightings, format='json')
+        force_authenticate(request, user=self.user)
+        response = view(request)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], SightingBatch.PENDING)
+        self.assertFalse(AttendanceRecord.objects.filter(student=self.student).exists())
+
+        self.assertEqual(drain(), 1)
+        self.assertEqual(drain(), 0)
+
+        client = RequestsClient()
+        client.headers.update({'Authorization': 'Token ' + str(self.token.key)})
+        response = client.get(response.data['url'])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], SightingBatch.DONE)
+        self.assertEqual(response.json()['attendance_records'][0]['meeting_instance'], self.meeting1inst1.pk)
+        self.assertTrue(AttendanceRecord.objects.filter(student=self.student,
+                                                        meeting_instance=self.meeting1inst1).exists())
+
 class Crypto(TestCase):
 
     def test_crypto(self):
@@ -0,0 +1,120 @@
+import hashlib
+from typing import Callable, Iterable, List
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from .models import AttendanceRecord, Beacon, Meeting, MeetingInstance, Student
+from .signals import attendance_recorded, bulk_saved
+from .versions import bump_versions, get_version, get_versions
+
+BEACON_VERSION_KEY = 'timetable-version:beacons'
+
+
+def timetable_version_key(student_id: int) -> str:
+    """
+    :return: the key of the Version which is bumped whenever the Student's timetable changes
+    """
+    return 'timetable-version:{}'.format(student_id)
+
+
+def timetable_version_keys(student_id: int) -> List[str]:
+    """
+    :return: the keys of the Versions which the Student's cached timetable pages are kept under
+    """
+    return [timetable_version_key(student_id), BEACON_VERSION_KEY]
+
+
+def bump_timetable_versions(student_ids: Iterable[int]):
+    """
+    Marks the cached timetable pages of the Students as out of date
+    """
+    bump_versions(timetable_version_key(student_id) for student_id in student_ids)
+
+
+def bump_beacon_version():
+    """
+    Marks every cached timetable page as out of date, since they all show which rooms have beacons
+    """
+    bump_versions([BEACON_VERSION_KEY])
+
+
+def timetable_version(student_id: int) -> int:
+    """
+    :return: a number which changes whenever the Student's timetable pages go out of date
+    """
+    return get_version(timetable_version_key(student_id))
+
+
+def timetable_versions(student: Student) -> List[int]:
+    """
+    :return: the Versions which the Student's cached timetable pages are kept under. Read once for each Student object,
+    so that the page and its ETag are made from the same ones.
+    """
+    versions = getattr(student, '_timetable_versions', None)
+    if versions is None:
+        versions = student._timetable_versions = get_versions(timetable_version_keys(student.pk))
+
+    return versions
+
+
+def timetable_page(student: Student, page: str, request, build: Callable[[], List]) -> List:
+    """
+    Returns a serialized page of a Student's timetable from the cache, building and caching it if it isn't there or is
+    out of date. The page is the same whoever is viewing it, so it is shared by the Student and all of their friends.
+    :param page: identifies which part of the timetable the page shows, e.g. the week
+    :param build: makes the serialized page
+    """
+
+    # Pages contain absolute links, so they depend on the host they were requested through
+    page_digest = hashlib.sha1('{}|{}'.format(request.build_absolute_uri('/'), page).encode('UTF-8')).hexdigest()
+    versions = ':'.join(str(version) for version in timetable_versions(student))
+    key = 'timetable:{}:{}:{}'.format(student.pk, versions, page_digest)
+
+    data = cache.get(key)
+    if data is None:
+        data = list(build())
+        cache.set(key, data, settings.TIMETABLE_CACHE_TIMEOUT)
+
+    return data
+
+
+@receiver(attendance_recorded)
+def _attendance_recorded(sender, records, **kwargs):
+    bump_timetable_versions(record.student_id for record in records)
+
+
+@receiver(post_delete, sender=AttendanceRecord)
+def _attendance_record_deleted(sender, instance, **kwargs):
+    bump_timetable_versions([instance.student_id])
+
+
+@receiver(post_save, sender=Beacon)
+@receiver(post_delete, sender=Beacon)
+def _beacon_changed(sender, **kwargs):
+    bump_beacon_version()
+
+
+@receiver(bulk_saved, sender=MeetingInstance)
+def _meeting_instances_bulk_saved(sender, instances, **kwargs):
+    # Timetable syncs write MeetingInstances in bulk, and every Student in their Meetings sees the change
+    meeting_ids = {instance.meeting_id for instance in instances}
+    bump_timetable_versions(Meeting.students.through.objects.filter(meeting__in=meeting_ids)
+                            .values_list('student', flat=True))
+
+
+@receiver(m2m_changed, sender=Meeting.students.through)
+def _meeting_students_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # Clearing a Meeting's Students has to be handled before they are removed
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if reverse:
+        # instance is a Student
+        bump_timetable_versions([instance.pk])
+    elif pk_set:
+        bump_timetable_versions(pk_set)
+    else:
+        bump_timetable_versions(instance.students.values_list('pk', flat=True))
@@ -7,6 +7,7 @@ router.register(r'accounts', AccountsViewSet, base_name='account')
 router.register(r'buildings', BuildingViewSet)
 router.register(r'rooms', RoomViewSet)
 router.register(r'beacons', BeaconViewSet)
+router.register(r'beacon-manifest', BeaconManifestViewSet, base_name='beacon-manifest')
 router.register(r'tokens', TokenViewSet)
 router.register(r'logs', LogEntryViewSet, base_name='log')
 router.register(r'classes', ClassViewSet)
@@ -15,6 +16,7 @@ router.register(r'meeting-instances', MeetingInstanceViewSet)
 router.register(r'students', StudentViewSet)
 router.register(r'timetables', TimetableViewSet, base_name='timetable')
 router.register(r'attendance-records', AttendanceRecordViewSet, base_name='attendance-record')
+router.register(r'sighting-batches', SightingBatchViewSet, base_name='sighting-batch')
 router.register(r'friends', FriendViewSet, base_name='friend')
 router.register(r'attendances', AttendancePercentageViewSet, base_name='attendance')
 router.register(r'streaks', StreakViewSet, base_name='streak')
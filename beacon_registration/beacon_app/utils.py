@@ -2,16 +2,35 @@ import datetime
 
 
 class Streak:
+    """
+    An immutable run of attendance from start to end. Its ISO 8601 rendering is worked out once, when it is created.
+    """
+    __slots__ = ('start', 'end', 'iso')
+
     def __init__(self, start: datetime.date, end: datetime.date):
-        self.start = start
-        self.end = end
+        object.__setattr__(self, 'start', start)
+        object.__setattr__(self, 'end', end)
+        object.__setattr__(self, 'iso', start.isoformat() + '/' + end.isoformat())
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Streaks can't be changed")
+
+    def __reduce__(self):
+        # Copying and unpickling would otherwise restore the slots with __setattr__
+        return Streak, (self.start, self.end)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Streak) and self.start == other.start and self.end == other.end
+
+    def __hash__(self) -> int:
+        return hash((self.start, self.end))
 
     def __len__(self) -> int:
         return (self.end - self.start).days
 
     def __str__(self) -> str:
         # ISO 8601
-        return str(self.start) + '/' + str(self.end)
+        return self.iso
 
     def __repr__(self):
-        return str(self)
+        return self.iso
@@ -0,0 +1,55 @@
+from typing import Iterable, List
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .models import Version
+
+
+def get_versions(keys: List[str]) -> List[int]:
+    """
+    Reads several Versions with a single query
+    :return: the value of the Version stored under each key, in the same order, or 0 for keys which have never been
+    bumped
+    """
+    values = dict(Version.objects.filter(key__in=keys).values_list('key', 'value'))
+    return [values.get(key, 0) for key in keys]
+
+
+def get_version(key: str) -> int:
+    """
+    :return: the value of the Version stored under the key, or 0 if it has never been bumped
+    """
+    return get_versions([key])[0]
+
+
+def bump_versions(keys: Iterable[str]):
+    """
+    Changes the Versions stored under the keys, creating any which don't exist yet
+    """
+    keys = set(keys)
+
+    # Usually every Version already exists, and this is the only query
+    if not keys or Version.objects.filter(key__in=keys).update(value=F('value') + 1) == len(keys):
+        return
+
+    missing = keys - set(Version.objects.filter(key__in=keys).values_list('key', flat=True))
+
+    try:
+        with transaction.atomic():
+            Version.objects.bulk_create([Version(key=key, value=1) for key in missing])
+    except IntegrityError:
+        # Some were created by another process since they were read
+        for key in missing:
+            try:
+                with transaction.atomic():
+                    Version.objects.create(key=key, value=1)
+            except IntegrityError:
+                Version.objects.filter(key=key).update(value=F('value') + 1)
+
+
+def bump_version(key: str):
+    """
+    Changes the Version stored under the key
+    """
+    bump_versions([key])
@@ -1,6 +1,14 @@
+import time
+import uuid
+from typing import Dict, List, Union
+
 import pytz
 import requests
-from django.db import transaction
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch
+from django.http import StreamingHttpResponse
 from requests import Session
 from rest_framework import status
 from rest_framework import viewsets, mixins
@@ -17,9 +25,22 @@ from rest_framework.utils.serializer_helpers import ReturnDict
 
 from beacon_app.exceptions import AlreadyExists
 
+from .counters import counters_version
 from .crypto import PasswordCrypto
+from .etags import ConditionalGetMixin, model_version_key
 from .auth import ExpiringTokenAuthentication, token_expired
-from .meetingbuilder import get_or_create_meetings
+from .indexes import beacon_index, attended_index
+from .ical import timetable_calendar
+from .idempotency import idempotent
+from .ingest import record_sightings, find_meeting_instance
+from .manifest import beacon_manifest
+from .pagination import KeysetPagination
+from .sightingqueue import enqueue_sightings
+from .syncqueue import do_sync, enqueue_sync
+from .streaks import streaks_version
+from .timetablecache import timetable_page, timetable_version_key, timetable_version_keys, timetable_versions
+from .versions import get_versions
+from .presence import presence_map
 from .permissions import IsUser, IsUserOrSharedWithUser, IsAuthenticatedOrCreating
 from .serializers import *
 from .models import *
@@ -31,22 +52,25 @@ class RoomViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = RoomSerializer
 
 
-class BeaconViewSet(viewsets.ReadOnlyModelViewSet):
+class BeaconViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     authentication_classes = ()
     queryset = Beacon.objects.all()
     serializer_class = BeaconSerializer
+    etag_models = (Beacon,)
 
 
-class BuildingViewSet(viewsets.ReadOnlyModelViewSet):
+class BuildingViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     authentication_classes = ()
     queryset = Building.objects.all()
     serializer_class = BuildingSerializer
+    etag_models = (Building, Room)
 
 
-class RoomViewSet(viewsets.ReadOnlyModelViewSet):
+class RoomViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     authentication_classes = ()
     queryset = Room.objects.all()
     serializer_class = NestedRoomSerializer
+    etag_models = (Room, Building, Beacon)
 
 
 class AccountsViewSet(viewsets.ViewSet):
@@ -66,7 +90,7 @@ class AccountsViewSet(viewsets.ViewSet):
         new_account_details = serializer.data
 
         with requests.Session() as s:
-            r = s.post("https://frontdoor.spa.gla.ac.uk/spacett/login.m",
+            r = s.post(settings.TIMETABLE_LOGIN_URL,
                        data={'guid': new_account_details['username'], 'password': new_account_details['password']})
 
             if not r.status_code == requests.codes.ok:
@@ -155,7 +179,7 @@ class TokenViewSet(viewsets.ViewSet):
                 if not student.fake_account:
                     with requests.Session() as s:
 
-                        r = s.post("https://frontdoor.spa.gla.ac.uk/spacett/login.m",
+                        r = s.post(settings.TIMETABLE_LOGIN_URL,
                                    data={'guid': data['username'], 'password': data['password']})
 
                         if not r.status_code == requests.codes.ok:
@@ -167,17 +191,15 @@ class TokenViewSet(viewsets.ViewSet):
         return Response({'token': token.key})
 
 
-def do_sync(session: Session, student: Student):
-    next_year = datetime.datetime.utcnow() + datetime.timedelta(days=365)
-    next_year_timestamp = calendar.timegm(next_year.utctimetuple())
-
-    r = session.get("https://frontdoor.spa.gla.ac.uk/spacett/timetable/events.m",
-                    params={'start': 0, 'end': next_year_timestamp})
-
-    new_timetable_json = r.json()
-
-    if new_timetable_json is not None:
-        get_or_create_meetings(new_timetable_json, student)
+def sync_or_enqueue(session: Session, student: Student):
+    """
+    Syncs the Student's timetable using a session which is logged in to the timetable service as them, or only queues
+    the sync if settings.TIMETABLE_SYNC_IN_BACKGROUND is set
+    """
+    if settings.TIMETABLE_SYNC_IN_BACKGROUND:
+        enqueue_sync(student, session)
+    else:
+        do_sync(session, student)
 
 
 def make_token(data: ReturnDict, student: Student, session: Session=None) -> Token:
@@ -187,38 +209,103 @@ def make_token(data: ReturnDict, student: Student, session: Session=None) -> Tok
         return token
 
     if session:
-        do_sync(session, student)
+        sync_or_enqueue(session, student)
     else:
         with requests.Session() as session:
-            r = session.post("https://frontdoor.spa.gla.ac.uk/spacett/login.m",
+            r = session.post(settings.TIMETABLE_LOGIN_URL,
                              data={'guid': data['username'], 'password': data['password']})
 
             if not r.status_code == requests.codes.ok:
                 raise AuthenticationFailed("Wrong username or password")
 
-            do_sync(session, student)
+            sync_or_enqueue(session, student)
 
     return token
 
 
-class ClassViewSet(viewsets.ReadOnlyModelViewSet):
+class BeaconManifestViewSet(viewsets.ViewSet):
+    """
+    A flat list of every Beacon with its Room and Building, for clients to map the Beacons they see to Rooms. Given the
+    cursor from an earlier response as ?since=, only lists the Beacons added, moved or removed since then.
+    """
+    authentication_classes = (ExpiringTokenAuthentication,)
+    permission_classes = (IsAuthenticated,)
+
+    def list(self, request, format=None):
+        since = request.query_params.get('since', None)
+
+        try:
+            since = int(since) if since is not None else None
+        except ValueError:
+            raise ParseError(detail="The since parameter was not a valid cursor")
+
+        if since is not None and since < 0:
+            raise ParseError(detail="The since parameter was not a valid cursor")
+
+        manifest = beacon_manifest(since)
+
+        manifest['beacons'] = ManifestBeaconSerializer(manifest['beacons'], many=True).data
+        manifest['shuffled_ids'] = ManifestShuffledIDSerializer(manifest['shuffled_ids'], many=True).data
+        return Response(manifest)
+
+
+def field_included(request: Request, field: str) -> bool:
+    """
+    :return: whether a field is included in the response, as chosen by ?fields=
+    """
+    fields = requested_fields(request)
+    return fields is None or field in fields
+
+
+class ClassViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     authentication_classes = ()
     queryset = Class.objects.all()
     serializer_class = ClassSerializer
+    pagination_class = KeysetPagination
+    etag_models = (Class, Meeting)
+
+    def get_queryset(self):
+        queryset = super(ClassViewSet, self).get_queryset()
 
+        if field_included(self.request, 'meetings'):
+            # Only the pks are needed for the links
+            queryset = queryset.prefetch_related(Prefetch('meetings', queryset=Meeting.objects.only('pk', 'class_rel')))
 
-class MeetingViewSet(viewsets.ReadOnlyModelViewSet):
+        return queryset
+
+
+class MeetingViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     authentication_classes = ()
     queryset = Meeting.objects.all()
     serializer_class = MeetingSerializer
+    pagination_class = KeysetPagination
+    etag_models = (Meeting, Class, MeetingInstance)
+
+    def get_queryset(self):
+        queryset = super(MeetingViewSet, self).get_queryset()
+
+        if field_included(self.request, 'instances'):
+            queryset = queryset.prefetch_related(
+                Prefetch('instances', queryset=MeetingInstance.objects.only('pk', 'meeting')))
+
+        return queryset
 
 
 class MeetingInstanceViewSet(viewsets.ReadOnlyModelViewSet):
     authentication_classes = (ExpiringTokenAuthentication,)
     queryset = MeetingInstance.objects.all()
     serializer_class = MeetingInstanceSerializer
+    pagination_class = KeysetPagination
     lookup_field = 'pk'
 
+    def get_queryset(self):
+        queryset = super(MeetingInstanceViewSet, self).get_queryset()
+
+        if field_included(self.request, 'lecturer'):
+            queryset = queryset.select_related('lecturer')
+
+        return queryset
+
     @detail_route(methods=['get'], permission_classes=(IsAuthenticated,), url_path='friends-attended')
     def list_attended_friends(self, request, pk, format=None):
         """
@@ -260,29 +347,78 @@ class FriendViewSet(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.Creat
         if not IsUserOrSharedWithUser().has_object_permission(request, self, friend):
             raise NotFound("No such friend {}".format(user__username))
 
-        data = Student.objects.get(user__username=user__username).location
-
-        if data['meeting_instance'] is None:
-            data.pop('meeting_instance')
-        else:
-            meeting_inst = data['meeting_instance']
-            data['time_start'] = meeting_inst.meeting.time_start
-            data['time_end'] = meeting_inst.meeting.time_end
-            data['room'] = meeting_inst.room.room_code
-            data['building'] = meeting_inst.room.building.name
-            data['class_name'] = str(meeting_inst.meeting.class_rel)
-
-        serializer = LocationSerializer(data=data)
+        serializer = LocationSerializer(data=location_data(friend.current_location))
         serializer.is_valid(raise_exception=True)
 
         return Response(serializer.data)
 
     @list_route(methods=['GET'], url_path='location-statuses')
-    def location_statuses(self, *args, **kwargs):
+    def location_statuses(self, request, *args, **kwargs):
+        """
+        :return: the location status of every friend. With ?include=location, the details of the class they should be
+        in are included too.
+        """
         student = self.get_object()
-        serializer = LocationStatusSerializer(student.friends, many=True)
+        include_location = request.query_params.get('include', None) == 'location'
+
+        friends = list(student.friends.select_related('user'))
+
+        serializer = FriendLocationSerializer(data=friend_statuses(friends, include_location), many=True)
+        serializer.is_valid(raise_exception=True)
+
         return Response(serializer.data)
 
+    @list_route(methods=['GET'], url_path='location-changes')
+    def location_changes(self, request, *args, **kwargs):
+        """
+        Long-polls for changes to friends' locations. Pass the cursor from the previous response as ?cursor= to wait
+        for up to settings.LOCATION_CHANGES_TIMEOUT seconds for a friend's location status to change. Only the friends
+        whose status changed are included. Without a cursor, or with one which has expired, every friend is included
+        and 'full' is true. Supports ?include=location in the same way as location-statuses.
+
+        Only changes made in this process wake a waiting request. Attendance recorded by another process, such as
+        processsightings, is seen once PRESENCE_MAX_AGE has passed. At most settings.LOCATION_CHANGES_MAX_WAITERS
+        requests wait at once in each process, and any more return straight away.
+        :return: the changed statuses, and the cursor to pass to the next request
+        """
+        student = self.get_object()
+        include_location = request.query_params.get('include', None) == 'location'
+        cursor = request.query_params.get('cursor', None)
+
+        friends = list(student.friends.select_related('user'))
+        friend_ids = [friend.pk for friend in friends]
+
+        previous = cache.get(location_cursor_key(student, cursor)) if cursor else None
+
+        with presence_map.waiting() as can_wait:
+            # Once every place to wait is taken, requests return straight away as they would with a timeout of 0
+            deadline = time.monotonic() + (settings.LOCATION_CHANGES_TIMEOUT if can_wait else 0)
+
+            while True:
+                statuses = friend_statuses(friends, include_location)
+
+                if previous is None:
+                    changes = statuses
+                else:
+                    changes = [status_data for status_data in statuses
+                               if previous.get(status_data['username']) != status_data]
+
+                remaining = deadline - time.monotonic()
+                if changes or remaining <= 0:
+                    break
+
+                presence_map.wait_for_change(friend_ids, remaining)
+
+        next_cursor = uuid.uuid4().hex
+        cache.set(location_cursor_key(student, next_cursor),
+                  {status_data['username']: status_data for status_data in statuses},
+                  settings.LOCATION_CURSOR_TIMEOUT)
+
+        serializer = FriendLocationSerializer(data=changes, many=True)
+        serializer.is_valid(raise_exception=True)
+
+        return Response({'cursor': next_cursor, 'full': previous is None, 'changes': serializer.data})
+
     @list_route(methods=['GET'], permission_classes=(IsAuthenticated,), url_path='friendship-statuses-involving-me')
     def list_friendships_involving_me(self, *args, **kwargs):
         student = self.get_object()
@@ -374,6 +510,48 @@ class FriendViewSet(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.Creat
         return self.request.user.student
 
 
+def friend_statuses(friends: List[Student], include_location: bool) -> List[Dict]:
+    """
+    :return: the location status of each friend, with the details of their class if include_location is set
+    """
+    locations = presence_map.locations([friend.pk for friend in friends])
+
+    statuses = []
+    for friend in friends:
+        if include_location:
+            status_data = location_data(locations[friend.pk])
+        else:
+            status_data = {'location_status': locations[friend.pk].status}
+
+        status_data['username'] = friend.username
+        statuses.append(status_data)
+
+    return statuses
+
+
+def location_cursor_key(student: Student, cursor: str) -> str:
+    return 'location-cursor:{}:{}'.format(student.pk, cursor)
+
+
+def location_data(location: Location) -> Dict:
+    """
+    :return: the location status, along with the times and place of the MeetingInstance if there is one
+    """
+    data = {'location_status': location.status}
+
+    meeting_inst = location.meeting_instance
+    if meeting_inst is not None:
+        data['time_start'] = meeting_inst.meeting.time_start
+        data['time_end'] = meeting_inst.meeting.time_end
+        data['class_name'] = str(meeting_inst.meeting.class_rel)
+
+        if meeting_inst.room is not None:
+            data['room'] = meeting_inst.room.room_code
+            data['building'] = meeting_inst.room.building.name
+
+    return data
+
+
 def viewable_students(request: Request, view_base, format=None) -> Response:
     """
     A generic view for listing which resources are accessible by the Student sending this request
@@ -386,7 +564,34 @@ def viewable_students(request: Request, view_base, format=None) -> Response:
     return Response(AllowedTimetableSerializer(student, base_view=view_base, context={'request': request}).data)
 
 
-class TimetableViewSet(viewsets.ViewSet):
+class StudentConditionalGetMixin(ConditionalGetMixin):
+    """
+    A ConditionalGetMixin for the views which show a single Student's data, looked up by their username
+    """
+
+    def get_object(self, username: str) -> Student:
+        # Looked up once for both the ETag and the response
+        if getattr(self, '_student', None) is None:
+            obj = get_object_or_404(Student, user__username=username)
+            self.check_object_permissions(self.request, obj)
+            self._student = obj
+
+        return self._student
+
+    def get_etag_parts(self, request, username=None, **kwargs) -> Union[List, None]:
+        if username is None:
+            return None
+
+        return self.get_student_etag_parts(self.get_object(username))
+
+    def get_student_etag_parts(self, student: Student) -> Union[List, None]:
+        """
+        :return: cheap values which change whenever the Student's response would, or None if there is no ETag for it
+        """
+        return None
+
+
+class TimetableViewSet(StudentConditionalGetMixin, viewsets.ViewSet):
     """
     Contains the views which present MeetingInstance information in a
     client friendly manner
@@ -395,10 +600,9 @@ class TimetableViewSet(viewsets.ViewSet):
     permission_classes = (IsAuthenticated, IsUserOrSharedWithUser)
     lookup_field = 'username'
 
-    def get_object(self, username: str) -> Student:
-        obj = get_object_or_404(Student, user__username=username)
-        self.check_object_permissions(self.request, obj)
-        return obj
+    def get_student_etag_parts(self, student: Student) -> List:
+        # The same versions that the cached timetable pages are kept under
+        return timetable_versions(student)
 
     def list(self, request, format=None):
         return viewable_students(request, 'timetable', format)
@@ -406,13 +610,32 @@ class TimetableViewSet(viewsets.ViewSet):
     def retrieve(self, request, username=None, format=None):
         timetable_username = username
         timetable_student = self.get_object(timetable_username)
-        return Response(TimetableSerializer(self.get_meetings(timetable_student), many=True,
-                                            context={'student': timetable_student, 'request': request}).data)
 
-    def get_meetings(self, student: Student):
-        meetings = student.meeting_set.all()
+        page = '&'.join('{}={}'.format(param, request.query_params.get(param, ''))
+                        for param in ('day', 'week', 'month'))
 
-        queryset = MeetingInstance.objects.filter(meeting__in=meetings)
+        return Response(timetable_page(timetable_student, page, request,
+                                       lambda: TimetableSerializer(self.get_meetings(timetable_student), many=True,
+                                                                   context={'student': timetable_student,
+                                                                            'request': request}).data))
+
+    @detail_route(methods=['get'], url_path='ics')
+    def calendar(self, request, username=None, format=None):
+        """
+        :return: the timetable as an iCalendar file, streamed a few events at a time. Takes the same filtering
+        parameters as the timetable.
+        """
+        timetable_student = self.get_object(username)
+
+        instances = self.get_meetings(timetable_student).order_by('meeting_id', 'room_id', 'lecturer_id', 'date')
+        response = StreamingHttpResponse(timetable_calendar(username, instances.iterator(), request.get_host()),
+                                         content_type='text/calendar; charset=utf-8')
+        response['Content-Disposition'] = 'attachment; filename="{}.ics"'.format(username)
+        return response
+
+    def get_meetings(self, student: Student):
+        queryset = MeetingInstance.objects.filter(meeting__students=student).select_related(
+            'meeting__class_rel', 'room__building', 'lecturer')
 
         day = self.request.query_params.get('day', None)
         week = self.request.query_params.get('week', None)
@@ -438,15 +661,18 @@ class TimetableViewSet(viewsets.ViewSet):
             raise ParseError(detail="Filtering parameter was not in a valid format")
 
 
-class AttendancePercentageViewSet(viewsets.ViewSet):
+class AttendancePercentageViewSet(StudentConditionalGetMixin, viewsets.ViewSet):
     authentication_classes = (ExpiringTokenAuthentication,)
     permission_classes = (IsAuthenticated, IsUserOrSharedWithUser)
     lookup_field = 'username'
 
-    def get_object(self, username: str) -> Student:
-        obj = get_object_or_404(Student, user__username=username)
-        self.check_object_permissions(self.request, obj)
-        return obj
+    def get_student_etag_parts(self, student: Student) -> Union[List, None]:
+        counters = counters_version(student)
+        if counters is None:
+            return None
+
+        return get_versions(timetable_version_keys(student.pk) +
+                            [model_version_key(Class), model_version_key(MeetingInstance)]) + [counters]
 
     @staticmethod
     def list(request, format=None):
@@ -471,43 +697,24 @@ class AttendanceRecordViewSet(viewsets.ViewSet):
     permission_classes = (IsAuthenticated,)
 
     @list_route(methods=['POST'], url_path='add-multiple')
+    @idempotent
     def create_multiple(self, request, format=None):
         student = self.request.user.student
-        
+
         serializer = BeaconSightingDeserializer(data=request.data, many=True)
         serializer.is_valid(raise_exception=True)
 
-        beacon_sightings = serializer.validated_data
-        new_attendance_records = []
-
-        for sighting in beacon_sightings:
-            try:
-                beacon = Beacon.objects.get(uuid=sighting['uuid'], major=sighting['major'], minor=sighting['minor'])
-            except Beacon.DoesNotExist:
-                continue
-
-            try:
-                seen_at_date = sighting['seen_at_time'].date()
-                seen_at_time = sighting['seen_at_time'].time()
-
-                meeting_instance = MeetingInstance.objects.get(room=beacon.room,
-                                                               date=seen_at_date,
-                                                               meeting__time_start__lte=seen_at_time,
-                                                               meeting__time_end__gte=seen_at_time,
-                                                               meeting__students=student)
-            except MeetingInstance.DoesNotExist:
-                continue
-
-            try:
-                AttendanceRecord.objects.get(student=student, meeting_instance=meeting_instance)
-            except AttendanceRecord.DoesNotExist:
-                record = AttendanceRecord.objects.create(student=student, meeting_instance=meeting_instance,
-                                                         time_attended=sighting['seen_at_time'])
+        if request.query_params.get('async', 'false').lower() == 'true':
+            # The sightings will be processed by the processsightings command
+            batch = enqueue_sightings(student, serializer.validated_data)
+            return Response(SightingBatchSerializer(batch, context={'request': request}).data,
+                            status=status.HTTP_202_ACCEPTED)
 
-                new_attendance_records.append(record)
+        new_attendance_records = record_sightings(student, serializer.validated_data)
 
         return Response(AttendanceRecordSerializer(new_attendance_records, many=True).data)
 
+    @idempotent
     def create(self, request, format=None):
         student = self.request.user.student
 
@@ -515,30 +722,27 @@ class AttendanceRecordViewSet(viewsets.ViewSet):
         serializer.is_valid(raise_exception=True)
         data = serializer.validated_data
 
-        try:
-            # TODO: Replace this lookup with a ShuffledIDs lookup
-            beacon = Beacon.objects.get(uuid=data['uuid'], major=data['major'], minor=data['minor'])
-        except Beacon.DoesNotExist:
+        beacon = beacon_index.resolve(data['uuid'], data['major'], data['minor'], seen_at=data['seen_at_time'])
+        if beacon is None:
             raise NotFound("No such beacon exists")
 
-        try:
-            seen_at_date = data['seen_at_time'].date()
-            seen_at_time = data['seen_at_time'].time()
-
-            meeting_instance = MeetingInstance.objects.get(room=beacon.room,
-                                                           date=seen_at_date,
-                                                           meeting__time_start__lte=seen_at_time,
-                                                           meeting__time_end__gte=seen_at_time,
-                                                           meeting__students=student)
-        except MeetingInstance.DoesNotExist:
+        meeting_instance = find_meeting_instance(student, beacon.room_id, data['seen_at_time'])
+        if meeting_instance is None:
             raise NotFound("The student is not in a class where this beacon is")
 
+        if meeting_instance.pk in attended_index.attended(student.pk, [meeting_instance.date]):
+            raise AlreadyExists("This attendance record already exists")
+
         try:
-            AttendanceRecord.objects.get(student=student, meeting_instance=meeting_instance)
+            with transaction.atomic():
+                record = AttendanceRecord.objects.create(student=student, meeting_instance=meeting_instance,
+                                                         time_attended=data['seen_at_time'])
+        except IntegrityError:
+            # Recorded by another process since the AttendedIndex was loaded
             raise AlreadyExists("This attendance record already exists")
-        except AttendanceRecord.DoesNotExist:
-            record = AttendanceRecord.objects.create(student=student, meeting_instance=meeting_instance,
-                                                     time_attended=data['seen_at_time'])
+        except ValidationError:
+            # Unenrolled by another process since the MeetingIndex was loaded
+            raise NotFound("The student is not in a class where this beacon is")
 
         return Response(AttendanceRecordSerializer(record).data,
                         status=status.HTTP_201_CREATED)
@@ -571,15 +775,30 @@ class AttendanceRecordViewSet(viewsets.ViewSet):
             raise NotFound("No such meeting instance exists")
 
 
-class StreakViewSet(viewsets.ViewSet):
+class SightingBatchViewSet(viewsets.GenericViewSet, mixins.RetrieveModelMixin):
+    """
+    Contains the views for checking on sightings queued with attendance-records/add-multiple?async=true
+    """
+    authentication_classes = (ExpiringTokenAuthentication,)
+    permission_classes = (IsAuthenticated,)
+    serializer_class = SightingBatchSerializer
+
+    def get_queryset(self):
+        return SightingBatch.objects.filter(student=self.request.user.student)
+
+
+class StreakViewSet(StudentConditionalGetMixin, viewsets.ViewSet):
     authentication_classes = (ExpiringTokenAuthentication,)
     permission_classes = (IsAuthenticated, IsUserOrSharedWithUser)
     lookup_field = 'username'
 
-    def get_object(self, username: str) -> Student:
-        obj = get_object_or_404(Student, user__username=username)
-        self.check_object_permissions(self.request, obj)
-        return obj
+    def get_student_etag_parts(self, student: Student) -> Union[List, None]:
+        streaks = streaks_version(student)
+        if streaks is None:
+            return None
+
+        return get_versions([timetable_version_key(student.pk), model_version_key(Class),
+                             model_version_key(MeetingInstance)]) + [streaks]
 
     def list(self, request, format=None):
         return viewable_students(request, 'streak', format)
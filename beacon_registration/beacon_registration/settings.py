@@ -137,4 +137,87 @@ REST_FRAMEWORK = {
     'TOKEN_EXPIRATION': timedelta(hours=24)
 }
 
+# LIST ENDPOINTS
+
+# How many rows a page of the classes, meetings and meeting-instances listings has by default, and the most that can be
+# asked for with ?page_size=
+LIST_PAGE_SIZE = 500
+LIST_MAX_PAGE_SIZE = 5000
+
+# IN-MEMORY INDEXES
+
+# How long the BeaconIndex can be used for before it is reloaded from the database
+BEACON_INDEX_MAX_AGE = timedelta(minutes=5)
+
+# How long the BeaconIndex keeps ShuffledIDs after their valid_until, for sightings which were buffered before they
+# rotated. Sightings from longer ago than this are resolved from the database.
+SHUFFLED_ID_GRACE = timedelta(minutes=30)
+
+# How long a date in the MeetingIndex can be used for before it is rebuilt, and how many dates are kept
+MEETING_INDEX_MAX_AGE = timedelta(minutes=5)
+MEETING_INDEX_MAX_DAYS = 7
+
+# How long the AttendedIndex keeps a student's attended meeting instances before reloading them, and how many
+# students are kept
+ATTENDED_INDEX_MAX_AGE = timedelta(minutes=5)
+ATTENDED_INDEX_MAX_STUDENTS = 10000
+
+# The longest that the PresenceMap keeps a student's location for
+PRESENCE_MAX_AGE = timedelta(minutes=1)
+
+# How many seconds a request to friends/location-changes waits for a change before returning an empty response, and
+# how many seconds the cursor it returns can be used for
+LOCATION_CHANGES_TIMEOUT = 25
+LOCATION_CURSOR_TIMEOUT = 10 * 60
+
+# How many requests to friends/location-changes can wait at once in each process. Each one holds a worker while it
+# waits, and is only woken by changes made in the same process; those made by another process, such as sightings
+# ingested by processsightings, are seen once PRESENCE_MAX_AGE has passed.
+LOCATION_CHANGES_MAX_WAITERS = 8
+
+# CACHES
+
+# Idempotency keys, location cursors and timetable pages are kept in the cache. Use a backend that is shared between
+# processes, such as memcached, when running more than one.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000
+        }
+    }
+}
+
+# How many seconds the response to a request with an Idempotency-Key header is kept for
+IDEMPOTENCY_KEY_TIMEOUT = 24 * 60 * 60
+
+# How many seconds a serialized timetable page is kept for. Pages are replaced as soon as the student's timetable,
+# attendance or beacons change, so this only bounds how long edits made directly to MeetingInstances take to show.
+TIMETABLE_CACHE_TIMEOUT = 60 * 60
+
+# How long a timetable which hasn't changed since it was last synced can go without being applied again. Applying it
+# again repairs any changes made to the student's meetings by other means.
+TIMETABLE_SYNC_MAX_AGE = timedelta(days=7)
+
+# TIMETABLE SYNC
+
+# The university timetable service, which students log in to and their timetables are fetched from
+TIMETABLE_LOGIN_URL = 'https://frontdoor.spa.gla.ac.uk/spacett/login.m'
+TIMETABLE_API_URL = 'https://frontdoor.spa.gla.ac.uk/spacett/timetable/events.m'
+
+# How many seconds a request to the timetable service can take before it is given up on
+TIMETABLE_REQUEST_TIMEOUT = 30
+
+# Whether logging in only queues a sync of the student's timetable, to be run by the synctimetables command, rather
+# than syncing it before responding. Keep the command running while this is set, or timetables won't be synced.
+TIMETABLE_SYNC_IN_BACKGROUND = True
+
+# How long a queued sync can wait for the synctimetables command before it is given up on, along with the cookies of
+# the login session it was queued with
+TIMETABLE_SYNC_QUEUE_TIMEOUT = timedelta(minutes=30)
+
+# The most timetables that the synctimetables command fetches from the timetable service each second, across all of
+# its workers
+TIMETABLE_SYNC_RATE = 5
+
 SOURCE_CODE_URL = "https://github.com/SCOTPAUL/beacon_registration_server"
\ No newline at end of file